@@ -0,0 +1,62 @@
+import csv
+
+from wstlr.bench.extraction import compare_to_baseline
+from wstlr.bench.synthetic import StudyShape, SyntheticStudy
+from wstlr.config import Configuration
+from wstlr.extractor import DataCsvToObject
+
+
+def small_study(tmp_path, **overrides):
+    shape = StudyShape(subjects=10, tables=2, variables=6, harmony_rows=20, **overrides)
+    study = SyntheticStudy(tmp_path, shape)
+    study.generate()
+    return study
+
+
+class TestSyntheticStudy:
+    def test_configuration_parses_every_table_dd(self, tmp_path):
+        study = small_study(tmp_path)
+        with study.config_filename.open() as f:
+            config = Configuration(f)
+
+        assert set(config.study_dd.tables.keys()) == set(
+            study.table_names + study.grouped_table_names + study.embedded_table_names
+        )
+
+    def test_generation_is_deterministic(self, tmp_path):
+        first = small_study(tmp_path / "a")
+        second = small_study(tmp_path / "b")
+
+        first_data = (first.data_dir / "table_00.csv").read_text()
+        assert first_data == (second.data_dir / "table_00.csv").read_text()
+
+    def test_harmony_has_requested_number_of_rows(self, tmp_path):
+        study = small_study(tmp_path)
+        with study.harmony_filename.open() as f:
+            rows = list(csv.DictReader(f))
+
+        assert len(rows) == 20
+
+    def test_extraction_groups_and_embeds(self, tmp_path):
+        study = small_study(tmp_path, aggregated_columns=2, rows_per_subject=2)
+        with study.config_filename.open() as f:
+            config = Configuration(f)
+        dataset = DataCsvToObject(config)
+
+        first_table = dataset[study.table_names[0]]
+        assert len(first_table) == 10
+        assert len(first_table[0]["embedded_00"]) == 2
+        assert len(first_table[0]["measurements"]) == 2
+        # Two distinct group keys per subject
+        assert len(dataset["grouped_00"]) == 20
+        assert len(dataset["harmony"]) == 1
+
+
+def test_compare_to_baseline_flags_only_regressions_beyond_tolerance():
+    baseline = {"extract": {"seconds": 1.0, "peak_mb": 10.0}}
+    results = {"extract": {"seconds": 1.2, "peak_mb": 20.0}}
+
+    regressions = compare_to_baseline(results, baseline, tolerance=1.25)
+
+    assert len(regressions) == 1
+    assert regressions[0].startswith("extract.peak_mb")
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from wstlr.conceptmap import BuildConceptMap
+
+harmony_csv = """local code,text,table_name,parent_varname,local code system,code,display,code system,comment
+M,Male,demo,sex,sex,248153007,Male (finding),http://snomed.info/sct,
+F,Female,demo,sex,sex,248152002,Female (finding),http://snomed.info/sct,
+1,Yes,exposure,smoker,smoker,LA33-6,Yes,http://loinc.org,
+"""
+
+codesystems = [
+    {
+        "table_name": "demo",
+        "varname": "sex",
+        "url": "https://example.org/CodeSystem/demo-sex",
+        "values": [{"code": "M", "description": "Male"}],
+    },
+    {
+        "table_name": "demo",
+        "varname": "sex",
+        "url": "https://example.org/CodeSystem/demo-sex",
+        "values": [
+            {"code": "M", "description": "Male"},
+            {"code": "F", "description": "Female"},
+        ],
+    },
+]
+
+
+@pytest.fixture
+def harmony(tmp_path, monkeypatch):
+    monkeypatch.setenv("WHISTLER_CACHE_DIR", str(tmp_path / "cache"))
+    filename = tmp_path / "harmony.csv"
+    filename.write_text(harmony_csv)
+    return filename
+
+
+def build(harmony, outname, **kwargs):
+    BuildConceptMap([str(harmony)], {}, name_prefix="study", outname=str(outname), codesystems=codesystems, **kwargs)
+
+
+def dd_groups(outname):
+    concept_map = json.loads(outname.read_text())
+    return [x for x in concept_map["group"] if x["target"] == "https://example.org/CodeSystem/demo-sex"]
+
+
+def test_duplicate_dd_groups_are_kept_by_default(harmony, tmp_path):
+    outname = tmp_path / "harmony" / "study.json"
+    build(harmony, outname)
+    assert len(dd_groups(outname)) == 2
+
+
+def test_duplicate_dd_groups_can_be_merged(harmony, tmp_path):
+    outname = tmp_path / "harmony" / "study.json"
+    build(harmony, outname, merge_groups=True)
+
+    groups = dd_groups(outname)
+    assert len(groups) == 1
+    assert [x["code"] for x in groups[0]["element"]] == ["M", "F"]
+
+
+def test_dd_self_maps_are_optional(harmony, tmp_path):
+    outname = tmp_path / "harmony" / "study.json"
+    build(harmony, outname, dd_self_maps=False)
+
+    concept_map = json.loads(outname.read_text())
+    assert set(x["target"] for x in concept_map["group"]) == {
+        "http://snomed.info/sct",
+        "http://loinc.org",
+        "self",
+    }
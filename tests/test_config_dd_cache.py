@@ -0,0 +1,62 @@
+import pytest
+
+from wstlr.bench.synthetic import StudyShape, SyntheticStudy
+from wstlr.config import Configuration
+
+
+@pytest.fixture
+def study(tmp_path, monkeypatch):
+    monkeypatch.setenv("WHISTLER_CACHE_DIR", str(tmp_path / "cache"))
+    study = SyntheticStudy(tmp_path / "study", StudyShape(subjects=5, tables=2, variables=4))
+    study.generate()
+    return study
+
+
+def load_config(study):
+    with study.config_filename.open("rt") as f:
+        return Configuration(f)
+
+
+def dd_summary(study_dd):
+    return {
+        table_name: [(v.varname, v.data_type, v.enumerations, v.url) for v in table.vardata]
+        for table_name, table in study_dd.tables.items()
+    }
+
+
+class TestStudyDdCache:
+    def test_dd_is_parsed_lazily(self, study, tmp_path):
+        config = load_config(study)
+        assert config._study_dd is None
+        assert not (tmp_path / "cache" / "dd").exists()
+
+        assert len(config.study_dd.tables) > 0
+        assert len(list((tmp_path / "cache" / "dd").glob("*.json"))) == 1
+
+    def test_cached_dd_matches_parsed(self, study, monkeypatch):
+        parsed_dd = load_config(study).study_dd
+        parsed = dd_summary(parsed_dd)
+
+        def fail(self):
+            raise AssertionError("The data-dictionary should have come from the cache")
+
+        monkeypatch.setattr(Configuration, "parse_study_dd", fail)
+        cached_dd = load_config(study).study_dd
+        assert dd_summary(cached_dd) == parsed
+        for table_name in parsed_dd.tables:
+            assert cached_dd.table_as_dd(table_name) == parsed_dd.table_as_dd(table_name)
+            assert cached_dd.table_as_cs(table_name) == parsed_dd.table_as_cs(table_name)
+        assert cached_dd.obj_as_dd() == parsed_dd.obj_as_dd()
+
+    def test_changes_invalidate_the_cache(self, study, tmp_path):
+        config = load_config(study)
+        dd_filename = config.dd_sources()[0][1]
+        original = config.study_dd
+
+        with open(dd_filename, "at") as f:
+            f.write("added_variable,An added variable,string,\n")
+
+        config = load_config(study)
+        assert "added_variable" in config.study_dd.tables[config.dd_sources()[0][0]].variables
+        assert len(list((tmp_path / "cache" / "dd").glob("*.json"))) == 2
+        assert "added_variable" not in original.tables[config.dd_sources()[0][0]].variables
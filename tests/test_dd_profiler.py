@@ -0,0 +1,171 @@
+import csv
+import json
+
+import pytest
+
+from wstlr.dd.profiler import (
+    ColumnProfile,
+    HyperLogLog,
+    TopK,
+    exec,
+    profile_csv,
+    profile_files,
+    profile_whistle_input,
+)
+
+
+def write_csv(filename, rows):
+    with open(filename, "wt", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    return filename
+
+
+def demo_rows(count=300):
+    return [
+        {
+            "subject_id": f"p{i:05d}",
+            "sex": ["M", "F", ""][i % 3],
+            "age": str(20 + i % 50),
+            "weight": f"{50 + i / 4:.2f}",
+            "visit_date": f"2021-01-{1 + i % 28:02d}",
+            "smoker": ["yes", "no"][i % 2],
+        }
+        for i in range(count)
+    ]
+
+
+class TestHyperLogLog:
+    def test_estimate_is_close(self):
+        hll = HyperLogLog()
+        for i in range(50000):
+            hll.add(f"value-{i}")
+        assert abs(hll.count() - 50000) / 50000 < 0.05
+
+    def test_merge(self):
+        left, right = HyperLogLog(), HyperLogLog()
+        for i in range(1000):
+            left.add(str(i))
+            right.add(str(i + 500))
+        left.merge(right)
+        assert abs(left.count() - 1500) < 75
+
+
+class TestTopK:
+    def test_exact_when_nothing_is_dropped(self):
+        top = TopK(2)
+        for value in "aabbbc":
+            top.add(value)
+        assert top.top() == [("b", 3), ("a", 2)]
+        assert not top.truncated
+
+    def test_memory_is_bounded(self):
+        top = TopK(3, capacity=32)
+        for i in range(10000):
+            top.add("common")
+            top.add(f"rare-{i}")
+        assert len(top.counts) <= 32
+        assert top.truncated
+        assert top.top(1) == [("common", 10000)]
+
+
+class TestColumnProfile:
+    @pytest.mark.parametrize(
+        "values, expected",
+        [
+            (["1", "2", "-3"], "integer"),
+            (["1", "2.5", "1e3"], "number"),
+            (["2021-01-01", "2020-12-31T10:00:00Z"], "date"),
+            (["yes", "No", "TRUE"], "boolean"),
+            (["1", "abc"], "string"),
+            ([1, 2.5], "number"),
+            ([], "string"),
+        ],
+    )
+    def test_type_inference(self, values, expected):
+        column = ColumnProfile("col")
+        for value in values:
+            column.add(value)
+        assert column.inferred_type() == expected
+
+    def test_high_cardinality_columns_are_approximate(self):
+        column = ColumnProfile("id", exact_limit=100)
+        for i in range(5000):
+            column.add(f"id-{i}")
+        assert not column.distinct_is_exact
+        assert not column.is_enumerable()
+        assert abs(column.distinct_count - 5000) < 250
+
+
+def test_profile_csv(tmp_path):
+    filename = write_csv(tmp_path / "demo.csv", demo_rows())
+    (profile,) = profile_csv(filename)
+    assert profile.name == "demo"
+    assert profile.rows == 300
+
+    columns = {name: column.as_dict() for name, column in profile.columns.items()}
+    assert columns["subject_id"]["type"] == "string"
+    assert columns["subject_id"]["distinct"] == 300
+    assert not columns["subject_id"]["enumerable"]
+    assert columns["sex"]["missing"] == 100
+    assert profile.columns["sex"].enumerations() == ["F", "M"]
+    assert columns["age"]["type"] == "integer"
+    assert (columns["age"]["min"], columns["age"]["max"]) == (20, 69)
+    assert columns["weight"]["type"] == "number"
+    assert columns["visit_date"]["type"] == "date"
+    assert columns["visit_date"]["max"] == "2021-01-28"
+    assert columns["smoker"]["type"] == "boolean"
+
+
+def test_profile_whistle_input(tmp_path):
+    filename = tmp_path / "whistle-input.json"
+    filename.write_text(
+        json.dumps(
+            {
+                "study": {"id": "STUDY"},
+                "code-systems": [{"url": "x"}],
+                "demo": [{"id": 1, "sex": "M"}, {"id": 2}],
+                "lab": [{"id": 1, "result": 1.5}],
+            }
+        )
+    )
+    profiles = profile_whistle_input(filename)
+    assert [profile.name for profile in profiles] == ["demo", "lab"]
+    assert profiles[0].columns["sex"].missing == 1
+    assert profiles[1].columns["result"].inferred_type() == "number"
+
+
+def test_parallel_matches_serial(tmp_path):
+    filenames = []
+    for table in ["a", "b", "c"]:
+        filenames.append(write_csv(tmp_path / f"{table}.csv", demo_rows(50)))
+    serial = [profile.as_dict() for profile in profile_files(filenames, workers=1)]
+    parallel = [profile.as_dict() for profile in profile_files(filenames, workers=3)]
+    assert serial == parallel
+    assert [profile["table"] for profile in parallel] == ["a", "b", "c"]
+
+
+def test_exec_writes_a_loadable_draft(tmp_path):
+    filename = write_csv(tmp_path / "demo.csv", demo_rows())
+    output = tmp_path / "draft"
+    exec([str(filename), "--output", str(output), "--json", str(tmp_path / "p.json")])
+
+    with open(output / "demo.csv", newline="") as f:
+        rows = {row["variable_name"]: row for row in csv.DictReader(f)}
+    assert rows["sex"]["enumerations"] == "F;M"
+    assert rows["age"]["data_type"] == "integer"
+    assert rows["age"]["min"] == "20"
+    assert json.loads((tmp_path / "p.json").read_text())[0]["rows"] == 300
+
+
+def test_unwritable_enumerations_are_left_out(tmp_path):
+    rows = [{"subject_id": f"p{i}", "dose": ["5mg", "5mg;10mg", "a=b"][i % 3]} for i in range(30)]
+    filename = write_csv(tmp_path / "meds.csv", rows)
+    output = tmp_path / "draft"
+    exec([str(filename), "--output", str(output)])
+
+    with open(output / "meds.csv", newline="") as f:
+        dose = {row["variable_name"]: row for row in csv.DictReader(f)}["dose"]
+    assert dose["enumerations"] == "5mg"
+    assert dose["notes"].endswith("2 values left out of the enumerations")
@@ -122,3 +122,10 @@ class TestSerialization:
         table.add_variable(variable_name="notes", data_type="string")
         codesystems = table.variables_as_cs()
         assert sorted(cs["varname"] for cs in codesystems) == ["notes", "sex"]
+
+    def test_variable_codes_are_updated_when_variables_are_added(self):
+        table = self._table_with_sex_variable()
+        assert len(table.obj_as_cs()["values"]) == 1
+        table.add_variable(variable_name="notes", data_type="string")
+        assert table.obj_as_cs()["values"] is table.obj_as_dd_variable()["values"]
+        assert [v["code"] for v in table.obj_as_cs()["values"]] == ["sex", "notes"]
@@ -1,6 +1,13 @@
+import io
+import json
+import pickle
+
 import pytest
 
+from wstlr import dd_system_url, system_base
 from wstlr.dd.variable import DdVariable
+from wstlr.harmony import ParseJSON
+from wstlr.sourcedata import DdVariable as SourceDdVariable
 
 
 def make_variable(**overrides):
@@ -124,3 +131,88 @@ class TestObjAsCs:
     def test_consent_group_is_omitted_when_absent(self):
         var = make_variable()
         assert "consent_group" not in var.obj_as_cs()
+
+
+class TestObjAsDdVariable:
+    def test_values_are_included_by_default(self):
+        var = make_variable(data_type="enumeration", enumerations="M=Male;F=Female")
+        obj = var.obj_as_dd_variable()
+        assert len(obj["values"]) == 2
+        assert obj["values-url"] == var.url
+
+    def test_compact_references_the_code_system_instead(self):
+        var = make_variable(data_type="enumeration", enumerations="M=Male;F=Female")
+        obj = var.obj_as_dd_variable(compact=True)
+        assert "values" not in obj
+        assert obj["values-count"] == 2
+        assert obj["values-url"] == var.obj_as_cs()["url"]
+        assert obj["values-details"] == {"table-name": "demographics", "varname": "sex"}
+
+    def test_compact_without_values(self):
+        obj = make_variable().obj_as_dd_variable(compact=True)
+        assert obj["values-count"] == 0
+        assert "values-url" not in obj
+
+    def test_compact_entries_are_still_enumerations_downstream(self):
+        var = make_variable(data_type="enumeration", enumerations="M=Male;F=Female")
+        compact = SourceDdVariable(var.obj_as_dd_variable(compact=True))
+        full = SourceDdVariable(var.obj_as_dd_variable())
+        assert compact.vartype == full.vartype == "enumeration"
+
+    def test_harmony_skeleton_finds_values_in_the_code_systems(self):
+        var = make_variable(data_type="enumeration", enumerations="M=Male;F=Female")
+
+        def skeleton(compact):
+            content = {
+                "study": {
+                    "data-dictionary": [
+                        {
+                            "table_name": "demographics",
+                            "variables": [var.obj_as_dd_variable(compact=compact)],
+                        }
+                    ]
+                },
+                "code-systems": [var.obj_as_cs()],
+            }
+            output = io.StringIO()
+            ParseJSON(io.StringIO(json.dumps(content)), output)
+            return output.getvalue()
+
+        assert "Female" in skeleton(True)
+        assert skeleton(True) == skeleton(False)
+
+
+class TestCompactRepresentation:
+    def test_url_matches_dd_system_url(self):
+        var = make_variable(variable_name="Age (Years)", consent_group="GRU")
+        assert var.url == dd_system_url(
+            system_base, "CodeSystem", "GRU", "demographics", "Age (Years)"
+        )
+
+    def test_values_are_built_once_and_shared(self):
+        var = make_variable(data_type="enumeration", enumerations="M=Male;F=Female")
+        assert var.obj_as_dd()["values"] is var.obj_as_cs()["values"]
+        assert var.obj_as_dd_variable()["values"] is var.values_for_json()
+
+    def test_variables_are_slotted(self):
+        var = make_variable()
+        assert not hasattr(var, "__dict__")
+        with pytest.raises(AttributeError):
+            var.something_else = 1
+
+    def test_survives_pickling(self):
+        var = make_variable(data_type="enumeration", enumerations="M=Male;F=Female")
+        var.values_for_json()
+        copy = pickle.loads(pickle.dumps(var))
+        assert copy.url == var.url
+        assert copy.enumerations == var.enumerations
+        assert copy.obj_as_cs() == var.obj_as_cs()
+
+    def test_survives_json_state(self):
+        var = make_variable(data_type="enumeration", enumerations="M=Male;F=Female")
+        var.values_for_json()
+        copy = DdVariable.from_state(json.loads(json.dumps(var.as_state())))
+        assert copy.url == var.url
+        assert copy.enumerations == var.enumerations
+        assert copy.obj_as_cs() == var.obj_as_cs()
+        assert copy.obj_as_dd_variable() == var.obj_as_dd_variable()
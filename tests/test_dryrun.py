@@ -0,0 +1,63 @@
+from wstlr.dryrun import MemoryIdCache, NullFhirClient, unresolved_references
+from wstlr.load import ResourceLoader
+
+prefix = "https://example.org/fhir"
+
+
+def patient(value):
+    return {
+        "resourceType": "Patient",
+        "identifier": [{"system": f"{prefix}/participant", "value": value}],
+    }
+
+
+def observation(value, subject):
+    return {
+        "resourceType": "Observation",
+        "identifier": [{"system": f"{prefix}/observation", "value": value}],
+        "subject": {"identifier": {"system": f"{prefix}/participant", "value": subject}},
+    }
+
+
+def dry_run_loader():
+    idcache = MemoryIdCache()
+    return ResourceLoader(prefix, NullFhirClient(), study_id="DRY", idcache=idcache)
+
+
+class TestDryRunLoad:
+    def test_references_resolve_to_synthetic_ids(self):
+        loader = dry_run_loader()
+        obs = observation("o1", "p1")
+
+        # The observation arrives first, so it has to wait on the patient
+        loader.consume_load("observation", obs)
+        assert len(loader.delayed_loading) == 1
+
+        loader.consume_load("patient", patient("p1"))
+        loader.retry_loading()
+
+        assert loader.delayed_loading == []
+        assert obs["subject"] == {"reference": "Patient/dry-patient-1"}
+        assert loader.studyids.ids["Patient"] == ["dry-patient-1"]
+        assert loader.studyids.ids["Observation"] == ["dry-observation-1"]
+        assert loader.resource_summary == {"Patient": 1, "Observation": 1}
+
+    def test_existing_ids_are_reused(self):
+        loader = dry_run_loader()
+        loader.consume_load("patient", patient("p1"))
+        loader.consume_load("patient", patient("p1"))
+
+        assert loader.studyids.ids["Patient"] == ["dry-patient-1", "dry-patient-1"]
+
+    def test_unresolved_references_are_reported(self):
+        loader = dry_run_loader()
+        loader.consume_load("patient", patient("p1"))
+        loader.consume_load("observation", observation("o1", "p1"))
+        loader.consume_load("observation", observation("o2", "missing"))
+        loader.consume_load("observation", observation("o3", "missing"))
+        loader.retry_loading()
+
+        problems = unresolved_references(loader.delayed_loading, loader.idcache)
+        assert problems == {
+            f"Observation: Unseen reference to subject=>{prefix}/participant:missing": 2
+        }
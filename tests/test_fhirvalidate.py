@@ -0,0 +1,188 @@
+import json
+import zipfile
+
+import pytest
+
+from wstlr.fhirvalidate import ProfileValidator, load_definitions, type_matches, validate_output
+
+profile_url = "https://example.org/StructureDefinition/study-patient"
+gender_vs = "https://example.org/ValueSet/gender"
+observation_url = "https://example.org/StructureDefinition/study-observation"
+
+
+def element(path, min=0, max="*", types=(), **extra):
+    return dict(
+        {"id": path, "path": path, "min": min, "max": max, "type": [{"code": x} for x in types]},
+        **extra,
+    )
+
+
+def definitions():
+    patient = {
+        "resourceType": "StructureDefinition",
+        "url": profile_url,
+        "name": "StudyPatient",
+        "kind": "resource",
+        "type": "Patient",
+        "snapshot": {
+            "element": [
+                element("Patient", max="*"),
+                element("Patient.identifier", min=1, types=["Identifier"]),
+                element("Patient.identifier.system", min=1, max="1", types=["uri"]),
+                element("Patient.identifier:official", min=1, max="1", types=["Identifier"]),
+                element(
+                    "Patient.gender",
+                    max="1",
+                    types=["code"],
+                    binding={"strength": "required", "valueSet": f"{gender_vs}|1.0"},
+                ),
+                element("Patient.birthDate", max="1", types=["date"]),
+                element("Patient.active", max="1", types=["boolean"], fixedBoolean=True),
+            ]
+        },
+    }
+    observation = {
+        "resourceType": "StructureDefinition",
+        "url": observation_url,
+        "name": "StudyObservation",
+        "kind": "resource",
+        "type": "Observation",
+        "snapshot": {
+            "element": [
+                element("Observation"),
+                element(
+                    "Observation.code",
+                    min=1,
+                    max="1",
+                    types=["CodeableConcept"],
+                    patternCodeableConcept={"coding": [{"system": "https://loinc.org"}]},
+                ),
+                element("Observation.value[x]", max="1", types=["Quantity", "integer"]),
+                element(
+                    "Observation.subject",
+                    max="1",
+                    type=[
+                        {
+                            "code": "Reference",
+                            "targetProfile": [profile_url],
+                        }
+                    ],
+                ),
+            ]
+        },
+    }
+    value_set = {
+        "resourceType": "ValueSet",
+        "url": gender_vs,
+        "compose": {"include": [{"system": "https://example.org/CodeSystem/gender"}]},
+    }
+    code_system = {
+        "resourceType": "CodeSystem",
+        "url": "https://example.org/CodeSystem/gender",
+        "content": "complete",
+        "concept": [{"code": "male"}, {"code": "female", "concept": [{"code": "female-ish"}]}],
+    }
+    return [patient, observation, value_set, code_system]
+
+
+def patient(**content):
+    return dict(
+        {
+            "resourceType": "Patient",
+            "meta": {"profile": [profile_url]},
+            "identifier": [{"system": "https://example.org/ids", "value": "1"}],
+        },
+        **content,
+    )
+
+
+def rules(validator, resource):
+    return sorted(rule for rule, _ in validator.check(resource)[1])
+
+
+def test_primitive_types():
+    assert type_matches("2020-02", "date")
+    assert not type_matches("2020-13-01", "date")
+    assert type_matches("2020-02-01T10:00:00Z", "dateTime")
+    assert not type_matches("2020-02-01T10:00", "dateTime")
+    assert not type_matches(True, "integer")
+    assert not type_matches(0, "positiveInt")
+    assert type_matches({"value": 1}, "Quantity")
+
+
+def test_valid_resource_has_no_problems():
+    validator = ProfileValidator(definitions())
+    assert validator.check(patient(gender="female-ish", birthDate="2001", active=True)) == (1, [])
+
+
+def test_problems_are_found():
+    validator = ProfileValidator(definitions())
+    resource = patient(gender="unknown", birthDate="01/02/2001", active=False)
+    resource["identifier"].append({"value": "2"})
+    assert rules(validator, resource) == [
+        "Patient.active fixed",
+        "Patient.birthDate type",
+        "Patient.gender binding",
+        "Patient.identifier.system cardinality",
+    ]
+
+    assert rules(validator, patient(identifier=[])) == ["Patient.identifier cardinality"]
+
+
+def test_choice_patterns_and_references():
+    validator = ProfileValidator(definitions())
+    observation = {
+        "resourceType": "Observation",
+        "meta": {"profile": [observation_url]},
+        "code": {"coding": [{"system": "https://loinc.org", "code": "1234-5"}]},
+        "valueInteger": 3,
+        "subject": {"reference": "Patient/123"},
+    }
+    assert validator.check(observation) == (1, [])
+
+    observation.update(
+        valueString="3",
+        code={"coding": [{"system": "https://snomed.info/sct", "code": "1"}]},
+        subject={"reference": "Group/1"},
+    )
+    assert rules(validator, observation) == [
+        "Observation.code pattern",
+        "Observation.subject reference",
+        "Observation.value[x] cardinality",
+        "Observation.value[x] type",
+    ]
+
+
+def test_resources_without_known_profiles_are_skipped():
+    validator = ProfileValidator(definitions())
+    unprofiled = patient()
+    del unprofiled["meta"]
+    assert validator.check(unprofiled) == (0, [])
+
+    validator = ProfileValidator(definitions(), {"Patient": profile_url})
+    assert validator.check(dict(unprofiled, identifier=[])) == (
+        1,
+        [("Patient.identifier cardinality", "Patient.identifier must appear 1..* times")],
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_validate_output(tmp_path, workers):
+    ig = tmp_path / "ig"
+    (ig / "output").mkdir(parents=True)
+    with zipfile.ZipFile(ig / "output" / "definitions.json.zip", "w") as z:
+        for index, resource in enumerate(definitions()):
+            z.writestr(f"{resource['resourceType']}-{index}.json", json.dumps(resource))
+    validator = ProfileValidator(load_definitions({"IG": {"source_type": "IG", "path": str(ig)}}))
+    assert sorted(validator.profiles) == sorted([profile_url, observation_url])
+
+    output = tmp_path / "output.json"
+    patients = [patient(gender="male") for _ in range(5)] + [patient(gender="other")]
+    output.write_text(json.dumps({"patient": patients, "group": [{"resourceType": "Group"}]}))
+
+    result = validate_output([str(output)], validator, workers=workers)
+    assert result.validated == {"Patient": 6}
+    assert result.unvalidated == {"Group": 1}
+    finding = result.report.findings[("patient", "Patient.gender binding")]
+    assert finding.count == 1
+    assert finding.samples == ["Patient https://example.org/ids:1"]
@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+from wstlr.fingerprints import (
+    BloomFilter,
+    FingerprintSet,
+    IdentifierSet,
+    TwoPassIdentifierSet,
+    fingerprint,
+)
+
+
+@pytest.mark.parametrize("bits", [64, 128])
+def test_fingerprint_set_behaves_like_a_set(bits):
+    rng = random.Random(bits)
+    values = [rng.getrandbits(bits) for _ in range(5000)] + [0]
+    fingerprints = FingerprintSet(capacity=16, bits=bits)
+    expected = set()
+    for value in values + values[:100]:
+        assert fingerprints.add(value) == (value in expected)
+        expected.add(value)
+
+    assert len(fingerprints) == len(expected)
+    assert all(x in fingerprints for x in values)
+    assert rng.getrandbits(bits) not in fingerprints
+    # Zero shares a slot with one
+    assert set(fingerprints) == {x or 1 for x in expected}
+
+
+def test_fingerprint_sets_merge():
+    first = FingerprintSet()
+    second = FingerprintSet()
+    for value in range(1, 100):
+        first.add(value)
+    for value in range(90, 200):
+        second.add(value)
+    assert sorted(first.update(second)) == list(range(90, 100))
+    assert len(first) == 199
+
+
+def test_memory_is_a_few_bytes_per_identifier():
+    identifiers = IdentifierSet()
+    for i in range(100000):
+        assert not identifiers.seen(f"Patient|https://example.org/ids:{i}")
+    assert identifiers.seen("Patient|https://example.org/ids:5")
+    assert identifiers.nbytes / len(identifiers) < 24
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(fingerprint(str(i)))
+    assert all(bloom.add(fingerprint(str(i))) for i in range(1000))
+    false_positives = sum(fingerprint(f"x{i}") in bloom for i in range(10000))
+    assert false_positives < 200
+
+
+def test_two_passes_find_exactly_the_duplicates():
+    keys = [f"Observation|sys:{i}" for i in range(2000)] + ["Observation|sys:7", "Observation|sys:1999"]
+    identifiers = TwoPassIdentifierSet(expected=2000)
+    assert not any(identifiers.seen(key) for key in keys)
+    assert identifiers.needs_second_pass
+
+    identifiers.start_second_pass()
+    assert [key for key in keys if identifiers.seen(key)] == ["Observation|sys:7", "Observation|sys:1999"]
@@ -0,0 +1,60 @@
+import pytest
+
+from wstlr.harmonystore import HarmonyStore
+
+harmony_csv = """Local Code,Text,Table_Name,Parent_Varname,Local Code System,Code,Display,Code System,Comment
+M,Male,demo,sex,sex,248153007,Male (finding),http://snomed.info/sct,
+F,Female,demo,sex,sex,248152002,Female (finding),http://snomed.info/sct,
+F,Female,demo,sex,sex,female,female,http://hl7.org/fhir/administrative-gender
+1,Yes,demo,smoker,smoker,,,,
+"""
+
+
+@pytest.fixture
+def harmony_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("WHISTLER_CACHE_DIR", str(tmp_path / "cache"))
+    filename = tmp_path / "harmony.csv"
+    filename.write_text(harmony_csv)
+    return filename
+
+
+class TestHarmonyStore:
+    def test_field_names_are_normalized(self, harmony_file):
+        harmony = HarmonyStore().get(harmony_file)
+
+        assert harmony.rows[0]["local code"] == "M"
+        # The short row is filled in rather than left with None
+        assert harmony.rows[2]["comment"] == ""
+
+    def test_code_details(self, harmony_file):
+        harmony = HarmonyStore().get(harmony_file)
+        assert harmony.code_details() == {"M": "Male (finding)", "F": "female", "1": ""}
+
+    def test_code_details_without_a_local_code_system(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("WHISTLER_CACHE_DIR", str(tmp_path / "cache"))
+        filename = tmp_path / "old-harmony.csv"
+        filename.write_text("Local Code,Display\nM,Male\nF,Female\n")
+        assert HarmonyStore().get(filename).code_details() == {"M": "Male", "F": "Female"}
+
+    def test_parsed_once_per_process(self, harmony_file):
+        store = HarmonyStore()
+        first = store.get(harmony_file)
+        assert store.get(harmony_file) is first
+        assert store.parse_count == 1
+
+    def test_disk_cache_is_reused(self, harmony_file, tmp_path):
+        HarmonyStore().get(harmony_file)
+        assert len(list((tmp_path / "cache" / "harmony").glob("*.json"))) == 1
+
+        store = HarmonyStore()
+        harmony = store.get(harmony_file)
+        assert store.parse_count == 0
+        assert harmony.rows == HarmonyStore(use_disk_cache=False).get(harmony_file).rows
+
+    def test_changes_are_picked_up(self, harmony_file):
+        store = HarmonyStore()
+        store.get(harmony_file)
+
+        harmony_file.write_text(harmony_csv + "U,Unknown,demo,sex,sex,,,,\n")
+        assert store.get(harmony_file).code_details()["U"] == ""
+        assert store.parse_count == 2
@@ -0,0 +1,159 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic, sleep
+
+import pytest
+import requests
+
+from wstlr.httpcache import HttpCache, OfflineCacheMiss
+
+
+class FileServer:
+    """Serves in-memory files with ETags, counting the requests made"""
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        self.not_modified = 0
+        self.status = None
+        self.delay = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                sleep(server.delay)
+                if server.status is not None:
+                    self.send_error(server.status)
+                    return
+                if self.path not in server.files:
+                    self.send_error(404)
+                    return
+                content = server.files[self.path]
+                etag = '"' + hashlib.md5(content).hexdigest() + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    server.not_modified += 1
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_port}{path}"
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    yield server
+    server.stop()
+
+
+class TestHttpCache:
+    def test_unchanged_files_are_revalidated(self, server, tmp_path):
+        server.files["/dd.json"] = b'{"name": "dd"}'
+        cache = HttpCache(tmp_path)
+
+        first = cache.get(server.url("/dd.json"))
+        second = cache.get(server.url("/dd.json"))
+
+        assert not first.from_cache
+        assert second.from_cache
+        assert second.json() == {"name": "dd"}
+        assert server.not_modified == 1
+
+    def test_changed_files_are_downloaded(self, server, tmp_path):
+        server.files["/dd.json"] = b'{"version": 1}'
+        cache = HttpCache(tmp_path)
+        first = cache.get(server.url("/dd.json"))
+
+        server.files["/dd.json"] = b'{"version": 2}'
+        second = cache.get(server.url("/dd.json"))
+        assert second.json() == {"version": 2}
+        assert second.digest != first.digest
+
+    def test_offline_mode(self, server, tmp_path):
+        server.files["/dd.json"] = b"[]"
+        HttpCache(tmp_path).get(server.url("/dd.json"))
+
+        offline = HttpCache(tmp_path, offline=True)
+        assert offline.get(server.url("/dd.json")).from_cache
+        assert len(server.requests) == 1
+
+        with pytest.raises(OfflineCacheMiss):
+            offline.get(server.url("/missing.json"))
+
+    def test_unreachable_server_uses_cached_copy(self, server, tmp_path):
+        server.files["/dd.json"] = b"[1]"
+        url = server.url("/dd.json")
+        cache = HttpCache(tmp_path)
+        cache.get(url)
+        server.stop()
+
+        assert cache.get(url).json() == [1]
+
+    def test_timeout_uses_cached_copy(self, server, tmp_path, monkeypatch):
+        server.files["/dd.json"] = b"[1]"
+        url = server.url("/dd.json")
+        cache = HttpCache(tmp_path)
+        cache.get(url)
+
+        def timeout(*args, **kwargs):
+            raise requests.Timeout("read timed out")
+
+        monkeypatch.setattr(requests, "get", timeout)
+        assert cache.get(url).json() == [1]
+
+    def test_server_errors_use_cached_copy(self, server, tmp_path):
+        server.files["/dd.json"] = b"[1]"
+        url = server.url("/dd.json")
+        cache = HttpCache(tmp_path)
+        cache.get(url)
+
+        server.status = 503
+        assert cache.get(url).json() == [1]
+
+        with pytest.raises(requests.HTTPError):
+            cache.get(server.url("/never-cached.json"))
+
+    def test_lock_is_not_held_while_downloading(self, server, tmp_path):
+        server.files["/slow"] = b"slow"
+        cache = HttpCache(tmp_path)
+
+        server.delay = 0.5
+        slow = Thread(target=cache.get, args=(server.url("/slow"),))
+        slow.start()
+        sleep(0.1)
+        started = monotonic()
+        with cache.lock:
+            waited = monotonic() - started
+        slow.join()
+        assert waited < 0.3
+
+    def test_least_recently_used_files_are_evicted(self, server, tmp_path):
+        for name in ["a", "b", "c"]:
+            server.files[f"/{name}"] = name.encode() * 100
+        cache = HttpCache(tmp_path, max_bytes=250)
+
+        cache.get(server.url("/a"))
+        cache.get(server.url("/b"))
+        cache.get(server.url("/c"))
+
+        assert len(list(tmp_path.glob("*.body"))) == 2
+        with pytest.raises(OfflineCacheMiss):
+            HttpCache(tmp_path, offline=True).get(server.url("/a"))
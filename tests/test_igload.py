@@ -0,0 +1,178 @@
+import json
+import zipfile
+from threading import Lock
+from types import SimpleNamespace
+from urllib.parse import unquote
+
+import pytest
+
+from wstlr.igload.ig_source import IgPackage
+from wstlr.igload.loader import IgLoader, content_hash, dependency_levels, order_resources
+
+
+class FakeClient:
+    """Keeps canonical resources by url, like a FHIR server would"""
+
+    def __init__(self, existing=None):
+        self.lock = Lock()
+        self.resources = {x["url"]: x for x in existing or []}
+        self.loaded = []
+        self.queries = []
+
+    def get(self, query, recurse=True, except_on_error=True):
+        self.queries.append(query)
+        url = unquote(query.split("url=")[1].split("&")[0])
+        entries = []
+        if url in self.resources:
+            entries.append({"resource": self.resources[url]})
+        return SimpleNamespace(entries=entries, response={})
+
+    def load(self, resource_type, resource, skip_insert_if_present=False):
+        with self.lock:
+            if skip_insert_if_present and resource["url"] in self.resources:
+                return {"status_code": 200, "response": self.resources[resource["url"]]}
+            self.loaded.append(resource["url"])
+            self.resources[resource["url"]] = dict(resource, id="server-id")
+        return {"status_code": 200, "response": resource}
+
+    def post(self, resource_type, resource):
+        return self.load(resource_type, dict(resource, url=resource["id"]))
+
+
+def resource(resource_type, name, **content):
+    return dict(
+        {"resourceType": resource_type, "id": name, "url": f"http://example.org/{name}"},
+        **content,
+    )
+
+
+ig = {
+    "ImplementationGuide-ig.json": resource("ImplementationGuide", "ig"),
+    "ValueSet-vs.json": resource("ValueSet", "vs"),
+    "Questionnaire-q.json": resource("Questionnaire", "q"),
+    "SearchParameter-sp.json": resource("SearchParameter", "sp"),
+    "CodeSystem-cs.json": resource("CodeSystem", "cs"),
+    "StructureDefinition-sd.json": resource("StructureDefinition", "sd"),
+}
+
+
+def test_resources_are_ordered_by_dependency():
+    tiers = order_resources(ig)
+    assert [[x[1]["id"] for x in tier] for tier in tiers] == [
+        ["cs", "sd"],
+        ["vs"],
+        ["sp"],
+        ["q"],
+        ["ig"],
+    ]
+
+
+def test_dependents_within_a_tier_wait_for_what_they_build_on():
+    profiles = {
+        "sd-extension.json": resource("StructureDefinition", "extension"),
+        "sd-patient.json": resource(
+            "StructureDefinition",
+            "patient",
+            baseDefinition="http://example.org/base|1.0",
+            differential={"element": [{"type": [{"code": "Extension", "profile": ["http://example.org/extension"]}]}]},
+        ),
+        "sd-base.json": resource("StructureDefinition", "base"),
+        "cs.json": resource("CodeSystem", "cs"),
+        "vs-all.json": resource("ValueSet", "all", compose={"include": [{"valueSet": ["http://example.org/some"]}]}),
+        "vs-some.json": resource("ValueSet", "some", compose={"include": [{"system": "http://example.org/cs"}]}),
+    }
+    types = {filename: x["resourceType"] for filename, x in profiles.items()}
+    tier = ["sd-extension.json", "sd-patient.json", "sd-base.json", "cs.json"]
+    assert dependency_levels(tier, types, profiles.get) == [
+        ["sd-extension.json", "sd-base.json", "cs.json"],
+        ["sd-patient.json"],
+    ]
+
+    client = FakeClient()
+    assert IgLoader(client, thread_count=4).load(profiles) == {"loaded": 6}
+    position = {url.split("/")[-1]: i for i, url in enumerate(client.loaded)}
+    assert max(position["extension"], position["base"]) < position["patient"]
+    assert position["some"] < position["all"]
+
+
+def test_content_hash_ignores_what_the_server_assigns():
+    local = resource("CodeSystem", "cs", status="active")
+    remote = dict(local, id="123", meta={"versionId": "4", "lastUpdated": "2024-01-01"})
+    assert content_hash(local) == content_hash(remote)
+    assert content_hash(local) != content_hash(dict(local, status="retired"))
+
+
+def test_loads_every_tier_before_the_next():
+    client = FakeClient()
+    results = IgLoader(client, thread_count=4).load(ig)
+
+    assert results == {"loaded": 6}
+    position = {url.split("/")[-1]: i for i, url in enumerate(client.loaded)}
+    assert max(position["cs"], position["sd"]) < position["vs"] < position["sp"]
+    assert position["sp"] < position["q"] < position["ig"]
+
+
+def test_unchanged_resources_are_skipped():
+    unchanged = resource("CodeSystem", "cs", status="active")
+    changed = resource("ValueSet", "vs", status="active")
+    client = FakeClient(
+        [
+            dict(unchanged, id="1", meta={"versionId": "1"}),
+            dict(changed, id="2", status="draft"),
+        ]
+    )
+    resources = {"cs.json": unchanged, "vs.json": changed}
+
+    # Anything already loaded is left alone by default
+    assert IgLoader(client).load(resources) == {"loaded": 2}
+    assert client.loaded == []
+
+    assert IgLoader(client, update_changed=True).load(resources) == {"unchanged": 1, "loaded": 1}
+    assert client.loaded == ["http://example.org/vs"]
+
+    # Unless we insist
+    client.loaded = []
+    assert IgLoader(client, force_overwrite=True).load(resources) == {"loaded": 2}
+
+
+@pytest.fixture
+def ig_path(tmp_path):
+    (tmp_path / "output").mkdir()
+    with zipfile.ZipFile(tmp_path / "output" / "definitions.json.zip", "w") as z:
+        for name, content in ig.items():
+            z.writestr(name, json.dumps(content))
+        # The resourceType needn't come first
+        padded = {"text": {"div": "x" * 4000}, "resourceType": "ValueSet", "id": "late"}
+        z.writestr("late.json", json.dumps(dict(padded, url="http://example.org/late")))
+        z.writestr("spec.internals", "{}")
+    return tmp_path
+
+
+def test_only_selected_entries_are_parsed(ig_path):
+    package = IgPackage({"path": str(ig_path)})
+    reads = []
+    read = package.read
+
+    def counted(filename):
+        reads.append(filename)
+        return read(filename)
+
+    package.read = counted
+    selected, skipped = package.select(["ValueSet"], lambda fn: "example" in fn)
+    assert selected == [("ValueSet-vs.json", "ValueSet"), ("late.json", "ValueSet")]
+    assert len(skipped) == 5
+    # Just the one whose resourceType we couldn't find by peeking
+    assert reads == ["late.json"]
+
+    client = FakeClient()
+    assert IgLoader(client).load_entries(selected, package.read) == {"loaded": 2}
+    assert sorted(client.loaded) == ["http://example.org/late", "http://example.org/vs"]
+    package.close()
+
+
+def test_server_copy_query_is_encoded():
+    client = FakeClient()
+    IgLoader(client).server_copy(
+        resource("CodeSystem", "cs", url="http://example.org/cs?a=1&b=2", version="1.0 beta")
+    )
+    assert client.queries == ["CodeSystem?url=http%3A%2F%2Fexample.org%2Fcs%3Fa%3D1%26b%3D2&version=1.0%20beta"]
@@ -0,0 +1,78 @@
+import csv
+import json
+
+import pytest
+
+from wstlr.inspection_report import InspectionReport
+from wstlr.inspector import ObservationInspector, ResourceInspector
+
+
+def patient(value, system="https://example.org/ids"):
+    return {
+        "resourceType": "Patient",
+        "meta": {"tag": [{"code": "STUDY"}]},
+        "identifier": [{"system": system, "value": value, "use": "official"}],
+    }
+
+
+def test_duplicate_identifiers_are_reported():
+    inspector = ResourceInspector(require_official=True)
+    inspector.check_identifier("patient", patient("1"))
+    inspector.check_identifier("patient", patient("2"))
+    # Same identifier, different type
+    inspector.check_identifier("group", dict(patient("1"), resourceType="Group"))
+
+    with pytest.raises(SystemExit):
+        inspector.check_identifier("patient", patient("1"))
+
+
+def test_collect_all_reports_every_problem(tmp_path):
+    report = InspectionReport(max_samples=2)
+    resources = ResourceInspector(require_official=True, report=report)
+    observations = ObservationInspector(report=report)
+
+    def inspect(module, resource):
+        resources.check_identifier(module, resource)
+        observations.inspect(module, resource)
+
+    for value in ["1", "2", "1", "1"]:
+        inspect("patient", patient(value))
+    untagged = patient("3")
+    del untagged["meta"]
+    inspect("patient", untagged)
+    unofficial = patient("4")
+    del unofficial["identifier"][0]["use"]
+    inspect("patient", unofficial)
+    inspect("observation", {"resourceType": "Observation", "meta": {"tag": []}})
+
+    counts = {key: x.count for key, x in report.findings.items()}
+    assert counts == {
+        ("patient", "duplicate-identifier"): 2,
+        ("patient", "missing-meta-tag"): 1,
+        ("patient", "not-official"): 1,
+        ("observation", "missing-identifier"): 1,
+        ("observation", "missing-code"): 1,
+    }
+    assert len(report) == 6
+    assert report.findings[("patient", "duplicate-identifier")].samples == [
+        "Patient https://example.org/ids:1",
+        "Patient https://example.org/ids:1",
+    ]
+
+    report.save(str(tmp_path / "report.json"))
+    saved = json.loads((tmp_path / "report.json").read_text())
+    assert saved["problems"] == 6
+    assert list(saved["modules"]["patient"]) == [
+        "duplicate-identifier",
+        "missing-meta-tag",
+        "not-official",
+    ]
+
+    report.save(str(tmp_path / "report.csv"))
+    with open(tmp_path / "report.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [(x["module"], x["rule"], x["count"]) for x in rows][0] == (
+        "observation",
+        "missing-identifier",
+        "1",
+    )
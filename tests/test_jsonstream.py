@@ -0,0 +1,53 @@
+import io
+import json
+
+import pytest
+
+from wstlr.jsonstream import ArrayStream, JsonStreamError, iter_members
+
+whistle_input = {
+    "study": {"id": "STUDY", "data-dictionary": [{"table_name": "demo", "variables": []}]},
+    "code-systems": [],
+    "demo": [{"id": f"p{i}", "age": i, "weight": i * 1.5} for i in range(200)],
+    "count": 12345,
+    "empty": [],
+}
+
+
+def read_all(text, chunk_size=1 << 20):
+    content = {}
+    for key, value in iter_members(io.StringIO(text), chunk_size=chunk_size):
+        content[key] = list(value) if isinstance(value, ArrayStream) else value
+    return content
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_matches_json_load_for_any_chunk_size(chunk_size):
+    text = json.dumps(whistle_input, indent=2)
+    assert read_all(text, chunk_size) == whistle_input
+
+
+def test_arrays_are_streamed():
+    members = iter_members(io.StringIO(json.dumps(whistle_input)))
+    key, value = next(members)
+    assert key == "study"
+    assert isinstance(value, dict)
+    next(members)
+    key, rows = next(members)
+    assert key == "demo"
+    assert isinstance(rows, ArrayStream)
+    assert next(rows) == {"id": "p0", "age": 0, "weight": 0.0}
+
+
+def test_unread_arrays_are_skipped():
+    keys = [key for key, value in iter_members(io.StringIO(json.dumps(whistle_input)), 16)]
+    assert keys == ["study", "code-systems", "demo", "count", "empty"]
+
+
+def test_byte_order_mark_and_empty_object():
+    assert read_all("\ufeff{}") == {}
+
+
+def test_truncated_document():
+    with pytest.raises(JsonStreamError):
+        read_all(json.dumps(whistle_input)[:-40])
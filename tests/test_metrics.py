@@ -0,0 +1,68 @@
+from urllib.request import urlopen
+
+from wstlr.metrics import Counter, Gauge, Histogram, RunMetrics
+
+
+class TestRendering:
+    def test_counter_renders_total_with_labels(self):
+        counter = Counter("whistler_resources", "Resources", ("operation", "resource_type"))
+        counter.inc("load", "Patient")
+        counter.inc("load", "Patient")
+
+        lines = counter.render()
+        assert "# TYPE whistler_resources counter" in lines
+        assert 'whistler_resources_total{operation="load",resource_type="Patient"} 2.0' in lines
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("latency", "Latency", ("operation",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "load")
+        histogram.observe(0.5, "load")
+        histogram.observe(5.0, "load")
+
+        lines = histogram.render()
+        assert 'latency_bucket{operation="load",le="0.1"} 1' in lines
+        assert 'latency_bucket{operation="load",le="1.0"} 2' in lines
+        assert 'latency_bucket{operation="load",le="+Inf"} 3' in lines
+        assert 'latency_count{operation="load"} 3' in lines
+
+    def test_gauge_tracks_increments_and_decrements(self):
+        gauge = Gauge("queue", "Queue depth", ("operation",))
+        gauge.inc("load")
+        gauge.inc("load")
+        gauge.dec("load")
+
+        assert 'queue{operation="load"} 1' in gauge.render()
+
+
+class TestRunMetrics:
+    def test_responses_are_classified(self):
+        metrics = RunMetrics()
+        metrics.observe_response("load", "Patient", 201, 0.1)
+        metrics.observe_response("load", "Patient", 429, 0.1)
+        metrics.observe_response("load", "Patient", 503, 0.1)
+
+        assert metrics.resources.snapshot() == {("load", "Patient"): 1}
+        assert metrics.throttled.snapshot() == {("load", "Patient"): 1}
+        assert metrics.server_errors.snapshot() == {("load", "Patient"): 1}
+        assert metrics.render().endswith("# EOF\n")
+
+    def test_textfile_is_written_on_stop(self, tmp_path):
+        metrics = RunMetrics()
+        metrics.write_textfile_periodically(tmp_path / "whistler.prom", interval=60)
+        metrics.observe_response("delete", "Observation", 200, 0.2)
+        metrics.stop()
+
+        content = (tmp_path / "whistler.prom").read_text()
+        assert 'whistler_resources_total{operation="delete",resource_type="Observation"} 1.0' in content
+
+    def test_http_endpoint_serves_metrics(self):
+        metrics = RunMetrics()
+        metrics.serve(0)
+        try:
+            port = metrics.server.server_port
+            with urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                body = response.read().decode()
+        finally:
+            metrics.stop()
+
+        assert "# TYPE whistler_request_seconds histogram" in body
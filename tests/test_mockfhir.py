@@ -0,0 +1,125 @@
+import json
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from wstlr.bench.mockfhir import MockFhirServer, find_references
+
+
+def request(url, method="GET", body=None):
+    data = None if body is None else json.dumps(body).encode()
+    req = Request(url, data=data, method=method, headers={"Content-Type": "application/fhir+json"})
+    try:
+        with urlopen(req) as response:
+            return response.status, json.load(response)
+    except HTTPError as e:
+        return e.code, json.load(e)
+
+
+def patient(value, study="STUDY"):
+    return {
+        "resourceType": "Patient",
+        "meta": {"tag": [{"code": study}]},
+        "identifier": [{"system": "https://example.org/patient", "value": value}],
+    }
+
+
+@pytest.fixture
+def server():
+    mock = MockFhirServer(page_size=2, seed=1)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+class TestMockFhirServer:
+    def test_create_and_search_by_identifier(self, server):
+        status, created = request(f"{server.base_url}/Patient", "POST", patient("p1"))
+        assert status == 201
+
+        status, bundle = request(
+            f"{server.base_url}/Patient?identifier=https://example.org/patient|p1"
+        )
+        assert bundle["total"] == 1
+        assert bundle["entry"][0]["resource"]["id"] == created["id"]
+
+    def test_put_replaces_existing(self, server):
+        assert request(f"{server.base_url}/Patient/abc", "PUT", patient("p1"))[0] == 201
+        status, updated = request(f"{server.base_url}/Patient/abc", "PUT", patient("p1"))
+        assert status == 200
+        assert updated["meta"]["versionId"] == "2"
+        assert server.resource_count("Patient") == 1
+
+    def test_tag_search_pages_with_next_links(self, server):
+        for i in range(5):
+            request(f"{server.base_url}/Patient", "POST", patient(f"p{i}"))
+        request(f"{server.base_url}/Patient", "POST", patient("other", study="OTHER"))
+
+        ids = []
+        url = f"{server.base_url}/Patient?_tag=STUDY&_elements=id"
+        while url is not None:
+            status, bundle = request(url)
+            ids += [entry["resource"]["id"] for entry in bundle["entry"]]
+            url = next((x["url"] for x in bundle["link"] if x["relation"] == "next"), None)
+        assert len(ids) == 5
+
+        status, count = request(f"{server.base_url}/Patient?_tag=STUDY&_summary=count")
+        assert count["total"] == 5
+        assert "entry" not in count
+
+    def test_delete_of_referenced_resource_conflicts(self, server):
+        status, subject = request(f"{server.base_url}/Patient", "POST", patient("p1"))
+        status, obs = request(
+            f"{server.base_url}/Observation",
+            "POST",
+            {"resourceType": "Observation", "subject": {"reference": f"Patient/{subject['id']}"}},
+        )
+
+        status, outcome = request(f"{server.base_url}/Patient/{subject['id']}", "DELETE")
+        assert status == 409
+        assert f"Observation/{obs['id']}" in outcome["issue"][0]["diagnostics"]
+
+        assert request(f"{server.base_url}/Observation/{obs['id']}", "DELETE")[0] == 200
+        assert request(f"{server.base_url}/Patient/{subject['id']}", "DELETE")[0] == 200
+        assert server.resource_count() == 0
+
+    def test_batch_bundle(self, server):
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [
+                {"resource": patient("p1"), "request": {"method": "PUT", "url": "Patient/a"}},
+                {"resource": patient("p2"), "request": {"method": "POST", "url": "Patient"}},
+                {"request": {"method": "DELETE", "url": "Patient/a"}},
+            ],
+        }
+        status, response = request(server.base_url, "POST", bundle)
+        assert response["type"] == "batch-response"
+        assert [x["response"]["status"] for x in response["entry"]] == ["201", "201", "200"]
+        assert server.resource_count("Patient") == 1
+
+    def test_conditional_delete(self, server):
+        for i in range(3):
+            request(f"{server.base_url}/Patient", "POST", patient(f"p{i}"))
+        status, metadata = request(f"{server.base_url}/metadata")
+        assert metadata["rest"][0]["resource"][0]["conditionalDelete"] == "multiple"
+
+        assert request(f"{server.base_url}/Patient?_tag=STUDY", "DELETE")[0] == 200
+        assert server.resource_count() == 0
+
+    def test_throttling_is_injected(self):
+        mock = MockFhirServer(throttle_rate=1.0)
+        mock.start()
+        try:
+            assert request(f"{mock.base_url}/Patient")[0] == 429
+        finally:
+            mock.stop()
+
+
+def test_find_references():
+    resource = {
+        "subject": {"reference": "Patient/1"},
+        "focus": [{"reference": "Specimen/2"}, {"reference": "#contained"}],
+    }
+    assert find_references(resource, set()) == {("Patient", "1"), ("Specimen", "2")}
@@ -1,3 +1,5 @@
+import pickle
+
 from wstlr.module_summary import ModuleSummary
 
 
@@ -26,3 +28,15 @@ class TestSummary:
         summary = ModuleSummary()
         assert dict(summary.resource_summary) == {}
         assert dict(summary.module_summary) == {}
+
+    def test_merged_summaries_add_up(self):
+        first = ModuleSummary()
+        first.summary("patients", {"resourceType": "Patient"})
+        second = pickle.loads(pickle.dumps(ModuleSummary()))
+        second.summary("patients", {"resourceType": "Patient"})
+        second.summary("observations", {"resourceType": "Observation"})
+
+        first.merge(second)
+        assert first.module_summary["patients"]["Patient"] == 2
+        assert first.module_summary["observations"]["Observation"] == 1
+        assert first.resource_summary["Patient"] == 2
@@ -0,0 +1,75 @@
+import json
+
+from wstlr.inspection_report import InspectionReport
+from wstlr.inspector import ObservationInspector, ResourceInspector
+from wstlr.module_summary import ModuleSummary
+from wstlr.parallel_inspection import inspect_parallel, iter_share
+
+
+def resource(resource_type, value, **extra):
+    return dict(
+        {
+            "resourceType": resource_type,
+            "meta": {"tag": [{"code": "STUDY"}]},
+            "identifier": [{"system": "https://example.org/ids", "value": value, "use": "official"}],
+        },
+        **extra,
+    )
+
+
+def write_output(path):
+    patients = [resource("Patient", str(i)) for i in range(25)]
+    # One duplicate in the same batch, one several batches later
+    patients.append(resource("Patient", "0"))
+    patients.insert(3, resource("Patient", "20"))
+    observations = [resource("Observation", f"o{i}", code={}) for i in range(17)]
+    observations[5].pop("code")
+    observations.append(resource("Observation", "o1", code={}))
+    path.write_text(json.dumps({"patient": patients, "observation": observations}))
+    return str(path)
+
+
+def serial_inspection(filename):
+    report = InspectionReport()
+    summary = ModuleSummary()
+    resources = ResourceInspector(require_official=True, report=report)
+    observations = ObservationInspector(report=report)
+    with open(filename) as f:
+        for module, items in json.load(f).items():
+            for item in items:
+                resources.check_identifier(module, item)
+                observations.inspect(module, item)
+                summary.summary(module, item)
+    return summary, report
+
+
+def counts(report):
+    return {key: x.count for key, x in report.findings.items()}
+
+
+def test_shares_cover_every_resource_once(tmp_path):
+    filename = write_output(tmp_path / "output.json")
+    seen = []
+    for worker in range(3):
+        shared = iter_share([filename], worker, 3, batch_size=4)
+        seen += [(module, x["identifier"][0]["value"]) for module, x in shared]
+    assert len(seen) == 27 + 18
+    assert sorted(set(seen)) == sorted(
+        [("patient", str(i)) for i in range(25)] + [("observation", f"o{i}") for i in range(17)]
+    )
+
+
+def test_parallel_matches_serial(tmp_path):
+    filename = write_output(tmp_path / "output.json")
+    expected_summary, expected = serial_inspection(filename)
+
+    summary, report = inspect_parallel([filename], True, workers=3, batch_size=4)
+    assert counts(report) == counts(expected)
+    assert counts(report) == {
+        ("patient", "duplicate-identifier"): 2,
+        ("observation", "duplicate-identifier"): 1,
+        ("observation", "missing-code"): 1,
+    }
+    assert len(report.findings[("patient", "duplicate-identifier")].samples) == 2
+    assert summary.module_summary == expected_summary.module_summary
+    assert summary.resource_summary == expected_summary.resource_summary
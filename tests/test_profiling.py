@@ -0,0 +1,65 @@
+import pstats
+
+from wstlr.profiling import CallTimings, Profiler
+
+
+class TestCallTimings:
+    def test_accumulates_calls_per_resource_type_and_step(self):
+        timings = CallTimings()
+        timings.record("Patient", "client.post", 0.5)
+        timings.record("Patient", "client.post", 1.5)
+        timings.record("Observation", "build_references", 0.25)
+
+        summary = timings.as_dict()
+        assert summary["Patient"]["client.post"]["calls"] == 2
+        assert summary["Patient"]["client.post"]["total_seconds"] == 2.0
+        assert summary["Patient"]["client.post"]["max_ms"] == 1500.0
+        assert summary["Observation"]["build_references"]["mean_ms"] == 250.0
+
+    def test_time_context_manager_records_a_call(self):
+        timings = CallTimings()
+        with timings.time("Patient", "serialize"):
+            pass
+
+        assert timings.as_dict()["Patient"]["serialize"]["calls"] == 1
+
+
+class TestProfiler:
+    def test_disabled_profiler_writes_nothing(self, tmp_path):
+        profiler = Profiler(None)
+        with profiler.stage("extract"):
+            pass
+
+        assert not profiler.enabled
+        assert profiler.timings is None
+
+    def test_each_stage_gets_its_own_pstats_file(self, tmp_path):
+        profiler = Profiler(tmp_path / "profile")
+        with profiler.stage("extract"):
+            sum(range(100))
+        with profiler.stage("extract"):
+            sum(range(100))
+
+        files = sorted(p.name for p in (tmp_path / "profile").iterdir())
+        assert files == ["extract-01.pstats", "extract-02.pstats"]
+        pstats.Stats(str(tmp_path / "profile" / "extract-01.pstats"))
+
+    def test_dotted_stage_names_keep_their_counter(self, tmp_path):
+        profiler = Profiler(tmp_path / "profile")
+        for name in ["inspect-study.output", "inspect-study.output", "inspect-other.output"]:
+            with profiler.stage(name):
+                sum(range(100))
+
+        files = sorted(p.name for p in (tmp_path / "profile").iterdir())
+        assert files == [
+            "inspect-other.output-01.pstats",
+            "inspect-study.output-01.pstats",
+            "inspect-study.output-02.pstats",
+        ]
+
+    def test_finish_writes_loader_timings(self, tmp_path):
+        profiler = Profiler(tmp_path)
+        profiler.timings.record("Patient", "client.post", 0.1)
+        profiler.finish()
+
+        assert (tmp_path / "call-timings.json").exists()
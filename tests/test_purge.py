@@ -0,0 +1,390 @@
+import json
+from types import SimpleNamespace
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+import wstlr.purge
+from wstlr.bench.mockfhir import MockFhirServer
+from wstlr.purge import ResourceDeleter, next_link
+from wstlr.studyids import StudyIDsDB
+
+
+class MockClient:
+    """Just enough of FhirClient to run the purge against MockFhirServer"""
+
+    def __init__(self, server):
+        self.target_service_url = server.base_url
+        self.requests = []
+
+    def send(self, method, url, body=None):
+        if not url.startswith("http"):
+            url = f"{self.target_service_url}/{url}"
+        self.requests.append((method, url))
+        data = None if body is None else json.dumps(body).encode()
+        request = Request(
+            url, data=data, method=method, headers={"Content-Type": "application/fhir+json"}
+        )
+        try:
+            with urlopen(request) as response:
+                return {"status_code": response.status, "response": json.load(response)}
+        except HTTPError as e:
+            return {"status_code": e.code, "response": json.load(e)}
+
+    def get(self, url, recurse=True, except_on_error=True):
+        result = self.send("GET", url)
+        return SimpleNamespace(
+            response=result["response"], entries=result["response"].get("entry", [])
+        )
+
+    def delete_by_record_id(self, resource_type, id, silence_warnings=False):
+        return self.send("DELETE", f"{resource_type}/{id}")
+
+    def post(self, resource_type, resource):
+        return self.send("POST", resource_type, resource)
+
+    def count(self, method, fragment=""):
+        return len([x for x in self.requests if x[0] == method and fragment in x[1]])
+
+
+def observation(index, patient_id, study="STUDY"):
+    return {
+        "resourceType": "Observation",
+        "meta": {"tag": [{"code": study}]},
+        "status": "final",
+        "code": {"text": f"obs {index}"},
+        "subject": {"reference": f"Patient/{patient_id}"},
+    }
+
+
+def patient(index, study="STUDY"):
+    return {"resourceType": "Patient", "meta": {"tag": [{"code": study}]}, "gender": "unknown"}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(
+        wstlr.purge,
+        "default_resources",
+        lambda client, ignore_resources=None: [
+            x for x in ["Patient", "Observation"] if x not in (ignore_resources or [])
+        ],
+    )
+    mock = MockFhirServer(page_size=10, max_page_size=25)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+def populate(server, patients=20, observations=3, study="STUDY"):
+    client = MockClient(server)
+    for i in range(patients):
+        created = client.send("POST", "Patient", patient(i, study))["response"]
+        for j in range(observations):
+            client.send("POST", "Observation", observation(j, created["id"], study))
+
+
+def test_next_link():
+    assert next_link({"link": [{"relation": "self", "url": "a"}]}) is None
+    assert next_link({"link": [{"relation": "next", "url": "b"}]}) == "b"
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+def test_purge_by_tag_follows_pages_until_nothing_is_left(server, threaded):
+    populate(server)
+    populate(server, patients=2, study="OTHER")
+
+    deleter = ResourceDeleter(MockClient(server), threaded=threaded, thread_count=4)
+    deleter.page_size = 25
+    deleter.conditional_delete = False
+    deleter.delete_resources_by_tag("STUDY")
+    deleter.cleanup_threads()
+
+    # Far more than a single page of each
+    assert deleter.deleted == {"Observation": 60, "Patient": 20}
+    assert server.resource_count() == 8
+
+
+def test_purge_by_tag_keeps_going_until_the_count_is_zero(server, capsys):
+    populate(server, patients=12, observations=0)
+    client = MockClient(server)
+    deleter = ResourceDeleter(client)
+    deleter.page_size = 5
+    deleter.conditional_delete = False
+    fetch_tag_page = deleter.fetch_tag_page
+    searches = []
+
+    def stale_first_search(url):
+        # The first search stops after a single page, much like a server
+        # handing back cached results would
+        ids, total, next_url = fetch_tag_page(url)
+        searches.append(url)
+        return ids, total, next_url if len(searches) > 1 else None
+
+    deleter.fetch_tag_page = stale_first_search
+    deleter.delete_resources_by_tag("STUDY", resource_list=["Patient"])
+
+    assert server.resource_count() == 0
+    assert deleter.deleted["Patient"] == 12
+    assert client.count("GET", "_summary=count") > 1
+    assert "remain" not in capsys.readouterr().out
+
+
+def test_purge_by_tag_reports_what_is_left(server, capsys):
+    populate(server, patients=3, observations=1)
+    deleter = ResourceDeleter(MockClient(server))
+    deleter.conditional_delete = False
+    deleter.delete_resources_by_tag("STUDY", resource_list=["Patient"])
+
+    assert "3 Patient resources tagged with STUDY remain" in capsys.readouterr().out
+
+
+def test_tag_pages_that_are_not_json_end_the_search(server):
+    client = MockClient(server)
+    client.get = lambda url, recurse=True, except_on_error=True: SimpleNamespace(
+        response="<html>Bad Gateway</html>", entries=[]
+    )
+    deleter = ResourceDeleter(client)
+    assert deleter.fetch_tag_page("Patient?_tag=STUDY") == ([], None, None)
+
+
+def test_conflicts_do_not_loop_forever(server):
+    populate(server, patients=3, observations=1)
+    # Only delete the patients, leaving their observations behind
+    deleter = ResourceDeleter(MockClient(server))
+    deleter.delete_resources_by_tag("STUDY", resource_list=["Patient"])
+
+    assert deleter.deleted["Patient"] == 0
+    assert len(deleter.delayed_deletes["Patient"]) == 3
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+def test_deletes_are_sent_in_batches(server, threaded):
+    populate(server)
+    client = MockClient(server)
+    deleter = ResourceDeleter(client, threaded=threaded, thread_count=4)
+    deleter.page_size = 25
+    deleter.batch_size = 10
+    deleter.conditional_delete = False
+    deleter.delete_resources_by_tag("STUDY")
+    deleter.cleanup_threads()
+
+    assert deleter.deleted == {"Observation": 60, "Patient": 20}
+    assert server.resource_count() == 0
+    assert client.count("DELETE") == 0
+    # Pages don't always split evenly into batches, but it's far fewer
+    # requests than the 80 it would take otherwise
+    assert client.count("POST") <= 12
+
+
+def test_batch_conflicts_are_delayed(server):
+    populate(server, patients=3, observations=1)
+    deleter = ResourceDeleter(MockClient(server))
+    deleter.batch_size = 10
+    deleter.conditional_delete = False
+    deleter.delete_resources_by_tag("STUDY", resource_list=["Patient"])
+    assert len(deleter.delayed_deletes["Patient"]) == 3
+
+
+def test_falls_back_to_individual_deletes_without_batch_support(server):
+    populate(server, patients=3, observations=0)
+    client = MockClient(server)
+    client.post = lambda resource_type, resource: {"status_code": 400, "response": {}}
+    deleter = ResourceDeleter(client)
+    deleter.batch_size = 10
+    deleter.conditional_delete = False
+    deleter.delete_resources_by_tag("STUDY")
+
+    assert deleter.deleted["Patient"] == 3
+    assert client.count("DELETE") == 3
+
+
+def test_conditional_delete_when_advertised(server):
+    populate(server)
+    populate(server, patients=1, study="OTHER")
+    client = MockClient(server)
+    deleter = ResourceDeleter(client)
+    deleter.delete_resources_by_tag("STUDY")
+
+    assert deleter.deleted == {"Observation": 60, "Patient": 20}
+    assert server.resource_count() == 4
+    # One conditional delete per resource type and nothing individually
+    assert client.count("POST") == 2
+    assert client.count("DELETE") == 0
+
+
+def test_no_conditional_delete_unless_advertised(monkeypatch):
+    monkeypatch.setattr(
+        wstlr.purge, "default_resources", lambda client, ignore_resources=None: []
+    )
+    mock = MockFhirServer(conditional_delete=False)
+    mock.start()
+    try:
+        populate(mock, patients=2, observations=0)
+        client = MockClient(mock)
+        deleter = ResourceDeleter(client)
+        assert not deleter.supports_conditional_delete("Patient")
+        deleter.delete_resources_by_tag("STUDY", resource_list=["Patient"])
+        assert deleter.deleted["Patient"] == 2
+        assert client.count("POST") == 0
+    finally:
+        mock.stop()
+
+
+def test_purge_in_reference_graph_order(server):
+    populate(server, patients=5, observations=2)
+    client = MockClient(server)
+    deleter = ResourceDeleter(client, threaded=True, thread_count=4)
+    deleter.batch_size = 1
+    deleter.conditional_delete = False
+    graph = deleter.build_reference_graph("STUDY", by_tag=True, scan=True)
+    assert len(graph) == 15
+    assert len(graph.levels()) == 2
+    assert deleter.type_order == ["Observation", "Patient"]
+
+    deleter.delete_by_reference_graph()
+    deleter.cleanup_threads()
+
+    assert deleter.deleted == {"Observation": 10, "Patient": 5}
+    assert server.resource_count() == 0
+    assert len(deleter.delayed_deletes) == 0
+
+
+def record_study_ids(server, client, tmp_path, suffix):
+    """Write the STUDY resources' IDs to a StudyIDs file of the given kind"""
+    ids = {}
+    for resource_type in ["Patient", "Observation"]:
+        bundle = client.send("GET", f"{resource_type}?_tag=STUDY&_count=25")["response"]
+        ids[resource_type] = [x["resource"]["id"] for x in bundle["entry"]]
+    study_ids = tmp_path / f"study-ids{suffix}"
+    if suffix == ".json":
+        study_ids.write_text(json.dumps({"STUDY": {server.base_url: ids}}))
+    else:
+        db = StudyIDsDB(server.base_url, "STUDY", filename=study_ids)
+        for resource_type, resource_ids in ids.items():
+            for id in resource_ids:
+                db.add_id(resource_type, id)
+        db.close()
+    return study_ids
+
+
+@pytest.mark.parametrize("suffix", [".json", ".sqlite"])
+def test_reference_graph_from_study_ids(server, tmp_path, suffix):
+    populate(server, patients=3, observations=1)
+    populate(server, patients=2, observations=1, study="OTHER")
+    client = MockClient(server)
+    study_ids = record_study_ids(server, client, tmp_path, suffix)
+
+    deleter = ResourceDeleter(client)
+    deleter.batch_size = 1
+    deleter.load_studyids(study_ids)
+    graph = deleter.build_reference_graph("STUDY", scan=True)
+    assert len(graph) == 6
+    deleter.delete_by_reference_graph()
+
+    assert deleter.deleted == {"Observation": 3, "Patient": 3}
+    assert server.resource_count() == 4
+
+
+@pytest.mark.parametrize("suffix", [".json", ".sqlite"])
+def test_purge_by_study_ids_streams_the_ids(server, tmp_path, monkeypatch, suffix):
+    populate(server, patients=3, observations=1)
+    populate(server, patients=2, observations=1, study="OTHER")
+    client = MockClient(server)
+    study_ids = record_study_ids(server, client, tmp_path, suffix)
+
+    deleter = ResourceDeleter(client)
+    deleter.load_studyids(study_ids)
+    monkeypatch.setattr(deleter.studyids, "get_ids", None)
+    deleter.delete_resources("STUDY")
+
+    assert deleter.deleted == {"Observation": 3, "Patient": 3}
+    assert server.resource_count() == 4
+
+
+def test_reference_scan_is_opt_in_and_only_fetches_references(server):
+    populate(server, patients=2, observations=1)
+    client = MockClient(server)
+    deleter = ResourceDeleter(client)
+    assert deleter.build_reference_graph("STUDY", by_tag=True) is None
+    assert client.count("GET") == 0
+
+    # Types the server can delete by tag in one go are left to that
+    assert len(deleter.build_reference_graph("STUDY", by_tag=True, scan=True)) == 0
+
+    deleter.conditional_delete = False
+    assert len(deleter.build_reference_graph("STUDY", by_tag=True, scan=True)) == 4
+    scans = [url for method, url in client.requests if "_tag=STUDY" in url]
+    assert len(scans) > 0
+    assert all("_elements=" in url for url in scans)
+
+
+def test_conflicts_with_resources_in_the_graph_are_resolved(server):
+    populate(server, patients=2, observations=2)
+    client = MockClient(server)
+    deleter = ResourceDeleter(client)
+    deleter.batch_size = 1
+    deleter.conditional_delete = False
+    graph = deleter.build_reference_graph("STUDY", by_tag=True, scan=True)
+
+    # Deleting the patients first has to clear their observations out of
+    # the way without waiting for retry_purge
+    for resource, id in sorted(graph.nodes, key=lambda x: x[0] != "Patient"):
+        deleter.delete_resource(resource, id)
+
+    assert deleter.deleted == {"Observation": 4, "Patient": 2}
+    assert len(deleter.delayed_deletes) == 0
+    assert server.resource_count() == 0
+
+
+def test_conflicts_with_resources_outside_the_graph_are_delayed(server):
+    populate(server, patients=2, observations=1)
+    client = MockClient(server)
+    deleter = ResourceDeleter(client)
+    deleter.batch_size = 1
+    deleter.conditional_delete = False
+    deleter.build_reference_graph("STUDY", resource_list=["Patient"], by_tag=True, scan=True)
+    deleter.delete_by_reference_graph()
+
+    assert deleter.deleted["Patient"] == 0
+    assert len(deleter.delayed_deletes["Patient"]) == 2
+    assert server.resource_count("Observation") == 2
+
+
+def test_verify_counts_in_parallel_without_fetching_results(server):
+    populate(server, patients=3, observations=2)
+    client = MockClient(server)
+    deleter = ResourceDeleter(client, thread_count=4)
+
+    assert deleter.verify("STUDY") == {"Patient": 3, "Observation": 6}
+    assert deleter.count_query == "_summary=count"
+    # One query to detect the count support and one per resource type
+    assert client.count("GET") == 3
+    assert client.count("GET", "_summary=count") == 3
+
+
+def test_verify_falls_back_when_summary_is_not_supported(server):
+    populate(server, patients=3, observations=2)
+    client = MockClient(server)
+    send = client.send
+
+    def no_summary(method, url, body=None):
+        if "_summary" in url:
+            outcome = {
+                "resourceType": "OperationOutcome",
+                "issue": [{"diagnostics": "_summary argument is not supported"}],
+            }
+            return {"status_code": 400, "response": outcome}
+        return send(method, url, body)
+
+    client.send = no_summary
+    deleter = ResourceDeleter(client)
+    assert deleter.verify("STUDY", resource_list=["Observation"]) == {"Observation": 6}
+    assert deleter.count_query == "_total=accurate&_count=0"
+
+    # And if there is no way to get a count at all, the IDs are paged through
+    deleter.count_query = False
+    deleter.page_size = 4
+    assert deleter.count_remaining("Observation", "STUDY") == 6
+    assert client.count("GET", "_elements=id") == 2
@@ -0,0 +1,112 @@
+import json
+
+from wstlr.refgraph import (
+    ReferenceGraph,
+    blocking_referrer,
+    find_references,
+    from_whistle_output,
+)
+
+
+def test_find_references():
+    resource = {
+        "resourceType": "Observation",
+        "id": "1",
+        "identifier": [{"system": "x", "value": "obs-1"}],
+        "subject": {"reference": "Patient/p1"},
+        "hasMember": [{"reference": "Observation/2"}, {"reference": "#contained"}],
+        "specimen": {"identifier": {"system": "s", "value": "sp-1"}},
+    }
+    assert find_references(resource) == {
+        ("subject", "Patient/p1"),
+        ("hasMember", "Observation/2"),
+        ("specimen", "s|sp-1"),
+    }
+
+
+def test_blocking_referrer():
+    message = (
+        "Unable to delete Patient/1 because at least one resource has a reference "
+        "to this resource. First reference found was resource Observation/22 in "
+        "path Observation.subject"
+    )
+    assert blocking_referrer(message) == ("Observation", "22")
+    assert blocking_referrer("Injected conflict") is None
+    assert blocking_referrer(None) is None
+
+
+def test_levels_put_leaves_first():
+    graph = ReferenceGraph()
+    graph.add(("Patient", "p"))
+    graph.add(("Specimen", "s"), [("Patient", "p")])
+    graph.add(("Observation", "o"), [("Patient", "p"), ("Specimen", "s")])
+    graph.add(("Observation", "panel"), [("Observation", "o")])
+    # Outside of the graph, so it doesn't hold anything up
+    graph.add(("Condition", "c"), [("Practitioner", "x")])
+
+    assert graph.levels() == [
+        [("Condition", "c"), ("Observation", "panel")],
+        [("Observation", "o")],
+        [("Specimen", "s")],
+        [("Patient", "p")],
+    ]
+    assert graph.type_order() == ["Condition", "Observation", "Specimen", "Patient"]
+
+
+def test_cycles_end_up_last():
+    graph = ReferenceGraph()
+    graph.add(("Group", "a"), [("Group", "b")])
+    graph.add(("Group", "b"), [("Group", "a")])
+    graph.add(("List", "l"), [("Group", "a")])
+
+    assert graph.levels() == [[("List", "l")], [("Group", "a"), ("Group", "b")]]
+
+
+def test_from_whistle_output(tmp_path):
+    output = {
+        "patient": [
+            {"resourceType": "Patient", "identifier": [{"system": "p", "value": "1"}]},
+        ],
+        "specimen": [
+            {
+                "resourceType": "Specimen",
+                "identifier": [{"system": "s", "value": "1"}],
+                "subject": {"identifier": {"system": "p", "value": "1"}},
+            }
+        ],
+        "observation": [
+            {
+                "resourceType": "Observation",
+                "identifier": [{"system": "o", "value": "1"}],
+                "subject": {"identifier": {"system": "p", "value": "1"}},
+                "specimen": {"identifier": {"system": "s", "value": "1"}},
+                # Not a reference to anything in the output
+                "device": {"identifier": {"system": "https://example.org/devices", "value": "d1"}},
+            }
+        ],
+    }
+    filename = tmp_path / "output.json"
+    filename.write_text(json.dumps(output))
+
+    graph = from_whistle_output(filename)
+    assert len(graph) == 3
+    assert graph.referrers[("Patient", "p|1")] == {
+        ("Specimen", "s|1"),
+        ("Observation", "o|1"),
+    }
+    assert graph.type_order() == ["Observation", "Specimen", "Patient"]
+    assert graph.reference_elements["Observation"] == {"subject", "specimen"}
+
+
+def test_add_resource_keeps_literal_references():
+    graph = ReferenceGraph()
+    graph.add_resource(
+        {
+            "resourceType": "Specimen",
+            "id": "s1",
+            "subject": {"reference": "Patient/p1"},
+            "container": [{"identifier": {"system": "https://example.org/tubes", "value": "t1"}}],
+        }
+    )
+    assert graph.references[("Specimen", "s1")] == {("Patient", "p1")}
+    assert graph.reference_elements["Specimen"] == {"subject"}
@@ -2,7 +2,7 @@ import json
 
 import pytest
 
-from wstlr.studyids import StudyIDs
+from wstlr.studyids import StudyIDs, StudyIDsDB, log_filename, open_study_ids
 
 
 @pytest.fixture
@@ -90,3 +90,184 @@ class TestLoadFromFile:
             "Observation",
             "Patient",
         ]
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    return tmp_path / "study-ids.sqlite"
+
+
+class TestStudyIDsDB:
+    def test_ids_are_written_as_chunks_fill(self, db_file):
+        ids = StudyIDsDB("https://fhir.example.org", study_id="STUDY1", chunk_size=2, filename=db_file)
+        ids.flush_interval = 60
+        ids.add_id("Patient", "p1")
+        ids.add_id("Patient", "p2")
+        ids.add_id("Patient", "p3")
+
+        # A separate connection sees the first chunk before anything is flushed
+        reader = StudyIDsDB("https://fhir.example.org")
+        assert reader.load_from_file(db_file) == ["STUDY1"]
+        assert reader.get_ids("STUDY1", "Patient") == ["p1", "p2"]
+
+        ids.flush()
+        assert reader.get_ids("STUDY1", "Patient") == ["p1", "p2", "p3"]
+
+    def test_duplicates_are_dropped(self, db_file):
+        ids = StudyIDsDB("https://fhir.example.org", study_id="STUDY1", filename=db_file)
+        for id_ in ["p2", "p1", "p1", "p3", "p2"]:
+            ids.add_id("Patient", id_)
+        ids.dump_to_file(db_file)
+        ids.add_id("Patient", "p1")
+        ids.flush()
+
+        assert ids.get_ids("STUDY1", "Patient") == ["p2", "p1", "p3"]
+
+    def test_reads_are_restricted_to_host_study_and_resource(self, db_file):
+        for host, study in [("https://a", "S1"), ("https://a", "S2"), ("https://b", "S1")]:
+            ids = StudyIDsDB(host, study_id=study, filename=db_file)
+            ids.add_id("Patient", f"{host}-{study}")
+            ids.add_id("Observation", f"o-{host}-{study}")
+            ids.close()
+
+        reader = StudyIDsDB("https://a")
+        assert reader.load_from_file(db_file) == ["S1", "S2"]
+        assert sorted(reader.list_resource_types("S1")) == ["Observation", "Patient"]
+        assert list(reader.iter_ids("S2", "Patient", batch_size=1)) == ["https://a-S2"]
+
+    def test_finished_runs_replace_earlier_ids(self, db_file):
+        first = StudyIDsDB("https://a", study_id="S1", filename=db_file)
+        for id_ in ["p1", "p2"]:
+            first.add_id("Patient", id_)
+        first.add_id("Observation", "o1")
+        first.dump_to_file(db_file)
+        first.close()
+        other = StudyIDsDB("https://a", study_id="S2", filename=db_file)
+        other.add_id("Patient", "x1")
+        other.dump_to_file(db_file)
+        other.close()
+
+        second = StudyIDsDB("https://a", study_id="S1", filename=db_file)
+        second.add_id("Patient", "p3")
+        second.add_id("Patient", "p2")
+        # Until the run is done, the IDs are only added
+        second.flush()
+        assert second.get_ids("S1", "Patient") == ["p1", "p2", "p3"]
+
+        second.dump_to_file(db_file)
+        assert second.get_ids("S1", "Patient") == ["p2", "p3"]
+        # Types the run didn't load, and other studies, are left alone
+        assert second.get_ids("S1", "Observation") == ["o1"]
+        assert second.get_ids("S2", "Patient") == ["x1"]
+
+    def test_ids_can_be_streamed_in_reverse(self, db_file, ids_file):
+        ids = StudyIDsDB("https://a", study_id="S1", filename=db_file)
+        legacy = StudyIDs("https://a", study_id="S1")
+        for id_ in ["p1", "p2", "p3"]:
+            ids.add_id("Patient", id_)
+            legacy.add_id("Patient", id_)
+        ids.flush()
+        legacy.dump_to_file(ids_file)
+        legacy.load_from_file(ids_file)
+
+        for studyids in [ids, legacy]:
+            assert list(studyids.iter_ids("S1", "Patient", reverse=True)) == ["p3", "p2", "p1"]
+
+    def test_json_export_and_import(self, db_file, ids_file):
+        legacy = StudyIDs("https://fhir.example.org", study_id="STUDY2")
+        legacy.add_id("Patient", "q1")
+        legacy.dump_to_file(ids_file)
+
+        ids = StudyIDsDB("https://fhir.example.org", study_id="STUDY1", filename=db_file)
+        ids.add_id("Patient", "p2")
+        ids.add_id("Patient", "p1")
+        ids.export_json(ids_file)
+
+        reader = StudyIDs("https://fhir.example.org")
+        assert sorted(reader.load_from_file(ids_file)) == ["STUDY1", "STUDY2"]
+        assert reader.get_ids("STUDY1", "Patient") == ["p1", "p2"]
+
+        copy = StudyIDsDB("https://fhir.example.org", filename=db_file.with_name("copy.sqlite"))
+        assert copy.import_json(ids_file) == 3
+        assert copy.get_ids("STUDY2", "Patient") == ["q1"]
+
+
+def test_open_study_ids_picks_the_backend_from_the_filename(db_file, ids_file):
+    assert type(open_study_ids("https://a", db_file, "S1")) is StudyIDsDB
+    assert type(open_study_ids("https://a", ids_file, "S1")) is StudyIDs
+
+
+class TestIdLog:
+    def test_ids_are_logged_in_batches_as_they_are_added(self, ids_file):
+        ids = open_study_ids("https://fhir.example.org", ids_file, "STUDY1")
+        ids.chunk_size = 2
+        ids.flush_interval = 60
+        for id_ in ["p1", "p2", "p3"]:
+            ids.add_id("Patient", id_)
+
+        lines = log_filename(ids_file, "STUDY1").read_text().splitlines()
+        assert [json.loads(x)["ids"] for x in lines] == [["p1", "p2"]]
+        ids.flush_log()
+        lines = log_filename(ids_file, "STUDY1").read_text().splitlines()
+        assert json.loads(lines[-1]) == {
+            "study": "STUDY1",
+            "host": "https://fhir.example.org",
+            "resourceType": "Patient",
+            "ids": ["p3"],
+        }
+
+    def test_ids_from_an_unfinished_run_are_recovered(self, ids_file):
+        finished = StudyIDs("https://fhir.example.org", study_id="STUDY2")
+        finished.add_id("Patient", "q1")
+        finished.dump_to_file(ids_file)
+
+        crashed = open_study_ids("https://fhir.example.org", ids_file, "STUDY1")
+        crashed.add_id("Patient", "p1")
+        crashed.add_id("Observation", "o1")
+        crashed.flush_log()
+        # ...and never makes it to dump_to_file. A torn line is skipped
+        with log_filename(ids_file, "STUDY1").open("at") as f:
+            f.write('{"study": "STUDY1", "ho')
+        # Exiting releases the log's lock
+        crashed.close_log()
+
+        reader = StudyIDs("https://fhir.example.org")
+        assert sorted(reader.load_from_file(ids_file)) == ["STUDY1", "STUDY2"]
+        assert reader.get_ids("STUDY1", "Patient") == ["p1"]
+
+        # The next run's compaction folds them into the file and drops the log
+        rerun = open_study_ids("https://fhir.example.org", ids_file, "STUDY1")
+        rerun.add_id("Patient", "p2")
+        rerun.dump_to_file(ids_file)
+
+        data = json.loads(ids_file.read_text())
+        assert data["STUDY1"]["https://fhir.example.org"] == {
+            "Patient": ["p1", "p2"],
+            "Observation": ["o1"],
+        }
+        assert data["STUDY2"]["https://fhir.example.org"]["Patient"] == ["q1"]
+        assert not log_filename(ids_file, "STUDY1").exists()
+
+    def test_logs_in_use_by_other_runs_are_left_alone(self, ids_file):
+        running = open_study_ids("https://fhir.example.org", ids_file, "STUDY2")
+        running.add_id("Patient", "q1")
+        running.flush_log()
+
+        # Left behind by a run that is no longer around
+        abandoned = log_filename(ids_file, "STUDY3", pid=1)
+        abandoned.write_text(
+            json.dumps({"study": "STUDY3", "host": "https://fhir.example.org", "resourceType": "Patient", "ids": ["r1"]})
+            + "\n"
+        )
+
+        finished = open_study_ids("https://fhir.example.org", ids_file, "STUDY1")
+        finished.add_id("Patient", "p1")
+        finished.dump_to_file(ids_file)
+
+        assert log_filename(ids_file, "STUDY2").exists()
+        assert not abandoned.exists()
+        assert sorted(json.loads(ids_file.read_text())) == ["STUDY1", "STUDY3"]
+
+        running.dump_to_file(ids_file)
+        assert sorted(json.loads(ids_file.read_text())) == ["STUDY1", "STUDY2", "STUDY3"]
+        assert list(ids_file.parent.glob("*.log")) == []
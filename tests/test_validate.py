@@ -0,0 +1,124 @@
+import csv
+
+import pytest
+
+from wstlr.bench.synthetic import StudyShape, SyntheticStudy
+from wstlr.config import Configuration
+from wstlr.validate import exec, table_specs, validate_data
+
+
+@pytest.fixture
+def study(tmp_path, monkeypatch):
+    monkeypatch.setenv("WHISTLER_CACHE_DIR", str(tmp_path / "cache"))
+    study = SyntheticStudy(
+        tmp_path / "study",
+        StudyShape(subjects=20, tables=2, variables=6, grouped_tables=1, embedded_tables=0),
+    )
+    study.generate()
+    return study
+
+
+def load_config(study):
+    with study.config_filename.open("rt") as f:
+        return Configuration(f)
+
+
+def rewrite(filename, change):
+    with open(filename, newline="") as f:
+        rows = list(csv.DictReader(f))
+    change(rows)
+    with open(filename, "wt", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def problems(report):
+    return {(x.table, x.column, x.problem): x for x in report.issues}
+
+
+def test_clean_study_has_no_errors(study):
+    report = validate_data(load_config(study), workers=1)
+    assert report.errors == []
+    assert report.rows == {"table_00": 20, "table_01": 20, "grouped_00": 60}
+
+
+def test_bad_values_are_reported(study):
+    filename = study.data_dir / "table_00.csv"
+
+    def corrupt(rows):
+        rows[3]["table_00_var_000"] = "not-a-code"
+        rows[5]["table_00_var_000"] = "not-a-code"
+        rows[4]["table_00_var_001"] = "twelve"
+        rows[6]["table_00_var_001"] = "NA"
+        rows[7]["subject_id"] = ""
+
+    rewrite(filename, corrupt)
+    report = validate_data(load_config(study), workers=1)
+    found = problems(report)
+
+    enum = found[("table_00", "table_00_var_000", "not in enumerations")]
+    assert (enum.count, enum.examples, enum.first_row) == (2, ["not-a-code"], 5)
+    integer = found[("table_00", "table_00_var_001", "not an integer")]
+    assert (integer.count, integer.examples, integer.first_row) == (1, ["twelve"], 6)
+    assert found[("table_00", "subject_id", "empty key value")].first_row == 9
+    assert len(report.errors) == 3
+
+
+def test_enumeration_descriptions_are_accepted(study):
+    filename = study.data_dir / "table_00.csv"
+
+    def describe(rows):
+        rows[0]["table_00_var_000"] = "table_00_var_000 value 2"
+        rows[1]["table_00_var_000"] = "table_00_var_003 value 2"
+
+    rewrite(filename, describe)
+    found = problems(validate_data(load_config(study), workers=1))
+    enum = found[("table_00", "table_00_var_000", "not in enumerations")]
+    assert (enum.count, enum.examples) == (1, ["table_00_var_003 value 2"])
+
+
+def test_missing_key_column_is_an_error(study):
+    filename = study.data_dir / "table_01.csv"
+
+    def drop_columns(rows):
+        for row in rows:
+            del row["subject_id"]
+            del row["table_01_var_002"]
+            row["surprise"] = "x"
+
+    rewrite(filename, drop_columns)
+    found = problems(validate_data(load_config(study), workers=1))
+    assert found[("table_01", "subject_id", "missing key column")].severity == "error"
+    assert found[("table_01", "table_01_var_002", "missing column")].severity == "warning"
+    assert found[("table_01", "surprise", "not in data-dictionary")].severity == "warning"
+
+
+def test_parallel_matches_serial(study):
+    rewrite(
+        study.data_dir / "grouped_00.csv",
+        lambda rows: rows[0].update({"grouped_00_var_000": "bad"}),
+    )
+    config = load_config(study)
+    serial = validate_data(config, workers=1).as_dict()
+    parallel = validate_data(config, workers=3).as_dict()
+    assert serial == parallel
+    assert serial["errors"] == 1
+
+
+def test_specs_precompile_enumerations(study):
+    spec = {x.table_name: x for x in table_specs(load_config(study))}["table_00"]
+    rule = spec.columns["table_00_var_000"]
+    assert rule.enumerations == frozenset(["0", "1", "2", "3", "4"])
+    assert spec.columns["subject_id"].key
+
+
+def test_exec_exits_with_errors(study, tmp_path):
+    rewrite(
+        study.data_dir / "table_00.csv",
+        lambda rows: rows[0].update({"table_00_var_001": "x"}),
+    )
+    with pytest.raises(SystemExit) as excinfo:
+        exec([str(study.config_filename), "--report", str(tmp_path / "report.json")])
+    assert excinfo.value.code == 1
+    assert (tmp_path / "report.json").exists()
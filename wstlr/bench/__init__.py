@@ -0,0 +1,8 @@
+"""
+Benchmarking support for Whistler.
+
+These modules are not part of the normal pipeline. They generate synthetic
+studies of arbitrary size and time the individual pipeline components
+against them so that performance changes can be measured and compared
+against a stored baseline.
+"""
@@ -0,0 +1,271 @@
+"""
+Time and measure the memory used by the extraction components of the
+pipeline (everything that happens before whistle runs) against a synthetic
+study.
+
+Each benchmark is run --repeat times and the fastest run is reported. Peak
+memory is measured with tracemalloc in a separate run, since tracing skews
+the timings. Results can be saved as a baseline and later runs compared
+against it:
+
+    bench-extract --subjects 5000 --save-baseline bench/baseline.json
+    bench-extract --subjects 5000 --baseline bench/baseline.json
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from collections.abc import Callable
+from contextlib import redirect_stdout
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any
+
+from rich import print
+
+from wstlr.bench.synthetic import StudyShape, SyntheticStudy
+from wstlr.conceptmap import BuildConceptMap, ObjectifyHarmony
+from wstlr.config import Configuration
+from wstlr.embedable import EmbedableTable
+from wstlr.extractor import (
+    BuildAggregators,
+    DataCsvToObject,
+    GroupBy,
+    ObjectifyCSV,
+)
+
+
+class ExtractionBenchmarks:
+    def __init__(self, study: SyntheticStudy) -> None:
+        self.study = study
+        self.config_filename = study.config_filename
+        with redirect_stdout(io.StringIO()):
+            self.config = self.load_config()
+            self.dataset = DataCsvToObject(self.config)
+
+    def load_config(self) -> Configuration:
+        with self.config_filename.open("rt") as f:
+            return Configuration(f)
+
+    def objectify_csv(self) -> Any:
+        table_name = self.study.table_names[0]
+        table = self.config.dataset[table_name]
+        with open(table["filename"], encoding="utf-8-sig") as f:
+            return ObjectifyCSV(
+                f,
+                BuildAggregators(table.get("aggregators", {})),
+                GroupBy(),
+                None,
+                {},
+                self.config.study_dd.varname_lookup(table_name),
+            )
+
+    def group_by(self) -> Any:
+        results = []
+        for table_name in self.study.grouped_table_names:
+            table = self.config.dataset[table_name]
+            with open(table["filename"], encoding="utf-8-sig") as f:
+                results.append(ObjectifyCSV(f, {}, GroupBy(config=table["group_by"])))
+        return results
+
+    def embedable_table(self) -> Any:
+        rows = 0
+        for table_name in self.study.embedded_table_names:
+            table = self.config.dataset[table_name]
+            embd = EmbedableTable(table_name, table["embed"]["dataset"], table["embed"]["colname"])
+            embd.load_data(table["filename"])
+            for subject_id in self.study.subject_ids():
+                rows += len(embd.get_rows(subject_id))
+        return rows
+
+    def objectify_harmony(self) -> Any:
+        return ObjectifyHarmony(
+            str(self.study.harmony_filename), curies={}, consent_group=None
+        )
+
+    def build_conceptmap(self) -> Any:
+        with TemporaryDirectory() as tmpdir:
+            return BuildConceptMap(
+                [str(self.study.harmony_filename)],
+                curies={},
+                name_prefix="bench",
+                outname=f"{tmpdir}/bench.json",
+                codesystems=self.dataset["code-systems"],
+            )
+
+    def data_csv_to_object(self) -> Any:
+        return DataCsvToObject(self.config)
+
+    def json_serialization(self) -> Any:
+        return json.dumps(self.dataset, indent=2)
+
+    def benchmarks(self) -> dict[str, Callable[[], Any]]:
+        return {
+            "configuration": self.load_config,
+            "objectify_csv": self.objectify_csv,
+            "group_by": self.group_by,
+            "embedable_table": self.embedable_table,
+            "objectify_harmony": self.objectify_harmony,
+            "build_conceptmap": self.build_conceptmap,
+            "data_csv_to_object": self.data_csv_to_object,
+            "json_serialization": self.json_serialization,
+        }
+
+
+def measure(func: Callable[[], Any], repeat: int = 3) -> dict[str, float]:
+    """Returns the fastest time (seconds) and peak memory (MB) for func"""
+    best = None
+    with redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            start = perf_counter()
+            func()
+            elapsed = perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        tracemalloc.start()
+        try:
+            func()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    assert best is not None
+    return {"seconds": best, "peak_mb": peak / (1024 * 1024)}
+
+
+def compare_to_baseline(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float = 1.25,
+) -> list[str]:
+    """Returns a description of each measurement that is worse than the
+    baseline by more than the tolerance (a ratio)"""
+    regressions = []
+    for name, measurements in results.items():
+        if name not in baseline:
+            continue
+        for metric, value in measurements.items():
+            previous = baseline[name].get(metric)
+            if previous is not None and previous > 0 and value / previous > tolerance:
+                regressions.append(
+                    f"{name}.{metric}: {value:.4f} vs {previous:.4f} ({value / previous:.2f}x)"
+                )
+    return regressions
+
+
+def print_results(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]] | None = None,
+) -> None:
+    print("Benchmark                Seconds    Peak MB    Baseline (s) Ratio")
+    print("------------------------ ---------- ---------- ------------ ------")
+    for name, measurements in results.items():
+        line = f"{name:<24} {measurements['seconds']:>10.4f} {measurements['peak_mb']:>10.2f}"
+        if baseline is not None and name in baseline:
+            previous = baseline[name]["seconds"]
+            line += f" {previous:>12.4f} {measurements['seconds'] / previous:>6.2f}"
+        print(line)
+
+
+def add_shape_arguments(parser: ArgumentParser) -> None:
+    defaults = StudyShape()
+    parser.add_argument("--subjects", type=int, default=defaults.subjects)
+    parser.add_argument("--tables", type=int, default=defaults.tables)
+    parser.add_argument("--variables", type=int, default=defaults.variables, help="Variables per table")
+    parser.add_argument("--enumerations", type=int, default=defaults.enumerations, help="Values per enumerated variable")
+    parser.add_argument("--aggregated-columns", type=int, default=defaults.aggregated_columns)
+    parser.add_argument("--grouped-tables", type=int, default=defaults.grouped_tables)
+    parser.add_argument("--embedded-tables", type=int, default=defaults.embedded_tables)
+    parser.add_argument("--rows-per-subject", type=int, default=defaults.rows_per_subject)
+    parser.add_argument("--harmony-rows", type=int, default=defaults.harmony_rows)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def shape_from_args(args: Any) -> StudyShape:
+    return StudyShape(
+        subjects=args.subjects,
+        tables=args.tables,
+        variables=args.variables,
+        enumerations=args.enumerations,
+        aggregated_columns=args.aggregated_columns,
+        grouped_tables=args.grouped_tables,
+        embedded_tables=args.embedded_tables,
+        rows_per_subject=args.rows_per_subject,
+        harmony_rows=args.harmony_rows,
+        seed=args.seed,
+    )
+
+
+def exec(args: list[str] | None = None) -> None:
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(
+        description="Benchmark the extraction pipeline against a synthetic study."
+    )
+    add_shape_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark")
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="append",
+        help="Only run the named benchmark(s). May be specified more than once.",
+    )
+    parser.add_argument("--baseline", type=str, help="JSON file with results to compare against")
+    parser.add_argument("--save-baseline", type=str, help="Write the results to this JSON file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="Ratio over the baseline at which a result is considered a regression",
+    )
+    parser.add_argument(
+        "--study-dir",
+        type=str,
+        help="Write the synthetic study here (and keep it) rather than a temporary directory",
+    )
+    parsed = parser.parse_args(args)
+
+    with TemporaryDirectory() as tmpdir:
+        root = Path(parsed.study_dir) if parsed.study_dir else Path(tmpdir)
+        shape = shape_from_args(parsed)
+        study = SyntheticStudy(root, shape)
+        study.generate()
+        print(f"Synthetic study: {shape}")
+
+        bench = ExtractionBenchmarks(study)
+        results: dict[str, dict[str, float]] = {}
+        for name, func in bench.benchmarks().items():
+            if parsed.benchmark is None or name in parsed.benchmark:
+                results[name] = measure(func, parsed.repeat)
+
+    baseline = None
+    if parsed.baseline is not None:
+        with open(parsed.baseline, "rt") as f:
+            stored = json.load(f)
+        baseline = stored["results"]
+        if stored.get("shape") != shape.__dict__:
+            print(
+                "[yellow]The baseline was recorded with a different study "
+                f"shape: {stored.get('shape')}[/yellow]"
+            )
+
+    print_results(results, baseline)
+
+    if parsed.save_baseline is not None:
+        Path(parsed.save_baseline).parent.mkdir(parents=True, exist_ok=True)
+        with open(parsed.save_baseline, "wt") as f:
+            json.dump({"shape": shape.__dict__, "results": results}, f, indent=2)
+        print(f"Baseline written to {parsed.save_baseline}")
+
+    if baseline is not None:
+        regressions = compare_to_baseline(results, baseline, parsed.tolerance)
+        if len(regressions) > 0:
+            print("[red]Regressions:[/red]\n\t" + "\n\t".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,246 @@
+"""
+Measure loader and purge throughput against the in-memory mock FHIR server
+(wstlr.bench.mockfhir).
+
+A synthetic set of Patients and Observations (each Observation references
+its Patient by identifier, just like whistle's output) is loaded with
+ResourceLoader and then purged with ResourceDeleter over a grid of thread
+counts and load buffer sizes. Each cell of the grid gets a fresh server so
+that the results are independent of one another.
+
+    bench-load --patients 2000 --threads 1,4,16 --buffer-sizes 100,500
+
+Because the server is local, these numbers reflect the overhead of our own
+code and the client rather than any real server. Use --latency to simulate
+a remote server.
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from copy import deepcopy
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any
+
+from ncpi_fhir_client.fhir_client import FhirClient
+from ncpi_fhir_client.ridcache import RIdCache
+from rich import print
+
+from wstlr.bench.mockfhir import MockFhirServer
+from wstlr.load import ResourceLoader
+from wstlr.purge import ResourceDeleter
+
+identifier_prefix = "https://bench.whistler.example/fhir"
+
+
+def synthetic_resources(
+    study_id: str, patients: int, observations_per_patient: int
+) -> list[tuple[str, dict[str, Any]]]:
+    """Returns (group name, resource) pairs as ParseBundle would provide
+    them to the loader"""
+    tag = {"system": f"{identifier_prefix}/study", "code": study_id}
+    patient_system = f"{identifier_prefix}/{study_id}/participant"
+    observation_system = f"{identifier_prefix}/{study_id}/observation"
+
+    resources = []
+    for i in range(patients):
+        patient_identifier = {"system": patient_system, "value": f"p{i:07d}"}
+        resources.append(
+            (
+                "patient",
+                {
+                    "resourceType": "Patient",
+                    "meta": {"tag": [tag]},
+                    "identifier": [patient_identifier],
+                    "gender": ["female", "male"][i % 2],
+                },
+            )
+        )
+        for j in range(observations_per_patient):
+            resources.append(
+                (
+                    "observation",
+                    {
+                        "resourceType": "Observation",
+                        "meta": {"tag": [tag]},
+                        "identifier": [
+                            {"system": observation_system, "value": f"p{i:07d}.{j}"}
+                        ],
+                        "status": "final",
+                        "code": {"text": f"measurement {j}"},
+                        "subject": {"identifier": dict(patient_identifier)},
+                        "valueQuantity": {"value": i + j, "unit": "mg"},
+                    },
+                )
+            )
+    return resources
+
+
+class LoadBenchmark:
+    def __init__(
+        self,
+        resources: list[tuple[str, dict[str, Any]]],
+        study_id: str = "BENCH",
+        server_options: dict[str, Any] | None = None,
+        quiet: bool = True,
+    ) -> None:
+        self.resources = resources
+        self.study_id = study_id
+        self.server_options = server_options if server_options is not None else {}
+        self.quiet = quiet
+
+    def run(self, thread_count: int, buffer_size: int, workdir: Path) -> dict[str, Any]:
+        """Load then purge everything using a fresh server"""
+        server = MockFhirServer(**self.server_options)
+        server.start()
+        try:
+            output = io.StringIO() if self.quiet else sys.stdout
+            with redirect_stdout(output):
+                result = self.load(server, thread_count, buffer_size, workdir)
+                result.update(self.purge(server, thread_count, workdir))
+        finally:
+            server.stop()
+        result["remaining"] = server.resource_count()
+        return result
+
+    def load(
+        self, server: MockFhirServer, thread_count: int, buffer_size: int, workdir: Path
+    ) -> dict[str, Any]:
+        # Each run needs its own cache so that ids from a previous server
+        # aren't reused
+        study_id = f"{self.study_id}-{thread_count}-{buffer_size}"
+        idcache = RIdCache(study_id=study_id, valid_patterns=[])
+        client = FhirClient(server.host_config(), idcache=idcache)
+        loader = ResourceLoader(
+            identifier_prefix,
+            client,
+            study_id=self.study_id,
+            idcache=idcache,
+            threaded=thread_count > 1,
+            thread_count=thread_count,
+        )
+        loader.max_queue_size = buffer_size
+
+        resources = deepcopy(self.resources)
+        start = perf_counter()
+        for group_name, resource in resources:
+            loader.consume_load(group_name, resource)
+        loader.launch_threads()
+        if len(loader.delayed_loading) > 0:
+            loader.retry_loading()
+        loader.cleanup_threads()
+        elapsed = perf_counter() - start
+
+        loader.save_study_ids(workdir / f"study-ids-{server.port}.json")
+        loaded = sum(loader.resource_summary.values())
+        return {
+            "threads": thread_count,
+            "buffer_size": buffer_size,
+            "loaded": loaded,
+            "unresolved": len(loader.delayed_loading),
+            "load_seconds": elapsed,
+            "load_per_second": loaded / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def purge(self, server: MockFhirServer, thread_count: int, workdir: Path) -> dict[str, Any]:
+        client = FhirClient(server.host_config())
+        deleter = ResourceDeleter(
+            client,
+            threaded=thread_count > 1,
+            thread_count=thread_count,
+        )
+        deleter.load_studyids(workdir / f"study-ids-{server.port}.json")
+
+        before = server.resource_count()
+        start = perf_counter()
+        deleter.delete_resources(self.study_id)
+        deleter.cleanup_threads()
+        elapsed = perf_counter() - start
+        deleted = before - server.resource_count()
+
+        return {
+            "deleted": deleted,
+            "purge_seconds": elapsed,
+            "purge_per_second": deleted / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def print_results(results: list[dict[str, Any]]) -> None:
+    print(
+        "Threads  Buffer  Loaded    Load (s)  Loads/s    Deleted   Purge (s) Deletes/s  Left"
+    )
+    print(
+        "-------- ------- --------- --------- ---------- --------- --------- ---------- -----"
+    )
+    for result in results:
+        print(
+            f"{result['threads']:<8} {result['buffer_size']:<7} {result['loaded']:<9} "
+            f"{result['load_seconds']:>9.2f} {result['load_per_second']:>10.1f} "
+            f"{result['deleted']:<9} {result['purge_seconds']:>9.2f} "
+            f"{result['purge_per_second']:>10.1f} {result['remaining']:>5}"
+        )
+
+
+def int_list(value: str) -> list[int]:
+    return [int(x) for x in value.split(",") if x.strip() != ""]
+
+
+def exec(args: list[str] | None = None) -> None:
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(
+        description="Measure load and purge throughput against a local mock FHIR server."
+    )
+    parser.add_argument("--patients", type=int, default=500)
+    parser.add_argument("--observations", type=int, default=4, help="Observations per patient")
+    parser.add_argument(
+        "--threads",
+        type=int_list,
+        default=[1, 4, 10],
+        help="Comma separated list of thread counts to try",
+    )
+    parser.add_argument(
+        "--buffer-sizes",
+        type=int_list,
+        default=[500],
+        help="Comma separated list of load buffer sizes to try",
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the server adds to every request")
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests the server refuses with a 429. Be aware "
+        "that the loader sleeps for quite a while after each one.",
+    )
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the loader's output")
+    parsed = parser.parse_args(args)
+
+    resources = synthetic_resources("BENCH", parsed.patients, parsed.observations)
+    bench = LoadBenchmark(
+        resources,
+        server_options={"latency": parsed.latency, "throttle_rate": parsed.throttle_rate},
+        quiet=not parsed.verbose,
+    )
+    print(f"{len(resources)} resources per run")
+
+    results = []
+    with TemporaryDirectory() as tmpdir:
+        for thread_count in parsed.threads:
+            for buffer_size in parsed.buffer_sizes:
+                results.append(bench.run(thread_count, buffer_size, Path(tmpdir)))
+
+    print_results(results)
+
+    if parsed.output is not None:
+        with open(parsed.output, "wt") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {parsed.output}")
@@ -0,0 +1,475 @@
+"""
+A small, in-memory stand-in for a FHIR server.
+
+This is only intended to drive the loader and purge code for throughput
+testing. It understands just enough of the REST API to be useful:
+
+* create (POST), update (PUT), read (GET) and DELETE by id
+* search by identifier=system|value
+* search by _id=a,b,c
+* search by _tag with paging (_count, next links), _summary=count,
+  _total and _elements
+* conditional multi-delete (DELETE Type?_tag=x)
+* batch and transaction Bundles POSTed to the base URL
+* $validate, which always succeeds
+* /metadata
+
+Latency, 429 (throttling) and 409 (conflict) responses can be injected.
+Deleting a resource that is still referenced by another returns a 409 with
+the same style of diagnostics HAPI produces.
+
+The server can run in-process (MockFhirServer.start()) or standalone via
+the mock-fhir command.
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import re
+import sys
+from argparse import ArgumentParser
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import sleep
+from typing import Any
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+reference_rx = re.compile(r"^([A-Z][A-Za-z]+)/([A-Za-z0-9\-\.]{1,64})$")
+
+
+def find_references(value: Any, found: set[tuple[str, str]]) -> set[tuple[str, str]]:
+    """Collect every literal reference (Type/id) inside a resource"""
+    if type(value) is dict:
+        for key, child in value.items():
+            if key == "reference" and type(child) is str:
+                match = reference_rx.match(child)
+                if match:
+                    found.add((match.group(1), match.group(2)))
+            else:
+                find_references(child, found)
+    elif type(value) is list:
+        for child in value:
+            find_references(child, found)
+    return found
+
+
+def operation_outcome(severity: str, code: str, diagnostics: str) -> dict[str, Any]:
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": severity, "code": code, "diagnostics": diagnostics}],
+    }
+
+
+class MockFhirServer:
+    def __init__(
+        self,
+        port: int = 0,
+        host: str = "127.0.0.1",
+        latency: float = 0.0,
+        throttle_rate: float = 0.0,
+        conflict_rate: float = 0.0,
+        page_size: int = 100,
+        max_page_size: int = 1000,
+        conditional_delete: bool = True,
+        enforce_references: bool = True,
+        seed: int | None = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.conflict_rate = conflict_rate
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.conditional_delete = conditional_delete
+        self.enforce_references = enforce_references
+        self.random = random.Random(seed)
+
+        self.lock = Lock()
+        self.ids = count(1)
+
+        # resourceType => id => resource
+        self.resources: defaultdict[str, dict[str, dict[str, Any]]] = defaultdict(dict)
+        # (resourceType, system|value) => id
+        self.identifiers: dict[tuple[str, str], str] = {}
+        # (resourceType, id) => set of (resourceType, id) that refer to it
+        self.referrers: defaultdict[tuple[str, str], set[tuple[str, str]]] = defaultdict(set)
+
+        # method => number of requests received
+        self.request_counts: defaultdict[str, int] = defaultdict(int)
+
+        self.server: ThreadingHTTPServer | None = None
+        self.thread: Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/fhir"
+
+    def host_config(self) -> dict[str, Any]:
+        """An entry suitable for use in place of one from the fhir_hosts file"""
+        return {
+            "host_desc": "Mock FHIR Server",
+            "target_service_url": self.base_url,
+            "auth_type": "auth_basic",
+            "username": "mock",
+            "password": "mock",
+        }
+
+    def start(self) -> str:
+        server = self
+
+        class Handler(MockFhirHandler):
+            mock = server
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        self.thread = Thread(target=self.server.serve_forever, name="mock-fhir", daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def reset(self) -> None:
+        with self.lock:
+            self.resources.clear()
+            self.identifiers.clear()
+            self.referrers.clear()
+            self.request_counts.clear()
+
+    def resource_count(self, resource_type: str | None = None) -> int:
+        with self.lock:
+            if resource_type is not None:
+                return len(self.resources[resource_type])
+            return sum(len(x) for x in self.resources.values())
+
+    # ---- Storage, all of which expects the lock to be held ----
+    def _identifier_keys(self, resource: dict[str, Any]) -> list[tuple[str, str]]:
+        identifiers = resource.get("identifier", [])
+        if type(identifiers) is dict:
+            identifiers = [identifiers]
+        return [
+            (resource["resourceType"], f"{x.get('system', '')}|{x.get('value', '')}")
+            for x in identifiers
+        ]
+
+    def _store(self, resource_type: str, resource: dict[str, Any], id: str | None = None) -> tuple[int, dict[str, Any]]:
+        status = 200
+        version = 0
+        if id is None:
+            id = str(next(self.ids))
+        if id not in self.resources[resource_type]:
+            status = 201
+        else:
+            version = int(self.resources[resource_type][id]["meta"]["versionId"])
+            self._unindex(resource_type, id)
+
+        resource = dict(resource)
+        resource["resourceType"] = resource_type
+        resource["id"] = id
+        resource["meta"] = dict(resource.get("meta", {}))
+        resource["meta"]["versionId"] = str(version + 1)
+
+        self.resources[resource_type][id] = resource
+        for key in self._identifier_keys(resource):
+            self.identifiers[key] = id
+        for target in find_references(resource, set()):
+            self.referrers[target].add((resource_type, id))
+        return status, resource
+
+    def _unindex(self, resource_type: str, id: str) -> None:
+        resource = self.resources[resource_type][id]
+        for key in self._identifier_keys(resource):
+            if self.identifiers.get(key) == id:
+                del self.identifiers[key]
+        for target in find_references(resource, set()):
+            self.referrers[target].discard((resource_type, id))
+
+    def _delete(self, resource_type: str, id: str) -> tuple[int, dict[str, Any]]:
+        if id not in self.resources[resource_type]:
+            # FHIR deletes are idempotent
+            return 200, operation_outcome("information", "informational", "Nothing to delete")
+
+        if self.enforce_references and len(self.referrers[(resource_type, id)]) > 0:
+            ref_type, ref_id = sorted(self.referrers[(resource_type, id)])[0]
+            return 409, operation_outcome(
+                "error",
+                "processing",
+                f"Unable to delete {resource_type}/{id} because at least one "
+                f"resource has a reference to this resource. First reference "
+                f"found was resource {ref_type}/{ref_id} in path {ref_type}.subject",
+            )
+
+        self._unindex(resource_type, id)
+        del self.resources[resource_type][id]
+        self.referrers.pop((resource_type, id), None)
+        return 200, operation_outcome("information", "informational", "Successfully deleted 1 resource(s)")
+
+    def _matches(self, resource: dict[str, Any], params: dict[str, str]) -> bool:
+        if "_tag" in params:
+            tags = resource.get("meta", {}).get("tag", [])
+            wanted = params["_tag"].split("|")[-1]
+            if not any(tag.get("code") == wanted for tag in tags):
+                return False
+        if "_id" in params and resource["id"] not in params["_id"].split(","):
+            return False
+        if "url" in params and resource.get("url") != params["url"]:
+            return False
+        return True
+
+    def search(self, resource_type: str, params: dict[str, str]) -> dict[str, Any]:
+        with self.lock:
+            if "identifier" in params:
+                id = self.identifiers.get((resource_type, params["identifier"]))
+                matches = [] if id is None else [self.resources[resource_type][id]]
+            else:
+                matches = [
+                    resource
+                    for resource in self.resources[resource_type].values()
+                    if self._matches(resource, params)
+                ]
+
+        bundle: dict[str, Any] = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(matches),
+            "link": [],
+            "entry": [],
+        }
+        if params.get("_summary") == "count":
+            del bundle["entry"]
+            return bundle
+
+        page_size = min(int(params.get("_count", self.page_size)), self.max_page_size)
+        offset = int(params.get("_offset", 0))
+        page = matches[offset : offset + page_size]
+        if offset + page_size < len(matches):
+            next_params = dict(params)
+            next_params["_offset"] = str(offset + page_size)
+            bundle["link"].append(
+                {
+                    "relation": "next",
+                    "url": f"{self.base_url}/{resource_type}?{urlencode(next_params)}",
+                }
+            )
+
+        elements = params.get("_elements")
+        for resource in page:
+            if elements is not None:
+                keep = set(elements.split(",")) | {"resourceType", "id"}
+                resource = {k: v for k, v in resource.items() if k in keep}
+            bundle["entry"].append(
+                {
+                    "fullUrl": f"{self.base_url}/{resource_type}/{resource['id']}",
+                    "resource": resource,
+                }
+            )
+        return bundle
+
+    def capability_statement(self) -> dict[str, Any]:
+        types = sorted(set(self.resources.keys()) | {"Patient", "Observation"})
+        return {
+            "resourceType": "CapabilityStatement",
+            "status": "active",
+            "kind": "instance",
+            "fhirVersion": "4.0.1",
+            "format": ["json"],
+            "rest": [
+                {
+                    "mode": "server",
+                    "resource": [
+                        {
+                            "type": resource_type,
+                            "conditionalDelete": "multiple"
+                            if self.conditional_delete
+                            else "not-supported",
+                        }
+                        for resource_type in types
+                    ],
+                    "interaction": [{"code": "batch"}, {"code": "transaction"}],
+                }
+            ],
+        }
+
+    def inject_failure(self, method: str) -> tuple[int, dict[str, Any]] | None:
+        """Randomly throttle or reject requests as configured"""
+        if self.latency > 0:
+            sleep(self.latency)
+        if self.throttle_rate > 0 and self.random.random() < self.throttle_rate:
+            return 429, operation_outcome("error", "throttled", "Too many requests")
+        if (
+            method in ["PUT", "POST", "DELETE"]
+            and self.conflict_rate > 0
+            and self.random.random() < self.conflict_rate
+        ):
+            return 409, operation_outcome("error", "conflict", "Injected conflict")
+        return None
+
+    def handle(self, method: str, path: str, query: dict[str, str], body: Any) -> tuple[int, dict[str, Any]]:
+        """Route a single request (also used for batch entries)"""
+        parts = [x for x in path.split("/") if x != ""]
+
+        with self.lock:
+            self.request_counts[method] += 1
+
+        if len(parts) == 0:
+            if method == "POST" and type(body) is dict and body.get("resourceType") == "Bundle":
+                return 200, self.process_bundle(body)
+            return 400, operation_outcome("error", "not-supported", f"{method} / not supported")
+
+        resource_type = parts[0]
+        if resource_type == "metadata":
+            return 200, self.capability_statement()
+
+        if len(parts) > 1 and parts[-1] == "$validate":
+            return 200, operation_outcome("information", "informational", "Validation successful")
+
+        id = parts[1] if len(parts) > 1 else None
+
+        if method == "GET":
+            if id is None:
+                return 200, self.search(resource_type, query)
+            with self.lock:
+                resource = self.resources[resource_type].get(id)
+            if resource is None:
+                return 404, operation_outcome("error", "not-found", f"{resource_type}/{id} not found")
+            return 200, resource
+
+        if method == "POST":
+            with self.lock:
+                return self._store(resource_type, body)
+
+        if method == "PUT":
+            if id is None:
+                return 400, operation_outcome("error", "not-supported", "Conditional update isn't supported")
+            with self.lock:
+                return self._store(resource_type, body, id)
+
+        if method == "DELETE":
+            with self.lock:
+                if id is not None:
+                    return self._delete(resource_type, id)
+
+                if not self.conditional_delete:
+                    return 412, operation_outcome("error", "not-supported", "Conditional delete isn't supported")
+                matches = [
+                    rid
+                    for rid, resource in self.resources[resource_type].items()
+                    if self._matches(resource, query)
+                ]
+                for rid in matches:
+                    status, outcome = self._delete(resource_type, rid)
+                    if status >= 300:
+                        return status, outcome
+                return 200, operation_outcome(
+                    "information", "informational", f"Successfully deleted {len(matches)} resource(s)"
+                )
+
+        return 405, operation_outcome("error", "not-supported", f"{method} isn't supported")
+
+    def process_bundle(self, bundle: dict[str, Any]) -> dict[str, Any]:
+        entries = []
+        for entry in bundle.get("entry", []):
+            request = entry.get("request", {})
+            url = urlsplit(request.get("url", ""))
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            status, response = self.handle(request.get("method", "GET"), url.path, query, entry.get("resource"))
+            result: dict[str, Any] = {"response": {"status": f"{status}"}}
+            if status >= 300 or response.get("resourceType") == "OperationOutcome":
+                result["response"]["outcome"] = response
+            elif response.get("resourceType") not in ["OperationOutcome", "Bundle"]:
+                result["resource"] = response
+                result["response"]["location"] = f"{response['resourceType']}/{response['id']}"
+            entries.append(result)
+        return {
+            "resourceType": "Bundle",
+            "type": f"{bundle.get('type', 'batch')}-response",
+            "entry": entries,
+        }
+
+
+class MockFhirHandler(BaseHTTPRequestHandler):
+    mock: MockFhirServer
+
+    def dispatch(self, method: str) -> None:
+        url = urlsplit(self.path)
+        path = url.path
+        if path.startswith("/fhir"):
+            path = path[len("/fhir") :]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        body = None
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 0:
+            body = json.loads(self.rfile.read(length))
+
+        failure = self.mock.inject_failure(method)
+        if failure is not None:
+            status, response = failure
+        else:
+            status, response = self.mock.handle(method, path, query, body)
+
+        content = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(content)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self) -> None:
+        self.dispatch("GET")
+
+    def do_POST(self) -> None:
+        self.dispatch("POST")
+
+    def do_PUT(self) -> None:
+        self.dispatch("PUT")
+
+    def do_DELETE(self) -> None:
+        self.dispatch("DELETE")
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def exec(args: list[str] | None = None) -> None:
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description="Run an in-memory mock FHIR server for benchmarking.")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--conflict-rate", type=float, default=0.0, help="Fraction of writes answered with 409")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument(
+        "--no-conditional-delete",
+        action="store_true",
+        help="Don't advertise (or support) conditional multi-delete",
+    )
+    parsed = parser.parse_args(args)
+
+    server = MockFhirServer(
+        port=parsed.port,
+        latency=parsed.latency,
+        throttle_rate=parsed.throttle_rate,
+        conflict_rate=parsed.conflict_rate,
+        page_size=parsed.page_size,
+        conditional_delete=not parsed.no_conditional_delete,
+    )
+    server.start()
+    print(f"Mock FHIR server running at {server.base_url} (Ctrl-C to stop)")
+    try:
+        assert server.thread is not None
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,233 @@
+"""
+Generate a synthetic study (data, data-dictionaries, harmony file and
+configuration) with whatever dimensions are required for benchmarking.
+
+The output is a normal whistler project, so it can be passed to
+Configuration, DataCsvToObject, play, etc. Generation is deterministic for
+a given seed.
+"""
+
+from __future__ import annotations
+
+import csv
+import os
+import random
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from yaml import safe_dump
+
+harmony_columns = [
+    "local code",
+    "text",
+    "table_name",
+    "parent_varname",
+    "local code system",
+    "code",
+    "display",
+    "code system",
+    "comment",
+]
+
+
+@dataclass
+class StudyShape:
+    """Dimensions of the synthetic study"""
+
+    subjects: int = 1000
+    tables: int = 3
+    variables: int = 20
+    enumerations: int = 5
+    # Columns matched by the aggregator regex of the first table
+    aggregated_columns: int = 0
+    grouped_tables: int = 1
+    embedded_tables: int = 1
+    # Number of rows per subject in the grouped/embedded tables
+    rows_per_subject: int = 3
+    harmony_rows: int = 500
+    seed: int = 42
+
+
+class SyntheticStudy:
+    def __init__(self, root: str | os.PathLike[str], shape: StudyShape | None = None, study_id: str = "SYNTH") -> None:
+        self.root = Path(root)
+        self.shape = shape if shape is not None else StudyShape()
+        self.study_id = study_id
+        self.random = random.Random(self.shape.seed)
+
+        self.data_dir = self.root / "data"
+        self.dd_dir = self.root / "dd"
+        self.harmony_dir = self.root / "harmony"
+        self.config_filename = self.root / f"{study_id.lower()}.yaml"
+        self.harmony_filename = self.harmony_dir / f"{study_id.lower()}-harmony.csv"
+
+        # table name => [(varname, data_type, {code: description})]
+        self.variables: dict[str, list[tuple[str, str, dict[str, str]]]] = {}
+
+    @property
+    def table_names(self) -> list[str]:
+        return [f"table_{i:02d}" for i in range(self.shape.tables)]
+
+    @property
+    def grouped_table_names(self) -> list[str]:
+        return [f"grouped_{i:02d}" for i in range(self.shape.grouped_tables)]
+
+    @property
+    def embedded_table_names(self) -> list[str]:
+        return [f"embedded_{i:02d}" for i in range(self.shape.embedded_tables)]
+
+    def subject_ids(self) -> list[str]:
+        return [f"S{i:07d}" for i in range(self.shape.subjects)]
+
+    def build_variables(self, table_name: str, include_aggregates: bool = False) -> list[tuple[str, str, dict[str, str]]]:
+        variables: list[tuple[str, str, dict[str, str]]] = [("subject_id", "string", {})]
+
+        for i in range(self.shape.variables):
+            varname = f"{table_name}_var_{i:03d}"
+            kind = i % 3
+            if kind == 0:
+                enums = {
+                    f"{j}": f"{varname} value {j}"
+                    for j in range(self.shape.enumerations)
+                }
+                variables.append((varname, "enumeration", enums))
+            elif kind == 1:
+                variables.append((varname, "integer", {}))
+            else:
+                variables.append((varname, "string", {}))
+
+        if include_aggregates:
+            for i in range(self.shape.aggregated_columns):
+                variables.append((f"agg_measure_{i:03d}", "integer", {}))
+
+        self.variables[table_name] = variables
+        return variables
+
+    def write_dd(self, table_name: str) -> Path:
+        filename = self.dd_dir / f"{table_name}-dd.csv"
+        with filename.open("wt", newline="") as f:
+            writer = csv.writer(f, delimiter=",", quotechar='"')
+            writer.writerow(["variable_name", "description", "data_type", "enumerations"])
+            for varname, data_type, enums in self.variables[table_name]:
+                enumerations = ";".join(f"{code}={desc}" for code, desc in enums.items())
+                writer.writerow([varname, f"Description of {varname}", data_type, enumerations])
+        return filename
+
+    def random_value(self, data_type: str, enums: dict[str, str]) -> str:
+        if data_type == "enumeration":
+            return self.random.choice(list(enums.keys()))
+        if data_type == "integer":
+            return str(self.random.randint(0, 10000))
+        return f"text-{self.random.randint(0, 100000)}"
+
+    def write_data(self, table_name: str, rows_per_subject: int = 1, extra: dict[str, Any] | None = None) -> Path:
+        filename = self.data_dir / f"{table_name}.csv"
+        variables = self.variables[table_name]
+        with filename.open("wt", newline="") as f:
+            writer = csv.writer(f, delimiter=",", quotechar='"')
+            header = [varname for varname, _, _ in variables]
+            writer.writerow(header)
+            for subject_id in self.subject_ids():
+                for row_index in range(rows_per_subject):
+                    row = [subject_id]
+                    for varname, data_type, enums in variables[1:]:
+                        if varname == "group_key":
+                            row.append(f"{subject_id}-{row_index % 2}")
+                        else:
+                            row.append(self.random_value(data_type, enums))
+                    writer.writerow(row)
+        return filename
+
+    def write_harmony(self) -> Path:
+        # Draw from the enumerated variables so that the harmony rows
+        # actually correspond to DD codes like they would for a real study
+        candidates = []
+        for table_name, variables in self.variables.items():
+            for varname, data_type, enums in variables:
+                for code, desc in enums.items():
+                    candidates.append((table_name, varname, code, desc))
+            for varname, _, _ in variables:
+                candidates.append((table_name, table_name, varname, varname))
+
+        with self.harmony_filename.open("wt", newline="") as f:
+            writer = csv.writer(f, delimiter=",", quotechar='"')
+            writer.writerow(harmony_columns)
+            for i in range(self.shape.harmony_rows):
+                table_name, local_cs, code, desc = candidates[i % len(candidates)]
+                # Cycle the target codes so that some local codes map to more
+                # than one target
+                target = i // len(candidates)
+                writer.writerow(
+                    [
+                        code,
+                        desc,
+                        table_name,
+                        local_cs if local_cs != table_name else "",
+                        local_cs,
+                        f"C{i:06d}{target}",
+                        f"Target concept {i}",
+                        "http://example.org/synthetic-ontology",
+                        "",
+                    ]
+                )
+        return self.harmony_filename
+
+    def generate(self) -> Path:
+        """Write the entire study to disk and return the configuration's path"""
+        for directory in [self.data_dir, self.dd_dir, self.harmony_dir]:
+            directory.mkdir(parents=True, exist_ok=True)
+
+        dataset: dict[str, Any] = {}
+        for index, table_name in enumerate(self.table_names):
+            self.build_variables(table_name, include_aggregates=index == 0)
+            dataset[table_name] = {
+                "filename": str(self.write_data(table_name)),
+                "data_dictionary": {"filename": str(self.write_dd(table_name))},
+            }
+            if index == 0 and self.shape.aggregated_columns > 0:
+                dataset[table_name]["aggregators"] = {"measurements": "^agg_measure_"}
+
+        for table_name in self.grouped_table_names:
+            variables = self.build_variables(table_name)
+            variables.insert(1, ("group_key", "string", {}))
+            dataset[table_name] = {
+                "filename": str(self.write_data(table_name, self.shape.rows_per_subject)),
+                "data_dictionary": {"filename": str(self.write_dd(table_name))},
+                "group_by": "group_key",
+            }
+
+        for table_name in self.embedded_table_names:
+            self.build_variables(table_name)
+            dataset[table_name] = {
+                "filename": str(self.write_data(table_name, self.shape.rows_per_subject)),
+                "data_dictionary": {"filename": str(self.write_dd(table_name))},
+                "embed": {"dataset": self.table_names[0], "colname": "subject_id"},
+            }
+
+        harmony_filename = str(self.write_harmony())
+        dataset[self.table_names[0]]["code_harmonization"] = harmony_filename
+
+        config = {
+            "study_id": self.study_id,
+            "study_title": f"Synthetic study {self.study_id}",
+            "study_desc": "Generated for benchmarking",
+            "identifier_prefix": "https://example.org/synthetic",
+            "harmony_prefix": f"{self.study_id.lower()}-harmony",
+            "code_harmonization_dir": str(self.harmony_dir),
+            "code_harmonization": [harmony_filename],
+            "projections": {
+                "study": "projector",
+                "dataset": "projector",
+                "harmonized": "projector",
+            },
+            "whistle_src": "_entry.wstl",
+            "id_colname": "subject_id",
+            "curies": {},
+            "dataset": dataset,
+        }
+
+        with self.config_filename.open("wt") as f:
+            safe_dump(config, f, sort_keys=False)
+
+        return self.config_filename
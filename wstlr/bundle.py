@@ -21,6 +21,7 @@ from copy import deepcopy
 from argparse import ArgumentParser, FileType
 from collections import OrderedDict
 from wstlr import get_host_config
+from wstlr.profiling import Profiler, add_profile_arguments
 import sys
 from pathlib import Path
 from rich import print
@@ -212,11 +213,16 @@ def exec():
     parser.add_argument(
         "filename", nargs="+", type=FileType("rt"), help="JSON file from whistle output"
     )
+    add_profile_arguments(parser)
     args = parser.parse_args(sys.argv[1:])
+    profiler = Profiler.from_args(args)
 
     for fn in args.filename:
         fname = f"{Path(fn.name).stem}-transaction.json"
         outfilename = Path(args.output) / fname
 
-        bundle = Bundle(str(outfilename), fname, args.env)
-        ParseBundle(fn, [bundle.consume_resource])
+        with profiler.stage(f"bundle-{Path(fn.name).stem}"):
+            bundle = Bundle(str(outfilename), fname, args.env)
+            ParseBundle(fn, [bundle.consume_resource])
+
+    profiler.finish()
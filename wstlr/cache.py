@@ -0,0 +1,52 @@
+"""
+Shared location and helpers for whistler's on-disk caches.
+
+Anything we cache between runs lives under a single root directory, which
+defaults to whistler inside the user's cache directory ($XDG_CACHE_HOME, or
+~/.cache if that isn't set). Set WHISTLER_CACHE_DIR to put it somewhere
+else. Entries are keyed by content, so projects can safely share it.
+Removing the directory is always safe; everything in it will be rebuilt as
+needed.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+
+cache_env_var = "WHISTLER_CACHE_DIR"
+
+
+def cache_root() -> Path:
+    if cache_env_var in os.environ:
+        return Path(os.environ[cache_env_var])
+    user_cache = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(user_cache) / "whistler"
+
+
+def cache_dir(name: str) -> Path:
+    """Returns (and creates) a subdirectory of the cache root"""
+    path = cache_root() / name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def content_hash(*filenames: str | os.PathLike[str]) -> str:
+    """sha256 of the contents of one or more files. Used to key cache
+    entries so that they are invalidated when the source changes rather
+    than relying on timestamps"""
+    digest = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_atomic(filename: Path, content: bytes) -> None:
+    """Write a cache entry such that concurrent readers never see a
+    partially written file"""
+    tmpfile = filename.with_name(f".{filename.name}.{os.getpid()}")
+    tmpfile.write_bytes(content)
+    os.replace(tmpfile, filename)
@@ -17,7 +17,6 @@ descriptive representation, this system will also create a 'self' target
 system. 
 """
 
-from csv import DictReader
 import json
 import sys
 from argparse import ArgumentParser, FileType
@@ -25,6 +24,7 @@ from pathlib import Path
 from collections import defaultdict
 from copy import deepcopy
 from wstlr import system_base, dd_system_url
+from wstlr.harmonystore import load_harmony
 
 
 """Convert the harmonization csv file into a FHIR ConceptMap resource for use with Whistle"""
@@ -45,95 +45,92 @@ def ObjectifyHarmony(harmony_csv, curies, consent_group, url_base=system_base):
     if curies is None:
         curies = {}
 
-    with open(harmony_csv, "rt") as f:
-        reader = DictReader(f, delimiter=",", quotechar='"')
-
-        redundant_notice = defaultdict(lambda: defaultdict(lambda: 0))
-        for line in reader:
-            if line["table_name"].strip() != "":
-                local_cs = line["local code system"]
-                if local_cs not in mappings:
-                    mappings[local_cs] = {
-                        "source_cs": local_cs,
-                        "parent": line["parent_varname"],
-                        "table": line["table_name"],
-                        "group": {},
-                    }
-
-                target_cs = line["code system"]
-                if target_cs not in mappings[local_cs]["group"]:
-                    mappings[local_cs]["group"][target_cs] = {
-                        "target_cs": target_cs,
-                        "codes": {},
-                    }
-
-                local_code = line["local code"]
-                if local_code not in mappings[local_cs]["group"][target_cs]["codes"]:
-                    mappings[local_cs]["group"][target_cs]["codes"][local_code] = {
-                        "code": local_code,
-                        "system": "",
-                        "table": line["table_name"],
-                        "parent": line["parent_varname"],
-                        "display": line["text"],
-                        "table_name": line["table_name"],
-                        "parent_varname": line["parent_varname"],
-                        "target_codes": {},
-                    }
-                target_code = line["code"]
-                curie = ""
-                if target_cs in curies:
-                    curie = curies[target_cs] + ":"
-
-                # We do have some redundant rows where the CDE has two variables but the dataset doesn't specify
-                # at that detail. We'll just keep the last and hope they are identical
-                if (
-                    target_code
-                    in mappings[local_cs]["group"][target_cs]["codes"][local_code][
-                        "target_codes"
-                    ]
-                ):
-                    redundant_notice[f"{local_cs}:{local_code}"][
-                        f"{target_cs}:{target_code}"
-                    ] += 1
-
-                mappings[local_cs]["group"][target_cs]["codes"][local_code][
-                    "target_codes"
-                ][target_code] = {
-                    "code": line["code"],
-                    "display": line["display"],
-                    "system": line["code system"],
-                    "table": "",
-                    "parent": "",
+    redundant_notice = defaultdict(lambda: defaultdict(lambda: 0))
+    for line in load_harmony(harmony_csv).rows:
+        if line["table_name"].strip() != "":
+            local_cs = line["local code system"]
+            if local_cs not in mappings:
+                mappings[local_cs] = {
+                    "source_cs": local_cs,
+                    "parent": line["parent_varname"],
+                    "table": line["table_name"],
+                    "group": {},
                 }
 
-                vss_key = f"{local_cs}:{line['table_name']}:{line['parent_varname']}"
+            target_cs = line["code system"]
+            if target_cs not in mappings[local_cs]["group"]:
+                mappings[local_cs]["group"][target_cs] = {
+                    "target_cs": target_cs,
+                    "codes": {},
+                }
 
-                vs_sources[vss_key].append(
-                    {"code": local_code, "display": line["text"]}
-                )
-                sources[local_cs][local_code] = {
+            local_code = line["local code"]
+            if local_code not in mappings[local_cs]["group"][target_cs]["codes"]:
+                mappings[local_cs]["group"][target_cs]["codes"][local_code] = {
                     "code": local_code,
-                    "display": line["text"],
                     "system": "",
                     "table": line["table_name"],
                     "parent": line["parent_varname"],
+                    "display": line["text"],
+                    "table_name": line["table_name"],
+                    "parent_varname": line["parent_varname"],
+                    "target_codes": {},
                 }
-                targets[target_cs][target_code] = {
-                    "code": f"{curie}{target_code}",
-                    "display": line["display"],
-                    "system": target_cs,
-                    "table": "",
-                    "parent": "",
-                }
-        if len(redundant_notice) > 0:
-            print(f"The following mappings were found to be duplicated")
-            printed = 0
-            for k in redundant_notice:
-                printed += 1
-                if printed < 10:
-                    print(f"{k}: {', '.join(redundant_notice[k].keys())}")
-            if len(redundant_notice) > 10:
-                print(f"And {len(redundant_notice) - 10} more.")
+            target_code = line["code"]
+            curie = ""
+            if target_cs in curies:
+                curie = curies[target_cs] + ":"
+
+            # We do have some redundant rows where the CDE has two variables but the dataset doesn't specify
+            # at that detail. We'll just keep the last and hope they are identical
+            if (
+                target_code
+                in mappings[local_cs]["group"][target_cs]["codes"][local_code][
+                    "target_codes"
+                ]
+            ):
+                redundant_notice[f"{local_cs}:{local_code}"][
+                    f"{target_cs}:{target_code}"
+                ] += 1
+
+            mappings[local_cs]["group"][target_cs]["codes"][local_code][
+                "target_codes"
+            ][target_code] = {
+                "code": line["code"],
+                "display": line["display"],
+                "system": line["code system"],
+                "table": "",
+                "parent": "",
+            }
+
+            vss_key = f"{local_cs}:{line['table_name']}:{line['parent_varname']}"
+
+            vs_sources[vss_key].append(
+                {"code": local_code, "display": line["text"]}
+            )
+            sources[local_cs][local_code] = {
+                "code": local_code,
+                "display": line["text"],
+                "system": "",
+                "table": line["table_name"],
+                "parent": line["parent_varname"],
+            }
+            targets[target_cs][target_code] = {
+                "code": f"{curie}{target_code}",
+                "display": line["display"],
+                "system": target_cs,
+                "table": "",
+                "parent": "",
+            }
+    if len(redundant_notice) > 0:
+        print(f"The following mappings were found to be duplicated")
+        printed = 0
+        for k in redundant_notice:
+            printed += 1
+            if printed < 10:
+                print(f"{k}: {', '.join(redundant_notice[k].keys())}")
+        if len(redundant_notice) > 10:
+            print(f"And {len(redundant_notice) - 10} more.")
 
     cm_obj = {
         # Stuff to build the two value sets
@@ -378,8 +375,20 @@ class ConceptMap:
 
 
 def BuildConceptMap(
-    csvfilenames, curies, name_prefix=None, outname=None, codesystems=[]
+    csvfilenames,
+    curies,
+    name_prefix=None,
+    outname=None,
+    codesystems=[],
+    dd_self_maps=True,
+    merge_groups=False,
 ):
+    """Write the harmony ConceptMap used by whistle's Harmonize functions.
+
+    When dd_self_maps is False, the data-dictionary code systems aren't
+    mapped onto themselves, which is only safe if the projections never
+    Harmonize DD codes directly. When merge_groups is True, groups sharing
+    the same source and target are combined (see merge_duplicate_groups)."""
     # We'll assume that we only want to filename with any path/dot information
 
     if name_prefix is None:
@@ -397,35 +406,29 @@ def BuildConceptMap(
     # harmony file
     if True:
         for csvfilename in csvfilenames:
-            with open(csvfilename, "rt") as f:
-                reader = DictReader(f, delimiter=",", quotechar='"')
-                # Make sure the field names are uniform. Just ignore case
-                reader.fieldnames = [x.lower() for x in reader.fieldnames]
-
-                rowcount = 0
-                for row in reader:
-                    if row.get("code system") is None:
-                        row["code system"] = ""
-
-                    key = ".".join(
-                        [
-                            row["local code system"],
-                            row["local code"],
-                            row["code system"],
-                            row["code"],
-                        ]
-                    )
+            # The store takes care of normalizing the field names and
+            # missing code systems
+            rowcount = 0
+            for row in load_harmony(csvfilename).rows:
+                key = ".".join(
+                    [
+                        row["local code system"],
+                        row["local code"],
+                        row["code system"],
+                        row["code"],
+                    ]
+                )
 
-                    rowcount += 1
+                rowcount += 1
 
-                    if key not in observed_mappings:
-                        observed_mappings.add(key)
+                if key not in observed_mappings:
+                    observed_mappings.add(key)
 
-                        mappings[row["local code system"]][row["code system"]].append(
-                            row
-                        )
-                        if row["code system"].strip() != "":
-                            mappings[row["local code system"]][""].append(row)
+                    mappings[row["local code system"]][row["code system"]].append(
+                        row
+                    )
+                    if row["code system"].strip() != "":
+                        mappings[row["local code system"]][""].append(row)
 
         concept_map = {
             "id": name_prefix,
@@ -486,6 +489,9 @@ def BuildConceptMap(
 
                 concept_map["group"].append(element)
 
+        if not dd_self_maps:
+            codesystems = []
+
         for cs in codesystems:
             element = None
             # In order to use variable categoricals in the harmony,
@@ -537,6 +543,9 @@ def BuildConceptMap(
                 #     since those will no be referenced by anything else
                 concept_map["group"].append(element)
 
+        if merge_groups:
+            merge_duplicate_groups(concept_map)
+
         print(f"Writing Harmony ConceptMap: {outname}")
         Path(outname).parent.mkdir(parents=True, exist_ok=True)
         with open(outname, mode="wt") as f:
@@ -550,6 +559,28 @@ def BuildConceptMap(
     return Path(csvfilename).stat().st_mtime
 
 
+def merge_duplicate_groups(concept_map):
+    """Combine groups sharing the same source and target (which happens
+    when a DD code system is also present in the harmony file) so that
+    whistle doesn't have to hold the same codes more than once"""
+    groups = []
+    observed = {}
+    for group in concept_map["group"]:
+        group_id = (group["source"], group["target"])
+        if group_id not in observed:
+            observed[group_id] = group
+            groups.append(group)
+        else:
+            existing = observed[group_id]
+            codes = set(x["code"] for x in existing["element"])
+            for element in group["element"]:
+                if element["code"] not in codes:
+                    codes.add(element["code"])
+                    existing["element"].append(element)
+
+    concept_map["group"] = groups
+
+
 def Exec(argv=None):
     if argv is None:
         argv = sys.argv[1:]
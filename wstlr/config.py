@@ -13,6 +13,17 @@ from wstlr.dd.table import DdTable
 from wstlr import fix_fieldname
 
 from pathlib import Path
+from hashlib import sha256
+import json
+import re
+
+from wstlr.cache import cache_dir, content_hash, write_atomic
+from wstlr.httpcache import http_cache
+from wstlr.version import __version__
+
+# Bump this whenever the DD classes change in a way that would make older
+# cache entries unusable
+dd_cache_version = 3
 
 
 class Configuration:
@@ -25,49 +36,122 @@ class Configuration:
         if self.configuration.get("id_colname") is not None:
             DdTable.default_subject_id(fix_fieldname(self.configuration["id_colname"]))
 
-        # This is the data dictionary study object
-        self.study_dd = None
+        # This is the data dictionary study object. It isn't built until
+        # something asks for it (see study_dd)
+        self._study_dd = None
 
+    @property
+    def study_dd(self):
+        """The parsed data-dictionary.
+
+        Parsing large data-dictionaries is slow, so the result is cached
+        (see wstlr.cache) keyed by the contents of the data-dictionary files
+        and the configuration that affects how they are parsed."""
+        if self._study_dd is None:
+            self._study_dd = self.load_study_dd()
+        return self._study_dd
+
+    @study_dd.setter
+    def study_dd(self, study_dd):
+        self._study_dd = study_dd
+
+    def dd_sources(self):
+        """Returns the list of (table name, filename, colnames) for each of
+        the data-dictionaries in the order in which they are parsed"""
         if "anvil_data_model" in self.configuration:
             model_config = self.configuration["anvil_data_model"]
             die_if(
                 "filename" not in model_config,
                 "anvil_data_model config is missing property, 'filename'.",
             )
+            return [(None, model_config["filename"], model_config.get("colnames", {}))]
+
+        sources = []
+        for table_name, table in self.dataset.items():
+            if "data_dictionary" in table and table.get("hidden") != True:
+                sources.append(
+                    (
+                        table_name,
+                        table["data_dictionary"]["filename"],
+                        table["data_dictionary"].get("colnames", {}),
+                    )
+                )
+        return sources
+
+    def dd_cache_key(self):
+        sources = self.dd_sources()
+
+        # Remote data-dictionaries are keyed by the digest of the copy in
+        # the download cache, which is refreshed if the file has changed
+        digests = []
+        for _, filename, _ in sources:
+            if re.match("^https?:", filename):
+                digests.append(http_cache.get(filename).digest)
+            else:
+                digests.append(content_hash(filename))
+
+        details = {
+            "version": dd_cache_version,
+            "whistler": __version__,
+            "sources": sources,
+            "anvil": "anvil_data_model" in self.configuration,
+            "study_id": self.configuration.get("study_id"),
+            "study_desc": self.configuration.get("study_desc"),
+            "dd_prefix": self.dd_prefix,
+            "subject_id": DdTable.default_subject_id(),
+            "content": digests,
+        }
+        return sha256(json.dumps(details, sort_keys=True).encode()).hexdigest()
+
+    def load_study_dd(self):
+        # The cache holds plain JSON rather than pickles, so that reading an
+        # entry someone else has tampered with can't run anything
+        cachefile = cache_dir("dd") / f"{self.dd_cache_key()}.json"
+        if cachefile.exists():
+            try:
+                with cachefile.open("rt") as f:
+                    return DdStudy.from_state(json.load(f))
+            except Exception:
+                # Anything wrong with the cache entry just means
+                # we parse the files again
+                pass
+
+        study_dd = self.parse_study_dd()
+        write_atomic(cachefile, json.dumps(study_dd.as_state()).encode())
+        return study_dd
+
+    def parse_study_dd(self):
+        if "anvil_data_model" in self.configuration:
+            table_name, filename, colnames = self.dd_sources()[0]
 
             jsonp = JsonParser(
-                filename=model_config["filename"],
+                filename=filename,
                 tables_path="tables",
                 columns_path="columns",
-                colnames=model_config.get("colnames", {}),
+                colnames=colnames,
             )
 
-            self.study_dd = jsonp.study
+            return jsonp.study
 
-        else:
-            self.study_dd = DdStudy(
-                self.study_id, self.study_desc, url_base=self.dd_prefix
-            )
+        study_dd = DdStudy(self.study_id, self.study_desc, url_base=self.dd_prefix)
+
+        csvp = None
+        for table_name, csv_filename, colnames in self.dd_sources():
+            if csvp is None:
+                csvp = CsvParser(
+                    csv_filename,
+                    self.study_id,
+                    self.study_desc,
+                    table_name=table_name,
+                    colnames=colnames,
+                    url_base=self.dd_prefix,
+                )
+            else:
+                csvp.open(csv_filename, name=table_name, colnames=colnames)
 
-            csvp = None
-            for table_name, table in self.dataset.items():
-                if "data_dictionary" in table and table.get("hidden") != True:
-                    csv_filename = table["data_dictionary"]["filename"]
-                    colnames = table["data_dictionary"].get("colnames", {})
-
-                    if csvp is None:
-                        csvp = CsvParser(
-                            csv_filename,
-                            self.study_id,
-                            self.study_desc,
-                            table_name=table_name,
-                            colnames=colnames,
-                            url_base=self.dd_prefix,
-                        )
-                    else:
-                        csvp.open(csv_filename, name=table_name, colnames=colnames)
-
-            self.study_dd = csvp.study
+        if csvp is not None:
+            study_dd = csvp.study
+        return study_dd
 
     def from_config(self, key, default=None, required=False):
         die_if(
@@ -138,6 +222,20 @@ class Configuration:
     def code_harmonization_dir(self):
         return self.from_config("code_harmonization_dir", default="harmony")
 
+    @property
+    def harmony_dd_self_maps(self):
+        return self.from_config("harmony_dd_self_maps", default=True)
+
+    @property
+    def harmony_merge_groups(self):
+        return self.from_config("harmony_merge_groups", default=False)
+
+    @property
+    def compact_code_systems(self):
+        """When true, variables' values are only written to the code-systems
+        and not repeated in the data-dictionary"""
+        return self.from_config("compact_code_systems", default=False)
+
     @property
     def annotations(self):
         return self.from_config("annotations", default={})
@@ -5,6 +5,11 @@ EST 2022-08-17 - I suspect this is something I pulled together to work around
 some of the complexities encountered with DS Connect which should no longer
 apply. I suspect we can delete this altogether, but I haven't confirmed that 
 as of yet. 
+
+The whistle input is read a table row at a time and only as many distinct
+values as could be written out are kept for each variable, so this works for
+large studies, too. See wstlr.dd.profiler (profile-dd) for a more thorough
+profile of the source data.
 """
 
 import json
@@ -14,6 +19,11 @@ from collections import defaultdict
 from pathlib import Path
 import csv
 
+from wstlr.jsonstream import ArrayStream, iter_members
+
+# Variables with at least this many distinct values don't have them listed
+max_values = 50
+
 _codes_produced=defaultdict(int)
 def build_code(prefix, varwidth=6):
     global _codes_produced
@@ -41,7 +51,8 @@ class Variable:
     def add_value(self, value):
         if type(value) is list:
             for entry in value:
-                self.complex_variables[entry['code']][entry['value']] += 1
+                if entry['code'] in self.complex_variables or len(self.complex_variables) < max_values:
+                    self.complex_variables[entry['code']][entry['value']] += 1
         else:
             try:
                 val = float(value)
@@ -51,7 +62,10 @@ class Variable:
                     self.max = val
             except ValueError:
                 pass
-            self.values[value] += 1       
+            # Once there are too many values to list, there is no point in
+            # keeping track of new ones
+            if value in self.values or len(self.values) < max_values:
+                self.values[value] += 1       
 
     @classmethod
     def header(cls, writer):
@@ -71,7 +85,7 @@ class Variable:
 
 
         count_comment = []
-        if len(self.values) < 50:
+        if len(self.values) < max_values:
             for value,count in self.values.items():
                 if value.strip() != "":
                     if len(value) > 20:
@@ -85,7 +99,7 @@ class Variable:
                 count_comment.append(f"{value}={count}")
 
 
-        if len(self.complex_variables) < 50:
+        if len(self.complex_variables) < max_values:
             # We'll capture uniq question:values so that we can have only
             # one present regardless of the number of unique responses there
             # may be to a given set of check-boxes. Those will be different. 
@@ -152,8 +166,8 @@ def exec(args=None):
     output_directory = Path(args.output)
     output_directory.mkdir(parents=True, exist_ok=True)
 
-    content = json.load(args.json_input[0])
-    filename_prefix = Path(args.json_input[0].name).stem
+    input_file = args.json_input[0]
+    filename_prefix = Path(input_file.name).stem
 
     # We don't really want to treat study and code-systems as
     # if they are tables. However, we will attempt to glean
@@ -166,29 +180,31 @@ def exec(args=None):
     original_dd = defaultdict(dict)
 
     current_dd = {}
-    if 'study' in content and 'data-dictionary' in content['study']:
-        for dd in content['study']['data-dictionary']:
-            table_name = dd['table_name']
-            for variable in dd['variables']:
-                varname = variable['varname']
+    for table_name, content in iter_members(input_file):
+        if table_name == 'study':
+            # The study comes first in whistle input, so this will be
+            # ready before we see any of the tables
+            for dd in content.get('data-dictionary', []):
+                table_name = dd['table_name']
+                for variable in dd['variables']:
+                    varname = variable['varname']
 
-                var = Variable(variable['varname'], variable['desc'], code_prefix=args.value_prefix)
-                var.datatype = variable['type']
-                for value in var.values:
-                    code = value['code']
-                    desc = value['description']
+                    var = Variable(variable['varname'], variable['desc'], code_prefix=args.value_prefix)
+                    var.datatype = variable['type']
+                    for value in var.values:
+                        code = value['code']
+                        desc = value['description']
 
-                    if code != desc:
-                        code = f"{code}={desc}"
+                        if code != desc:
+                            code = f"{code}={desc}"
 
-                    var.values[code] = 0
+                        var.values[code] = 0
 
-                original_dd[table_name][variable['varname']] = var
+                    original_dd[table_name][variable['varname']] = var
 
-    for table_name in content:
-        if table_name not in ignored_components:
+        elif table_name not in ignored_components and isinstance(content, ArrayStream):
             current_dd[table_name] = {}
-            for participant in content[table_name]:
+            for participant in content:
                 for varname, value in participant.items():
                     if varname not in current_dd[table_name]:
                         var = None
@@ -212,5 +228,5 @@ def exec(args=None):
                 Variable.header(writer)
                 for varname,var in current_dd[table_name].items():
                     var.write(writer)
-    
-
+            # Nothing more is needed from this table
+            del current_dd[table_name]
@@ -4,13 +4,12 @@ Base class for data-dictionary loaders
 """
 
 import re
-import requests
 from copy import deepcopy 
 
 from wstlr.dd.study import DdStudy
 from wstlr import die_if, system_base
+from wstlr.httpcache import http_cache
 
-from tempfile import TemporaryFile
 import sys
 
 
@@ -55,10 +54,8 @@ class DdLoader:
         # We should support files that start with http: 
         httpx = re.compile("^http[s]*:")
         if httpx.search(filename):
-            response = requests.get(filename)
-            file = TemporaryFile()
-            file.write(response.content)
-            file.seek(0)
+            # Downloads are cached and only fetched again when they change
+            file = http_cache.open_text(filename)
         else:
             file = open(filename, 'rt')
 
@@ -0,0 +1,521 @@
+"""
+Profile the columns of source data to help draft a data-dictionary.
+
+Source CSV files and whistle input JSON files are read a row at a time, and
+each column keeps only a fixed amount of state, no matter how many rows
+there are:
+
+    * counts of the kinds of values seen (integer, decimal, date, boolean or
+      anything else) from which the column's type is inferred
+    * the smallest and largest numbers (or dates)
+    * an approximate count of distinct values (HyperLogLog). Columns with
+      only a handful of values are counted exactly.
+    * the most common values and their counts (top-K)
+
+Each source file is profiled by a separate worker process, so a directory of
+table CSVs is processed in parallel.
+
+    profile-dd data/*.csv --output dd-draft --json profile.json
+
+A draft data-dictionary CSV is written for each table, in the format
+whistler's CSV data-dictionaries use. The values of string and integer
+columns with no more than --max-enumerations distinct values are listed as
+enumerations.
+"""
+
+from __future__ import annotations
+
+import csv
+import hashlib
+import json
+import math
+import re
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from os import PathLike
+from pathlib import Path
+from typing import Any
+
+from rich import print
+
+from wstlr.jsonstream import ArrayStream, iter_members
+
+# Whistle input members that aren't tables
+ignored_components = ["study", "code-systems", "harmony", "config"]
+
+default_top_k = 20
+default_max_enumerations = 50
+
+_integer = re.compile(r"^[+-]?\d+$")
+_date = re.compile(r"^\d{4}-\d{2}-\d{2}([T ][0-9:.+\-Z]*)?$")
+_boolean_values = {"true", "false", "yes", "no"}
+
+# The DD parser splits enumerations on these (see DdVariable.parse_enums)
+# and has no way to escape them, so values containing them can't be written
+_enumeration_separators = (";", "=", "\n")
+
+
+def _number(value: float) -> int | float:
+    return int(value) if value.is_integer() else value
+
+
+class HyperLogLog:
+    """Approximate distinct counts in 2**precision bytes"""
+
+    def __init__(self, precision: int = 12) -> None:
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: str) -> None:
+        hashed = int.from_bytes(
+            hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        # Position of the first 1 bit in what remains of the hash
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: HyperLogLog) -> None:
+        for index, rank in enumerate(other.registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # Linear counting is far more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class TopK:
+    """The most common values seen, using a bounded table of counters.
+
+    When the table fills, the less common half is dropped. Counts for values
+    that were dropped and then seen again are underestimated by at most
+    max_error, so the results are exact as long as nothing was ever dropped.
+    """
+
+    def __init__(self, k: int = default_top_k, capacity: int | None = None) -> None:
+        self.k = k
+        self.capacity = capacity if capacity is not None else max(k * 8, 64)
+        self.counts: dict[str, int] = {}
+        self.max_error = 0
+        self.truncated = False
+
+    def add(self, value: str, count: int = 1) -> None:
+        if value in self.counts:
+            self.counts[value] += count
+            return
+        if len(self.counts) >= self.capacity:
+            self.prune()
+        self.counts[value] = count
+
+    def prune(self) -> None:
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        keep = self.capacity // 2
+        if len(ranked) > keep:
+            self.max_error = max(self.max_error, ranked[keep][1])
+            self.truncated = True
+        self.counts = dict(ranked[:keep])
+
+    def top(self, k: int | None = None) -> list[tuple[str, int]]:
+        ranked = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[: self.k if k is None else k]
+
+
+class ColumnProfile:
+    def __init__(
+        self,
+        name: str,
+        top_k: int = default_top_k,
+        max_enumerations: int = default_max_enumerations,
+        exact_limit: int = 1000,
+    ) -> None:
+        self.name = name
+        self.count = 0
+        self.missing = 0
+
+        # kind => number of values of that kind
+        self.kinds: dict[str, int] = {}
+
+        self.min: float | None = None
+        self.max: float | None = None
+        self.min_date: str | None = None
+        self.max_date: str | None = None
+
+        self.distinct = HyperLogLog()
+        # Exact distinct values until there are too many to be worth keeping
+        self.exact_limit = exact_limit
+        self.exact: set[str] | None = set()
+
+        # The counters must be able to hold every value of a column we may
+        # want to list as an enumeration
+        self.top_values = TopK(top_k, capacity=max(top_k * 8, max_enumerations * 2, 64))
+
+    def add(self, value: Any) -> None:
+        self.count += 1
+        if value is None or (isinstance(value, str) and value.strip() == ""):
+            self.missing += 1
+            return
+
+        if isinstance(value, (list, dict)):
+            self.add_kind("complex")
+            return
+
+        kind = self.classify(value)
+        self.add_kind(kind)
+
+        text = str(value).strip() if not isinstance(value, bool) else str(value).lower()
+        if kind in ("integer", "decimal"):
+            number = float(value)
+            if self.min is None or number < self.min:
+                self.min = number
+            if self.max is None or number > self.max:
+                self.max = number
+        elif kind == "date":
+            if self.min_date is None or text < self.min_date:
+                self.min_date = text
+            if self.max_date is None or text > self.max_date:
+                self.max_date = text
+
+        self.distinct.add(text)
+        if self.exact is not None:
+            self.exact.add(text)
+            if len(self.exact) > self.exact_limit:
+                self.exact = None
+        self.top_values.add(text)
+
+    def add_kind(self, kind: str) -> None:
+        self.kinds[kind] = self.kinds.get(kind, 0) + 1
+
+    @classmethod
+    def classify(cls, value: Any) -> str:
+        if isinstance(value, bool):
+            return "boolean"
+        if isinstance(value, int):
+            return "integer"
+        if isinstance(value, float):
+            return "decimal" if math.isfinite(value) else "string"
+
+        text = str(value).strip()
+        if _integer.match(text):
+            return "integer"
+        try:
+            if math.isfinite(float(text)):
+                return "decimal"
+        except ValueError:
+            pass
+        if _date.match(text):
+            return "date"
+        if text.lower() in _boolean_values:
+            return "boolean"
+        return "string"
+
+    @property
+    def distinct_count(self) -> int:
+        if self.exact is not None:
+            return len(self.exact)
+        return self.distinct.count()
+
+    @property
+    def distinct_is_exact(self) -> bool:
+        return self.exact is not None
+
+    def inferred_type(self) -> str:
+        """The data-dictionary type that best fits every value we saw"""
+        kinds = set(self.kinds)
+        if kinds == {"integer"}:
+            return "integer"
+        if len(kinds) > 0 and kinds <= {"integer", "decimal"}:
+            return "number"
+        if kinds == {"date"}:
+            return "date"
+        if kinds == {"boolean"}:
+            return "boolean"
+        return "string"
+
+    def is_enumerable(self, max_enumerations: int = default_max_enumerations) -> bool:
+        """Whether the column's values are few enough to list them all. Only
+        strings, booleans and (encoded) integers are considered"""
+        return (
+            self.inferred_type() in ("string", "integer", "boolean")
+            and "complex" not in self.kinds
+            and self.distinct_is_exact
+            and not self.top_values.truncated
+            and 0 < self.distinct_count <= max_enumerations
+        )
+
+    def enumerations(self, max_enumerations: int = default_max_enumerations) -> list[str]:
+        if not self.is_enumerable(max_enumerations):
+            return []
+        return [value for value, count in self.top_values.top(max_enumerations)]
+
+    def as_dict(self, max_enumerations: int = default_max_enumerations) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "type": self.inferred_type(),
+            "enumerable": self.is_enumerable(max_enumerations),
+            "count": self.count,
+            "missing": self.missing,
+            "kinds": dict(self.kinds),
+            "min": _number(self.min) if self.min is not None else self.min_date,
+            "max": _number(self.max) if self.max is not None else self.max_date,
+            "distinct": self.distinct_count,
+            "distinct_is_exact": self.distinct_is_exact,
+            "top": [
+                {"value": value, "count": count} for value, count in self.top_values.top()
+            ],
+            "top_is_exact": not self.top_values.truncated,
+        }
+
+
+class TableProfile:
+    def __init__(
+        self,
+        name: str,
+        source: str = "",
+        top_k: int = default_top_k,
+        max_enumerations: int = default_max_enumerations,
+    ) -> None:
+        self.name = name
+        self.source = source
+        self.top_k = top_k
+        self.max_enumerations = max_enumerations
+        self.rows = 0
+        self.columns: dict[str, ColumnProfile] = {}
+
+    def add_row(self, row: dict[str, Any]) -> None:
+        self.rows += 1
+        for colname, value in row.items():
+            # DictReader gives extra values a key of None
+            if colname is None:
+                continue
+            column = self.columns.get(colname)
+            if column is None:
+                column = ColumnProfile(colname, self.top_k, self.max_enumerations)
+                # Catch up on the rows that didn't have this column at all
+                column.count = column.missing = self.rows - 1
+                self.columns[colname] = column
+            column.add(value)
+
+    def finish(self) -> None:
+        """Rows that lack a column altogether count as missing for it"""
+        for column in self.columns.values():
+            if column.count < self.rows:
+                column.missing += self.rows - column.count
+                column.count = self.rows
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "table": self.name,
+            "source": self.source,
+            "rows": self.rows,
+            "columns": [
+                column.as_dict(self.max_enumerations) for column in self.columns.values()
+            ],
+        }
+
+    def write_dd(self, filename: str | PathLike[str]) -> None:
+        """Write a draft data-dictionary in whistler's CSV format"""
+        with open(filename, "wt", newline="") as f:
+            writer = csv.writer(f, delimiter=",", quotechar='"')
+            writer.writerow(
+                [
+                    "variable_name",
+                    "description",
+                    "data_type",
+                    "enumerations",
+                    "min",
+                    "max",
+                    "notes",
+                ]
+            )
+            for column in self.columns.values():
+                summary = column.as_dict(self.max_enumerations)
+                approx = "" if column.distinct_is_exact else "~"
+                notes = (
+                    f"{column.count - column.missing} values, "
+                    f"{column.missing} missing, {approx}{summary['distinct']} distinct"
+                )
+
+                enumerations = []
+                skipped = []
+                for value in column.enumerations(self.max_enumerations):
+                    if any(x in value for x in _enumeration_separators):
+                        skipped.append(value)
+                    else:
+                        enumerations.append(value)
+                if len(skipped) > 0:
+                    print(
+                        f"[yellow]{self.name}.{column.name}: leaving {len(skipped)} "
+                        f"value(s) containing ';', '=' or a newline out of the "
+                        f"enumerations: {', '.join(repr(x) for x in skipped[:5])}[/yellow]"
+                    )
+                    notes += f", {len(skipped)} values left out of the enumerations"
+
+                writer.writerow(
+                    [
+                        column.name,
+                        "",
+                        summary["type"],
+                        ";".join(enumerations),
+                        "" if summary["min"] is None else summary["min"],
+                        "" if summary["max"] is None else summary["max"],
+                        notes,
+                    ]
+                )
+
+
+def profile_csv(
+    filename: str | PathLike[str],
+    table_name: str | None = None,
+    top_k: int = default_top_k,
+    max_enumerations: int = default_max_enumerations,
+) -> list[TableProfile]:
+    if table_name is None:
+        table_name = Path(filename).stem
+    profile = TableProfile(table_name, str(filename), top_k, max_enumerations)
+    with open(filename, "rt", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f, delimiter=",", quotechar='"'):
+            profile.add_row(row)
+    profile.finish()
+    return [profile]
+
+
+def profile_whistle_input(
+    filename: str | PathLike[str],
+    tables: list[str] | None = None,
+    top_k: int = default_top_k,
+    max_enumerations: int = default_max_enumerations,
+) -> list[TableProfile]:
+    """Profile each of the tables found in a whistle input file. Rows are
+    read one at a time, so the file is never loaded in full"""
+    profiles = []
+    with open(filename, "rt", encoding="utf-8") as f:
+        for table_name, content in iter_members(f):
+            if not isinstance(content, ArrayStream):
+                continue
+            if table_name in ignored_components:
+                continue
+            if tables is not None and table_name not in tables:
+                continue
+
+            profile = TableProfile(table_name, str(filename), top_k, max_enumerations)
+            for row in content:
+                if isinstance(row, dict):
+                    profile.add_row(row)
+            profile.finish()
+            profiles.append(profile)
+    return profiles
+
+
+def profile_file(
+    filename: str | PathLike[str],
+    top_k: int = default_top_k,
+    max_enumerations: int = default_max_enumerations,
+) -> list[TableProfile]:
+    if Path(filename).suffix.lower() == ".json":
+        return profile_whistle_input(
+            filename, top_k=top_k, max_enumerations=max_enumerations
+        )
+    return profile_csv(filename, top_k=top_k, max_enumerations=max_enumerations)
+
+
+def profile_files(
+    filenames: list[str | PathLike[str]],
+    workers: int = 1,
+    top_k: int = default_top_k,
+    max_enumerations: int = default_max_enumerations,
+) -> list[TableProfile]:
+    """Profile each file, using up to workers processes at once. The tables
+    are returned in the order the files were given"""
+    if workers <= 1 or len(filenames) < 2:
+        results = [profile_file(filename, top_k, max_enumerations) for filename in filenames]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(filenames))) as executor:
+            results = list(
+                executor.map(
+                    profile_file,
+                    filenames,
+                    [top_k] * len(filenames),
+                    [max_enumerations] * len(filenames),
+                )
+            )
+    return [profile for result in results for profile in result]
+
+
+def print_profiles(profiles: list[TableProfile]) -> None:
+    for profile in profiles:
+        print(f"[green]{profile.name}[/green] ({profile.rows} rows)")
+        for column in profile.columns.values():
+            summary = column.as_dict(profile.max_enumerations)
+            approx = "" if column.distinct_is_exact else "~"
+            print(
+                f"\t{column.name:<32} {summary['type']:<12} "
+                f"{column.missing:>9} missing {approx}{summary['distinct']:>9} distinct"
+            )
+
+
+def exec(args: list[str] | None = None) -> None:
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(
+        description="Profile source CSV files (or whistle input JSON files) "
+        "and write a draft data-dictionary for each table."
+    )
+    parser.add_argument(
+        "source",
+        type=str,
+        nargs="+",
+        help="CSV files (one table each) and/or whistle input JSON files",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="dd-draft",
+        help="Directory where the draft data-dictionaries will be written",
+    )
+    parser.add_argument("--json", type=str, help="Write the full profile to this JSON file")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=4, help="Number of files to profile at once"
+    )
+    parser.add_argument(
+        "--top-k", type=int, default=default_top_k, help="Number of common values to report"
+    )
+    parser.add_argument(
+        "--max-enumerations",
+        type=int,
+        default=default_max_enumerations,
+        help="Columns with more distinct values than this aren't treated as enumerations",
+    )
+    parsed = parser.parse_args(args)
+
+    profiles = profile_files(
+        parsed.source,
+        workers=parsed.workers,
+        top_k=parsed.top_k,
+        max_enumerations=parsed.max_enumerations,
+    )
+
+    output_directory = Path(parsed.output)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    for profile in profiles:
+        filename = output_directory / f"{profile.name}.csv"
+        profile.write_dd(filename)
+        print(f"Writing {filename}")
+
+    if parsed.json is not None:
+        with open(parsed.json, "wt") as f:
+            json.dump([profile.as_dict() for profile in profiles], f, indent=2)
+        print(f"Profile written to {parsed.json}")
+
+    print_profiles(profiles)
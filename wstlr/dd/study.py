@@ -19,6 +19,25 @@ class DdStudy:
                                 None)
         self.tables = {}
 
+    def as_state(self):
+        """The parsed study as plain JSON types, suitable for caching (see
+        from_state)"""
+        state = {x: y for x, y in vars(self).items() if x != "tables"}
+        state["tables"] = [x.as_state() for x in self.tables.values()]
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild the study from as_state() without parsing anything"""
+        study = cls.__new__(cls)
+        for name, value in state.items():
+            if name != "tables":
+                setattr(study, name, value)
+        study.tables = {}
+        for table in state["tables"]:
+            study.tables[table["name"]] = DdTable.from_state(table)
+        return study
+
     def varname_lookup(self, table_name):
         lkup = {}
 
@@ -48,9 +67,9 @@ class DdStudy:
     def add_variable(self, table_name, **kwargs):
         self.tables[table_name].add_variable(**kwargs)
         
-    def table_as_dd(self, table_name):
+    def table_as_dd(self, table_name, compact=False):
         if table_name in self.tables:
-            return self.tables[table_name].obj_as_dd_table()
+            return self.tables[table_name].obj_as_dd_table(compact=compact)
 
     def table_as_cs(self, table_name):
         if table_name in self.tables:
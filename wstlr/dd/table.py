@@ -12,6 +12,20 @@ from wstlr.dd.variable import DdVariable
 _default_subject_id: str = "subject_id"
 
 class DdTable:
+    __slots__ = (
+        "url_base",
+        "name",
+        "description",
+        "study_name",
+        "consent_group",
+        "study_component",
+        "url",
+        "variables",
+        "key",
+        "subject_id",
+        "_values",
+    )
+
     def __init__(self, name: str, study_name: str, description: str = "", **kwargs: Any) -> None:
         self.url_base = kwargs.get("url_base", system_base)
         consent_group = kwargs.get("consent_group")
@@ -35,6 +49,10 @@ class DdTable:
         if self.subject_id is None:
             self.subject_id = DdTable.default_subject_id()
 
+        # The variables' code/description list, shared by the table's dd
+        # entry and its code-system. Reset whenever a variable is added
+        self._values: list[dict[str, Any]] | None = None
+
     @classmethod
     def default_subject_id(cls, colname: str | None = None) -> str | None:
         global _default_subject_id
@@ -43,6 +61,26 @@ class DdTable:
         _default_subject_id = colname
         return None
 
+    def as_state(self) -> dict[str, Any]:
+        """The parsed table, and its variables, as plain JSON types (see
+        from_state)"""
+        state: dict[str, Any] = {
+            x: getattr(self, x) for x in self.__slots__ if not x.startswith("_")
+        }
+        state["variables"] = [x.as_state() for x in self.variables.values()]
+        return state
+
+    @classmethod
+    def from_state(cls, state: dict[str, Any]) -> DdTable:
+        """Rebuild a table from as_state() without parsing it again"""
+        table = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(table, name, state.get(name))
+        table.variables = {}
+        for variable in state["variables"]:
+            table.variables[variable["varname"]] = DdVariable.from_state(variable)
+        return table
+
     def add_to_varname_lookup(self, lkup: dict[str, str]) -> None:
         for varname, variable in self.variables.items():
             variable.add_to_varname_lookup(lkup)
@@ -80,21 +118,26 @@ class DdTable:
         )
 
         self.variables[var.varname] = var
+        self._values = None
         if var.key_component:
             self.key.append(var.varname)
 
+    def values_for_json(self) -> list[dict[str, Any]]:
+        """The table's variables as code/description pairs. Like the
+        variable's values, this is built once and shared, so please don't
+        modify it"""
+        if self._values is None:
+            self._values = [
+                {"code": variable.varname, "description": variable.desc}
+                for variable in self.variables.values()
+            ]
+        return self._values
+
     def obj_as_dd_variable(self) -> dict[str, Any]:
         """Data dictionary variables do not dump their variable's values"""
         """only variable name/desc"""
 
-        values: list[dict[str, Any]] = []
-        for var in self.variables:
-            values.append(
-                {
-                    "code": self.variables[var].varname,
-                    "description": self.variables[var].desc,
-                }
-            )
+        values = self.values_for_json()
         obj = {
             "varname": self.name,
             "desc": self.desc,
@@ -115,12 +158,12 @@ class DdTable:
 
         return variable_cs
 
-    def obj_as_dd_table(self) -> dict[str, Any]:
+    def obj_as_dd_table(self, compact: bool = False) -> dict[str, Any]:
         """Data Dictionary tables list variable's content (but only as code/desc)"""
 
         variables: list[dict[str, Any]] = []
         for var in self.variables:
-            ddvar = self.variables[var].obj_as_dd_variable()
+            ddvar = self.variables[var].obj_as_dd_variable(compact=compact)
             if ddvar is not None:
                 variables.append(ddvar)
 
@@ -129,14 +172,7 @@ class DdTable:
         return obj
 
     def obj_as_cs(self) -> dict[str, Any]:
-        values: list[dict[str, Any]] = []
-        for variable in self.variables:
-            values.append(
-                {
-                    "code": self.variables[variable].varname,
-                    "description": self.variables[variable].desc,
-                }
-            )
+        values = self.values_for_json()
 
         obj = {
             "varname": None,
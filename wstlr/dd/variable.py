@@ -20,6 +20,7 @@ attributes based on the lookup table provided to the table loader.
 from __future__ import annotations
 
 import sys
+from functools import lru_cache
 from typing import Any
 
 from wstlr import (
@@ -31,14 +32,44 @@ from wstlr import (
 )
 
 
+@lru_cache(maxsize=None)
+def _table_system_url(url_base: str, consent_group: str | None, table_name: str) -> str:
+    """Every variable in a table shares the same URL prefix, so build it
+    (and keep a single copy of it) once per table"""
+    return sys.intern(
+        dd_system_url(url_base, "CodeSystem", consent_group, table_name, None)
+    )
+
+
 class DdVariable:
+    # Large studies can have tens of thousands of variables, so we avoid
+    # carrying a __dict__ around for each of them
+    __slots__ = (
+        "url_base",
+        "study_name",
+        "table_name",
+        "varname",
+        "fieldname",
+        "description",
+        "data_type",
+        "enumerations",
+        "consent_group",
+        "study_component",
+        "url",
+        "key_component",
+        "required",
+        "notes",
+        "_values",
+        "_values_details",
+    )
+
     def __init__(
         self, study_name: str, table_name: str, url_base: str = system_base, **kwargs: Any
     ) -> None:
         self.url_base = url_base
 
-        self.study_name = study_name
-        self.table_name = table_name
+        self.study_name = sys.intern(study_name)
+        self.table_name = sys.intern(table_name)
         self.varname = kwargs["variable_name"]
         self.fieldname = fix_fieldname(self.varname)
         self.description = kwargs.get("description", "")
@@ -46,13 +77,14 @@ class DdVariable:
         self.enumerations = self.parse_enums(kwargs.get("enumerations"))
 
         self.consent_group = kwargs.get("consent_group")
-        self.study_component = study_name
+        self.study_component = self.study_name
         if self.consent_group is not None:
-            self.study_component = f"{study_name}-{self.consent_group}"
+            self.consent_group = sys.intern(self.consent_group)
+            self.study_component = sys.intern(f"{study_name}-{self.consent_group}")
 
-        self.url = dd_system_url(
-            self.url_base, "CodeSystem", self.consent_group, table_name, self.varname
-        )
+        # Same as dd_system_url(...varname), but sharing the table's prefix
+        table_url = _table_system_url(self.url_base, self.consent_group, table_name)
+        self.url = f"{table_url}/{fix_fieldname(self.varname)}"
 
         # These are not currently used by Whistler, at least not in this way
         # as of the time of writing this
@@ -60,6 +92,26 @@ class DdVariable:
         self.required = evaluate_bool(kwargs.get("required", False))
         self.notes = kwargs.get("notes", "")
 
+        # The JSON ready fragments are built the first time they are needed
+        # and shared by every whistle input entry that refers to them
+        self._values: list[dict[str, str]] | None = None
+        self._values_details: dict[str, str] | None = None
+
+    def as_state(self) -> dict[str, Any]:
+        """The parsed variable as plain JSON types (see from_state). The JSON
+        fragments are left out; they are rebuilt as they are needed"""
+        return {x: getattr(self, x) for x in self.__slots__ if not x.startswith("_")}
+
+    @classmethod
+    def from_state(cls, state: dict[str, Any]) -> DdVariable:
+        """Rebuild a variable from as_state() without parsing it again"""
+        variable = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(variable, name, state.get(name))
+        variable.study_name = sys.intern(variable.study_name)
+        variable.table_name = sys.intern(variable.table_name)
+        return variable
+
     def add_to_varname_lookup(self, lkup: dict[str, str]) -> None:
         desc = self.desc
 
@@ -115,20 +167,27 @@ class DdVariable:
 
         return transformed_values
 
-    def obj_as_dd_variable(self) -> dict[str, Any]:
-        """Build out dd entries for the variable's whistle input"""
-        obj = {
+    def obj_as_dd_variable(self, compact: bool = False) -> dict[str, Any]:
+        """Build out dd entries for the variable's whistle input
+
+        When compact is True, the values themselves are left out since the
+        same values are found in the variable's code-system entry (at
+        values-url). Only the number of values, values-count, is kept."""
+        obj: dict[str, Any] = {
             "varname": self.varname,
             "desc": self.desc,
             "type": self.data_type,
-            "values": self.values_for_json(),
         }
-        if len(obj["values"]) > 0:
+        if compact:
+            value_count = len(self.enumerations)
+            obj["values-count"] = value_count
+        else:
+            obj["values"] = self.values_for_json()
+            value_count = len(obj["values"])
+
+        if value_count > 0:
             obj["values-url"] = self.url
-            obj["values-details"] = {
-                "table-name": self.table_name,
-                "varname": self.varname,
-            }
+            obj["values-details"] = self.values_details()
         return obj
 
     def obj_as_dd(self) -> dict[str, Any]:
@@ -141,10 +200,7 @@ class DdVariable:
         }
         if len(obj["values"]) > 0:
             obj["values-url"] = self.url
-            obj["values-details"] = {
-                "table-name": self.table_name,
-                "varname": self.varname,
-            }
+            obj["values-details"] = self.values_details()
         return obj
 
     def obj_as_cs(self) -> dict[str, Any]:
@@ -164,15 +220,27 @@ class DdVariable:
             obj["consent_group"] = self.consent_group
         return obj
 
+    def values_details(self) -> dict[str, str]:
+        if self._values_details is None:
+            self._values_details = {
+                "table-name": self.table_name,
+                "varname": self.varname,
+            }
+        return self._values_details
+
     def values_for_json(self) -> list[dict[str, str]]:
-        """Build out the values suitable for adding to json object"""
-        values: list[dict[str, str]] = []
+        """Build out the values suitable for adding to json object
 
-        for code in self.enumerations:
-            desc = self.enumerations[code]
+        The list is built once and then shared by each caller (the variable's
+        dd entry and its code-system both point to the same one), so please
+        don't modify it."""
+        if self._values is None:
+            values: list[dict[str, str]] = []
 
-            if desc is None or desc == "None" or desc.strip() == "":
-                desc = code
-            values.append({"code": code, "description": desc})
+            for code, desc in self.enumerations.items():
+                if desc is None or desc == "None" or desc.strip() == "":
+                    desc = code
+                values.append({"code": code, "description": desc})
+            self._values = values
 
-        return values
+        return self._values
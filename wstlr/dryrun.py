@@ -0,0 +1,142 @@
+"""
+Support for running the loader without a FHIR server (play --dry-run-load)
+
+NullFhirClient stands in for FhirClient. It accepts every resource and
+assigns a synthetic ID, so everything the loader does on our side of the
+wire (module/resource filtering, build_references, identifier extraction,
+ID caching and the StudyIDs bookkeeping) runs as it would during a real
+load. The resulting rate is the best we can hope for from the Python side,
+and any references that fail to resolve are reported without ever having
+touched a server.
+
+The synthetic IDs are meaningless outside of the run, so they live in an
+in-memory cache (MemoryIdCache) rather than the usual RIdCache.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+from copy import deepcopy
+from itertools import count
+from threading import Lock
+from typing import Any
+
+from rich import print
+
+from wstlr.load import InvalidReference, build_references
+
+
+class MemoryIdCache:
+    """Implements the parts of RIdCache used by the loader"""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+
+        # system => value => (resourceType, id)
+        self.ids: defaultdict[str, dict[str, tuple[str, str]]] = defaultdict(dict)
+
+    def get_id(self, system: str, value: str) -> tuple[str, str] | None:
+        with self.lock:
+            return self.ids[system].get(value)
+
+    def store_id(
+        self, resource_type: str, system: str, value: str, id: str, no_db: bool = False
+    ) -> None:
+        with self.lock:
+            self.ids[system][value] = (resource_type, id)
+
+
+class NullFhirClient:
+    """Accepts everything without making any requests"""
+
+    target_service_url = "dry-run://null"
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.next_id: defaultdict[str, count[int]] = defaultdict(lambda: count(1))
+
+        # resourceType => number of resources "written"
+        self.requests: defaultdict[str, int] = defaultdict(int)
+
+    def assign_id(self, resource_type: str, resource: dict[str, Any]) -> dict[str, Any]:
+        with self.lock:
+            self.requests[resource_type] += 1
+            if "id" in resource:
+                id = resource["id"]
+            else:
+                id = f"dry-{resource_type.lower()}-{next(self.next_id[resource_type])}"
+
+        response = dict(resource)
+        response["id"] = id
+        return response
+
+    def result(
+        self, resource_type: str, resource: dict[str, Any], validate_only: bool
+    ) -> dict[str, Any]:
+        if validate_only:
+            return {
+                "status_code": 200,
+                "request_url": f"{self.target_service_url}/{resource_type}/$validate",
+                "response": {"resourceType": "OperationOutcome", "issue": []},
+            }
+
+        response = self.assign_id(resource_type, resource)
+        return {
+            "status_code": 201,
+            "request_url": f"{self.target_service_url}/{resource_type}/{response['id']}",
+            "response": response,
+        }
+
+    def load(
+        self, resource_type: str, resource: dict[str, Any], validate_only: bool = False
+    ) -> dict[str, Any]:
+        return self.result(resource_type, resource, validate_only)
+
+    def post(
+        self,
+        resource_type: str,
+        resource: dict[str, Any],
+        identifier: str | None = None,
+        identifier_system: str | None = None,
+        identifier_type: str | None = None,
+        validate_only: bool = False,
+        retry_count: int = 1,
+    ) -> dict[str, Any]:
+        return self.result(resource_type, resource, validate_only)
+
+
+def unresolved_references(
+    delayed_loading: list[tuple[str, dict[str, Any]]], idcache: Any
+) -> dict[str, int]:
+    """Returns each reference that couldn't be resolved along with the
+    number of resources that were stuck on it"""
+    problems: defaultdict[str, int] = defaultdict(int)
+    for group_name, resource in delayed_loading:
+        try:
+            build_references(deepcopy(resource), idcache)
+        except InvalidReference as e:
+            problems[f"{resource['resourceType']}: {e.message()}"] += 1
+    return problems
+
+
+def print_dry_run_summary(loader: Any, elapsed: float, max_problems: int = 25) -> None:
+    total = sum(loader.resource_summary.values())
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(
+        f"\nDry run: {total} resources processed in {elapsed:.2f}s "
+        f"([green]{rate:.1f} resources/s[/green]). No data was sent to a server."
+    )
+
+    if len(loader.delayed_loading) == 0:
+        print("All references were resolved.")
+        return
+
+    problems = unresolved_references(loader.delayed_loading, loader.idcache)
+    print(
+        f"[red]{len(loader.delayed_loading)} resources have references that "
+        f"couldn't be resolved[/red]"
+    )
+    for problem, resource_count in sorted(problems.items())[:max_problems]:
+        print(f"\t{resource_count:>7} {problem}")
+    if len(problems) > max_problems:
+        print(f"\t... and {len(problems) - max_problems} more")
@@ -11,6 +11,7 @@ from collections import defaultdict
 from copy import deepcopy
 from wstlr.conceptmap import ObjectifyHarmony
 from wstlr.embedable import EmbedableTable
+from wstlr.harmonystore import load_harmony
 from wstlr import dd_system_url, StandardizeDdType, clean_values, fix_fieldname
 
 from wstlr import system_base, InvalidType
@@ -273,13 +274,7 @@ def DataCsvToObject(config):
 
         code_details = {}
         if "code_harmonization" in table:
-            with open(table["code_harmonization"], "rt") as f:
-                reader = csv.DictReader(f, delimiter=",", quotechar='"')
-
-                for row in reader:
-                    if "display" not in row:
-                        print(row)
-                    code_details[row["local code"]] = row["display"]
+            code_details = load_harmony(table["code_harmonization"]).code_details()
         if "data_dictionary" in table:
             if table["data_dictionary"]["filename"].lower() != "none":
                 with open(
@@ -292,7 +287,9 @@ def DataCsvToObject(config):
                 # Unlike data, we don't want data-dictionary components
                 # disappearing due to inactive tables. That control is
                 # intended for data loading
-                table_dd = config.study_dd.table_as_dd(category)
+                table_dd = config.study_dd.table_as_dd(
+                    category, compact=config.compact_code_systems
+                )
                 if table_dd:
                     dataset["study"]["data-dictionary"].append(table_dd)
 
@@ -0,0 +1,643 @@
+"""
+Validate whistle output against the IG's profiles without a FHIR server.
+
+Sending each resource to the server's $validate is far too slow for a whole
+study, which is why play --validate-only only validates a sample of each
+resourceType (--max-validations). Most of what goes wrong in a projection,
+though, is structural: a missing required element, too many of something,
+a value of the wrong type, a code that isn't in a required ValueSet. Those
+can be checked locally from the StructureDefinitions themselves.
+
+The StructureDefinitions (along with the ValueSets and CodeSystems used by
+their required bindings) are read from the same IG packages igload loads,
+using the same YAML content file. Each profile's snapshot is compiled into
+a set of rules, grouped by the path of the element they apply to:
+
+    * cardinality (min/max)
+    * type, including choice elements (value[x]) and the format of
+      primitives such as dates, ids and positive integers
+    * fixed[x] and pattern[x] values
+    * required bindings, for ValueSets that can be expanded from the IG's
+      own ValueSets and CodeSystems (those using filters or codes from
+      elsewhere aren't checked)
+    * the resourceTypes a Reference may point to
+
+Slices aren't checked, only the elements they belong to. Resources are
+checked against the profiles listed in their meta.profile, or a default
+profile for their resourceType (--default-profile Type=url). Anything else
+isn't validated. Resources are spread across worker processes the same way as
+inspectjson --inspect-workers (see wstlr.parallel_inspection).
+
+    validate-fhir -c ig.yaml output/whistle.output.json --report problems.csv
+
+play --local-validation ig.yaml runs the same checks before loading. The
+server's $validate is then only worth running for a small sample.
+"""
+
+from __future__ import annotations
+
+import re
+import sys
+from argparse import ArgumentParser, FileType
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+
+from rich import print
+from yaml import safe_load
+
+from wstlr.httpcache import add_http_cache_arguments, set_offline
+from wstlr.inspection_report import InspectionReport
+from wstlr.parallel_inspection import iter_share
+
+definition_types = ["StructureDefinition", "ValueSet", "CodeSystem"]
+
+core_profile_prefix = "http://hl7.org/fhir/StructureDefinition/"
+
+_date = r"\d{4}(-(0[1-9]|1[0-2])(-(0[1-9]|[12]\d|3[01]))?)?"
+_time = r"([01]\d|2[0-3]):[0-5]\d:([0-5]\d|60)(\.\d+)?"
+_zone = r"(Z|[+-]((0\d|1[0-3]):[0-5]\d|14:00))"
+
+# Primitive types => the pattern their values must match
+primitive_formats = {
+    "date": re.compile(f"^{_date}$"),
+    "dateTime": re.compile(
+        r"^\d{4}(-(0[1-9]|1[0-2])(-(0[1-9]|[12]\d|3[01])" f"(T{_time}{_zone})?)?)?$"
+    ),
+    "instant": re.compile(
+        r"^\d{4}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])" f"T{_time}{_zone}$"
+    ),
+    "time": re.compile(f"^{_time}$"),
+    "id": re.compile(r"^[A-Za-z0-9\-\.]{1,64}$"),
+    "code": re.compile(r"^[^\s]+( [^\s]+)*$"),
+}
+
+string_types = {
+    "string",
+    "code",
+    "id",
+    "uri",
+    "url",
+    "canonical",
+    "oid",
+    "uuid",
+    "markdown",
+    "base64Binary",
+    "date",
+    "dateTime",
+    "instant",
+    "time",
+    "xhtml",
+    "integer64",
+    "http://hl7.org/fhirpath/System.String",
+}
+integer_types = {"integer", "unsignedInt", "positiveInt", "http://hl7.org/fhirpath/System.Integer"}
+decimal_types = {"decimal", "http://hl7.org/fhirpath/System.Decimal"}
+boolean_types = {"boolean", "http://hl7.org/fhirpath/System.Boolean"}
+
+reference_type_rx = re.compile(r"^([A-Z][A-Za-z]+)[/?]")
+
+
+def type_matches(value: Any, code: str) -> bool:
+    """Does the value fit the type? Types we don't know about always fit"""
+    if code in string_types:
+        if type(value) is not str:
+            return False
+        rx = primitive_formats.get(code)
+        return rx is None or rx.match(value) is not None
+    if code in integer_types:
+        if type(value) is not int:
+            return False
+        if code == "positiveInt":
+            return value > 0
+        if code == "unsignedInt":
+            return value >= 0
+        return True
+    if code in decimal_types:
+        return type(value) in (int, float)
+    if code in boolean_types:
+        return type(value) is bool
+    if code.startswith("http://"):
+        return True
+    # Everything else (datatypes, BackboneElement, Resource) is an object
+    return type(value) is dict
+
+
+def matches_pattern(value: Any, pattern: Any) -> bool:
+    """Everything in the pattern must be present in the value, which may
+    have more besides"""
+    if type(pattern) is dict:
+        if type(value) is not dict:
+            return False
+        return all(k in value and matches_pattern(value[k], v) for k, v in pattern.items())
+    if type(pattern) is list:
+        values = value if type(value) is list else [value]
+        return all(any(matches_pattern(x, p) for x in values) for p in pattern)
+    return value == pattern
+
+
+@dataclass
+class ValueSetCodes:
+    # (system, code)
+    codings: frozenset[tuple[str, str]]
+    # For codes without a system (and plain code elements)
+    codes: frozenset[str] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.codes = frozenset(code for _, code in self.codings)
+
+    def contains(self, value: Any) -> bool:
+        if type(value) is str:
+            return value in self.codes
+        if type(value) is not dict:
+            return False
+        if "coding" in value:
+            codings = value["coding"] if type(value["coding"]) is list else [value["coding"]]
+            return any(self.contains(x) for x in codings)
+        if "code" not in value:
+            return False
+        if "system" in value:
+            return (value["system"], value["code"]) in self.codings
+        return value["code"] in self.codes
+
+
+def strip_version(url: str) -> str:
+    return url.split("|")[0]
+
+
+def code_system_codes(code_system: dict[str, Any]) -> set[str] | None:
+    """Every code in a complete CodeSystem, None for one that isn't"""
+    if code_system.get("content", "complete") != "complete":
+        return None
+    codes = set()
+    pending = list(code_system.get("concept", []))
+    while len(pending) > 0:
+        concept = pending.pop()
+        codes.add(concept["code"])
+        pending += concept.get("concept", [])
+    return codes
+
+
+def expand(
+    url: str,
+    value_sets: dict[str, dict[str, Any]],
+    code_systems: dict[str, dict[str, Any]],
+    expanding: frozenset[str] = frozenset(),
+) -> ValueSetCodes | None:
+    """The codes in the ValueSet, as far as the IG alone can tell us. None
+    if that isn't far enough"""
+    value_set = value_sets.get(url)
+    if value_set is None or url in expanding:
+        return None
+
+    if "expansion" in value_set and "contains" in value_set["expansion"]:
+        codings = set()
+        pending = list(value_set["expansion"]["contains"])
+        while len(pending) > 0:
+            item = pending.pop()
+            if "code" in item:
+                codings.add((item.get("system", ""), item["code"]))
+            pending += item.get("contains", [])
+        return ValueSetCodes(frozenset(codings))
+
+    compose = value_set.get("compose", {})
+    included: set[tuple[str, str]] = set()
+    for include in compose.get("include", []):
+        if "filter" in include:
+            return None
+        if "valueSet" in include:
+            if "system" in include:
+                return None
+            for other in include["valueSet"]:
+                nested = expand(strip_version(other), value_sets, code_systems, expanding | {url})
+                if nested is None:
+                    return None
+                included |= nested.codings
+        elif "concept" in include:
+            included |= {(include.get("system", ""), x["code"]) for x in include["concept"]}
+        elif "system" in include:
+            code_system = code_systems.get(include["system"])
+            if code_system is None:
+                return None
+            system_codes = code_system_codes(code_system)
+            if system_codes is None:
+                return None
+            included |= {(include["system"], x) for x in system_codes}
+
+    for exclude in compose.get("exclude", []):
+        if "concept" not in exclude:
+            return None
+        included -= {(exclude.get("system", ""), x["code"]) for x in exclude["concept"]}
+    return ValueSetCodes(frozenset(included))
+
+
+def type_suffix(code: str) -> str:
+    """How the type appears at the end of a choice element's name"""
+    return code[0].upper() + code[1:]
+
+
+@dataclass
+class ElementRule:
+    path: str
+    name: str
+    min: int
+    max: int | None
+    types: tuple[str, ...] = ()
+    target_types: frozenset[str] = frozenset()
+    fixed: Any = None
+    has_fixed: bool = False
+    pattern: Any = None
+    has_pattern: bool = False
+    value_set: str | None = None
+
+    @property
+    def is_choice(self) -> bool:
+        return self.name.endswith("[x]")
+
+    def values(self, node: dict[str, Any]) -> list[tuple[str, Any]]:
+        """(type, value) for each of the element's values in the node. The
+        type is only known for choice elements, otherwise it is empty"""
+        if self.is_choice:
+            prefix = self.name[:-3]
+            values = []
+            for key, value in node.items():
+                if key.startswith(prefix) and key[len(prefix) : len(prefix) + 1].isupper():
+                    for item in value if type(value) is list else [value]:
+                        values.append((key[len(prefix) :], item))
+            return values
+
+        value = node.get(self.name)
+        if value is None:
+            return []
+        return [("", x) for x in (value if type(value) is list else [value])]
+
+
+@dataclass
+class CompiledProfile:
+    url: str
+    name: str
+    type: str
+
+    # parent path => rules for its children
+    children: dict[str, list[ElementRule]] = field(default_factory=dict)
+
+
+def compile_element(element: dict[str, Any], profile_types: dict[str, str]) -> ElementRule:
+    path = element["path"]
+    max_value = element.get("max", "*")
+    rule = ElementRule(
+        path=path,
+        name=path.rsplit(".", 1)[1],
+        min=element.get("min", 0),
+        max=None if max_value == "*" else int(max_value),
+        types=tuple(x["code"] for x in element.get("type", []) if "code" in x),
+    )
+
+    targets = set()
+    for element_type in element.get("type", []):
+        for target in element_type.get("targetProfile", []):
+            target = strip_version(target)
+            if target.startswith(core_profile_prefix):
+                targets.add(target[len(core_profile_prefix) :])
+            elif target in profile_types:
+                targets.add(profile_types[target])
+            else:
+                # Can't tell what it is, so anything goes
+                targets.add("Resource")
+    if "Resource" not in targets:
+        rule.target_types = frozenset(targets)
+
+    for key, value in element.items():
+        if key.startswith("fixed"):
+            rule.fixed, rule.has_fixed = value, True
+        elif key.startswith("pattern"):
+            rule.pattern, rule.has_pattern = value, True
+
+    binding = element.get("binding", {})
+    if binding.get("strength") == "required" and "valueSet" in binding:
+        rule.value_set = strip_version(binding["valueSet"])
+    return rule
+
+
+def compile_profile(
+    structure_definition: dict[str, Any], profile_types: dict[str, str]
+) -> CompiledProfile:
+    profile = CompiledProfile(
+        url=structure_definition["url"],
+        name=structure_definition.get("name", structure_definition["url"]),
+        type=structure_definition["type"],
+    )
+    for element in structure_definition.get("snapshot", {}).get("element", []):
+        path = element["path"]
+        # Slices (and anything inside of them) aren't checked
+        if ":" in element.get("id", "") or "." not in path:
+            continue
+        rule = compile_element(element, profile_types)
+        profile.children.setdefault(path.rsplit(".", 1)[0], []).append(rule)
+    return profile
+
+
+class ProfileValidator:
+    def __init__(
+        self,
+        definitions: Iterable[dict[str, Any]],
+        default_profiles: dict[str, str] | None = None,
+    ) -> None:
+        structure_definitions = []
+        value_sets = {}
+        code_systems = {}
+        for resource in definitions:
+            resource_type = resource.get("resourceType")
+            if resource_type == "StructureDefinition":
+                if resource.get("kind") == "resource" and "snapshot" in resource:
+                    structure_definitions.append(resource)
+            elif resource_type == "ValueSet" and "url" in resource:
+                value_sets[resource["url"]] = resource
+            elif resource_type == "CodeSystem" and "url" in resource:
+                code_systems[resource["url"]] = resource
+
+        profile_types = {x["url"]: x["type"] for x in structure_definitions}
+        self.profiles = {
+            x["url"]: compile_profile(x, profile_types) for x in structure_definitions
+        }
+
+        # resourceType => profile url, for resources without a meta.profile
+        self.default_profiles = default_profiles or {}
+
+        # url => codes, or None if it can't be expanded
+        self.value_sets: dict[str, ValueSetCodes | None] = {}
+        for profile in self.profiles.values():
+            for rules in profile.children.values():
+                for rule in rules:
+                    if rule.value_set is not None and rule.value_set not in self.value_sets:
+                        self.value_sets[rule.value_set] = expand(
+                            rule.value_set, value_sets, code_systems
+                        )
+
+    @property
+    def unexpanded_value_sets(self) -> list[str]:
+        return sorted(url for url, codes in self.value_sets.items() if codes is None)
+
+    def profiles_for(self, resource: dict[str, Any]) -> list[CompiledProfile]:
+        urls = [strip_version(x) for x in resource.get("meta", {}).get("profile", [])]
+        if len(urls) == 0 and resource.get("resourceType") in self.default_profiles:
+            urls = [self.default_profiles[resource["resourceType"]]]
+        return [self.profiles[x] for x in urls if x in self.profiles]
+
+    def check_value(
+        self, profile: CompiledProfile, rule: ElementRule, value_type: str, value: Any
+    ) -> list[tuple[str, str]]:
+        """(problem, message) for each problem with one of the element's
+        values. What's inside of it is checked separately"""
+        problems = []
+        if value_type != "":
+            types = {type_suffix(x): x for x in rule.types}
+            if value_type not in types:
+                return [("type", f"{rule.path} must be one of: {', '.join(rule.types)}")]
+            codes: Iterable[str] = [types[value_type]]
+        else:
+            codes = rule.types
+        if len(rule.types) > 0 and not any(type_matches(value, x) for x in codes):
+            problems.append(("type", f"{rule.path} must be {' or '.join(rule.types)}"))
+
+        if rule.has_fixed and value != rule.fixed:
+            problems.append(("fixed", f"{rule.path} must be exactly {rule.fixed}"))
+        if rule.has_pattern and not matches_pattern(value, rule.pattern):
+            problems.append(("pattern", f"{rule.path} must match {rule.pattern}"))
+
+        if rule.value_set is not None:
+            codes_in_set = self.value_sets.get(rule.value_set)
+            if codes_in_set is not None and not codes_in_set.contains(value):
+                problems.append(("binding", f"{rule.path} must come from {rule.value_set}"))
+
+        if len(rule.target_types) > 0 and type(value) is dict and "reference" in value:
+            match = reference_type_rx.match(str(value["reference"]))
+            if match is not None and match.group(1) not in rule.target_types:
+                problems.append(
+                    (
+                        "reference",
+                        f"{rule.path} must refer to {' or '.join(sorted(rule.target_types))}",
+                    )
+                )
+        return problems
+
+    def check_node(
+        self, profile: CompiledProfile, path: str, node: dict[str, Any]
+    ) -> list[tuple[str, str]]:
+        """(rule, message) for each problem with the node, which is found at
+        path in the profile"""
+        problems = []
+        for rule in profile.children.get(path, []):
+            values = rule.values(node)
+            if len(values) < rule.min or (rule.max is not None and len(values) > rule.max):
+                maximum = "*" if rule.max is None else rule.max
+                problems.append(
+                    (
+                        f"{rule.path} cardinality",
+                        f"{rule.path} must appear {rule.min}..{maximum} times",
+                    )
+                )
+            for value_type, value in values:
+                for problem, message in self.check_value(profile, rule, value_type, value):
+                    problems.append((f"{rule.path} {problem}", message))
+                if type(value) is dict and rule.path in profile.children:
+                    problems += self.check_node(profile, rule.path, value)
+        return problems
+
+    def check(self, resource: dict[str, Any]) -> tuple[int, list[tuple[str, str]]]:
+        """Returns the number of profiles the resource was checked against
+        and (rule, message) for each problem found"""
+        profiles = self.profiles_for(resource)
+        problems = []
+        for profile in profiles:
+            if resource.get("resourceType") != profile.type:
+                problems.append(
+                    ("resourceType", f"{profile.url} is a profile of {profile.type}")
+                )
+                continue
+            problems += self.check_node(profile, profile.type, resource)
+        return len(profiles), problems
+
+
+@dataclass
+class ValidationTask:
+    filenames: list[str]
+    worker: int
+    workers: int
+    validator: ProfileValidator
+    batch_size: int = 1000
+
+
+@dataclass
+class ValidationResult:
+    report: InspectionReport
+    # resourceType => count
+    validated: Counter[str] = field(default_factory=Counter)
+    unvalidated: Counter[str] = field(default_factory=Counter)
+
+    def merge(self, other: ValidationResult) -> None:
+        self.report.merge(other.report)
+        self.validated.update(other.validated)
+        self.unvalidated.update(other.unvalidated)
+
+    def print_summary(self) -> None:
+        print("\nResource Type            Validated Not Validated")
+        print("------------------------ --------- -------------")
+        for resource_type in sorted(set(self.validated) | set(self.unvalidated)):
+            print(
+                f"{resource_type:<24} {self.validated[resource_type]:<9} "
+                f"{self.unvalidated[resource_type]}"
+            )
+        self.report.print_report()
+
+
+def validate_share(task: ValidationTask) -> ValidationResult:
+    result = ValidationResult(InspectionReport())
+    shared = iter_share(task.filenames, task.worker, task.workers, task.batch_size)
+    for module, resource in shared:
+        resource_type = resource.get("resourceType", "")
+        profile_count, problems = task.validator.check(resource)
+        if profile_count == 0:
+            result.unvalidated[resource_type] += 1
+            continue
+        result.validated[resource_type] += 1
+        for rule, message in problems:
+            result.report.add(module, rule, resource, message)
+    return result
+
+
+def validate_output(
+    filenames: list[str], validator: ProfileValidator, workers: int = 4
+) -> ValidationResult:
+    tasks = [ValidationTask(filenames, worker, workers, validator) for worker in range(workers)]
+    result = ValidationResult(InspectionReport())
+    if workers <= 1:
+        result.merge(validate_share(tasks[0]))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for share in executor.map(validate_share, tasks):
+                result.merge(share)
+    return result
+
+
+def load_definitions(content: dict[str, Any]) -> list[dict[str, Any]]:
+    """The StructureDefinitions, ValueSets and CodeSystems from each of the
+    sources in an igload content file"""
+    # Importing wstlr.igload brings in the FHIR client, which validation
+    # doesn't otherwise need
+    from wstlr.igload import file_source, ig_source
+
+    definitions = []
+    for key, config in content.items():
+        if config["source_type"] == "IG":
+            package = ig_source.IgPackage(config)
+            selected, _ = package.select(definition_types)
+            for filename, _ in selected:
+                resource = package.read(filename)
+                if resource is not None:
+                    definitions.append(resource)
+            package.close()
+        elif config["source_type"] == "FILES":
+            definitions += [
+                x
+                for x in file_source.load_resources(config).values()
+                if x.get("resourceType") in definition_types
+            ]
+    return definitions
+
+
+def parse_default_profiles(values: list[str] | None) -> dict[str, str]:
+    defaults = {}
+    for value in values or []:
+        resource_type, _, url = value.partition("=")
+        defaults[resource_type.strip()] = url.strip()
+    return defaults
+
+
+def build_validator(content_file: Any, default_profiles: list[str] | None = None) -> ProfileValidator:
+    validator = ProfileValidator(
+        load_definitions(safe_load(content_file)), parse_default_profiles(default_profiles)
+    )
+    print(f"Compiled {len(validator.profiles)} profiles")
+    unexpanded = validator.unexpanded_value_sets
+    if len(unexpanded) > 0:
+        print(
+            f"[yellow]{len(unexpanded)} required ValueSets can't be expanded from the "
+            f"IG alone and won't be checked[/yellow]"
+        )
+    return validator
+
+
+def add_default_profile_argument(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--default-profile",
+        type=str,
+        action="append",
+        help="ResourceType=url of the profile to validate resources without a "
+        "meta.profile against. May be specified more than once",
+    )
+
+
+def add_local_validation_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--local-validation",
+        type=FileType("rt"),
+        default=None,
+        help="igload content file (YAML) for the IG(s) with the profiles to "
+        "validate the whistle output against before loading. Loading stops if "
+        "there are any problems",
+    )
+    parser.add_argument(
+        "--local-validation-report",
+        type=str,
+        default=None,
+        help="Write the problems found by --local-validation to this file (JSON, "
+        "or CSV if the name ends with .csv)",
+    )
+    parser.add_argument(
+        "--local-validation-workers",
+        type=int,
+        default=4,
+        help="Number of processes to validate with",
+    )
+    add_default_profile_argument(parser)
+
+
+def exec(args: list[str] | None = None) -> None:
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(
+        description="Validate whistle output against the profiles from an IG "
+        "without sending anything to a FHIR server."
+    )
+    parser.add_argument(
+        "-c",
+        "--content",
+        type=FileType("rt"),
+        required=True,
+        help="YAML file (as used by igload) describing the IG(s) with the profiles",
+    )
+    parser.add_argument("file", nargs="+", help="JSON output from Whistle to be validated.")
+    add_default_profile_argument(parser)
+    parser.add_argument(
+        "-w", "--workers", type=int, default=4, help="Number of processes to validate with"
+    )
+    parser.add_argument(
+        "--report", type=str, help="Write the problems to this file (JSON, or CSV if the name ends with .csv)"
+    )
+    add_http_cache_arguments(parser)
+    parsed = parser.parse_args(args)
+    set_offline(parsed.offline)
+
+    validator = build_validator(parsed.content, parsed.default_profile)
+    result = validate_output(parsed.file, validator, workers=parsed.workers)
+    result.print_summary()
+    if parsed.report is not None:
+        result.report.save(parsed.report)
+        print(f"Report written to {parsed.report}")
+
+    if len(result.report) > 0:
+        sys.exit(1)
@@ -0,0 +1,219 @@
+"""
+Compact sets of identifiers for spotting duplicates in large outputs.
+
+Keeping every "system:value" string in a Python set costs well over a
+hundred bytes per resource, which adds up to gigabytes for outputs with
+millions of resources. Instead, each identifier is reduced to a 64 (or 128)
+bit fingerprint and the fingerprints are kept in an open addressing hash
+table backed by an array of machine words, i.e. 8 or 16 bytes per slot.
+
+With 64 bits, the odds of two different identifiers sharing a fingerprint
+are about n^2 / 2^65: roughly one in four hundred thousand for ten million
+identifiers. Use 128 bits if that isn't good enough.
+
+For even less memory, TwoPassIdentifierSet does the first pass with a Bloom
+filter (about ten bits per identifier), which only remembers the
+fingerprints of possible duplicates. A second pass over the same resources
+then confirms those against the identifiers themselves, so there are no
+false positives at all.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import math
+from array import array
+from collections.abc import Iterator
+
+_mask64 = (1 << 64) - 1
+
+
+def fingerprint(key: str, bits: int = 64) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=bits // 8).digest(), "little"
+    )
+
+
+class FingerprintSet:
+    """A set of 64 or 128 bit integers. Zero marks an empty slot, so a
+    fingerprint of zero is stored as one"""
+
+    max_load = 0.7
+
+    def __init__(self, capacity: int = 1024, bits: int = 64) -> None:
+        assert bits in (64, 128)
+        self.bits = bits
+        self.words = bits // 64
+        self.size = 0
+        slots = 16
+        while slots * self.max_load < capacity:
+            slots *= 2
+        self._allocate(slots)
+
+    def _allocate(self, slots: int) -> None:
+        self.slots = slots
+        self.mask = slots - 1
+        self.table = array("Q", bytes(8 * slots * self.words))
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.itemsize * len(self.table)
+
+    def _split(self, value: int) -> tuple[int, int]:
+        if value == 0:
+            value = 1
+        return value & _mask64, (value >> 64) & _mask64
+
+    def _find(self, low: int, high: int) -> tuple[int, bool]:
+        """The slot holding the value (True) or the empty slot it belongs in
+        (False)"""
+        table = self.table
+        words = self.words
+        index = low & self.mask
+        while True:
+            position = index * words
+            current = table[position]
+            if current == 0 and (words == 1 or table[position + 1] == 0):
+                return index, False
+            if current == low and (words == 1 or table[position + 1] == high):
+                return index, True
+            index = (index + 1) & self.mask
+
+    def add(self, value: int) -> bool:
+        """Add the value, returning True if it was already present"""
+        low, high = self._split(value)
+        index, found = self._find(low, high)
+        if found:
+            return True
+
+        position = index * self.words
+        self.table[position] = low
+        if self.words == 2:
+            self.table[position + 1] = high
+        self.size += 1
+        if self.size > self.slots * self.max_load:
+            self._grow()
+        return False
+
+    def __contains__(self, value: object) -> bool:
+        if not isinstance(value, int):
+            return False
+        return self._find(*self._split(value))[1]
+
+    def __iter__(self) -> Iterator[int]:
+        table = self.table
+        for index in range(self.slots):
+            position = index * self.words
+            low = table[position]
+            high = table[position + 1] if self.words == 2 else 0
+            if low != 0 or high != 0:
+                yield low | (high << 64)
+
+    def _grow(self) -> None:
+        values = list(self)
+        self._allocate(self.slots * 2)
+        self.size = 0
+        for value in values:
+            self.add(value)
+
+    def update(self, other: FingerprintSet) -> list[int]:
+        """Add everything from the other set. Returns the values that were
+        in both"""
+        return [value for value in other if self.add(value)]
+
+
+class BloomFilter:
+    def __init__(self, expected: int, error_rate: float = 0.01) -> None:
+        expected = max(expected, 1)
+        self.nbits = max(64, int(-expected * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.nbits / expected * math.log(2)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+    def _positions(self, value: int) -> Iterator[tuple[int, int]]:
+        # Double hashing, using both halves of the fingerprint
+        first = value & 0xFFFFFFFF
+        second = ((value >> 32) & 0xFFFFFFFF) | 1
+        for i in range(self.hashes):
+            bit = (first + i * second) % self.nbits
+            yield bit >> 3, 1 << (bit & 7)
+
+    def __contains__(self, value: object) -> bool:
+        if not isinstance(value, int):
+            return False
+        return all(self.bits[byte] & mask for byte, mask in self._positions(value))
+
+    def add(self, value: int) -> bool:
+        """Add the value, returning True if it may already have been present"""
+        present = True
+        for byte, mask in self._positions(value):
+            if not self.bits[byte] & mask:
+                present = False
+                self.bits[byte] |= mask
+        return present
+
+
+class IdentifierSet:
+    """Identifiers seen so far, as fingerprints"""
+
+    passes = 1
+
+    def __init__(self, bits: int = 64) -> None:
+        self.bits = bits
+        self.fingerprints = FingerprintSet(bits=bits)
+
+    def seen(self, key: str) -> bool:
+        """Record the key, returning True if it has been seen before"""
+        return self.fingerprints.add(fingerprint(key, self.bits))
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
+
+    @property
+    def nbytes(self) -> int:
+        return self.fingerprints.nbytes
+
+
+class TwoPassIdentifierSet:
+    """A Bloom filter on the first pass collects possible duplicates. Only
+    those are tracked exactly on the second pass, where seen() reports the
+    real duplicates. It never reports anything during the first pass"""
+
+    passes = 2
+
+    def __init__(self, expected: int, error_rate: float = 0.01) -> None:
+        self.bloom = BloomFilter(expected, error_rate)
+        self.candidates = FingerprintSet()
+        self.confirmed: set[str] = set()
+        self.current_pass = 1
+
+    def start_second_pass(self) -> None:
+        self.current_pass = 2
+
+    @property
+    def needs_second_pass(self) -> bool:
+        return len(self.candidates) > 0
+
+    def seen(self, key: str) -> bool:
+        value = fingerprint(key)
+        if self.current_pass == 1:
+            if self.bloom.add(value):
+                self.candidates.add(value)
+            return False
+
+        if value not in self.candidates:
+            return False
+        if key in self.confirmed:
+            return True
+        self.confirmed.add(key)
+        return False
+
+    @property
+    def nbytes(self) -> int:
+        return self.bloom.nbytes + self.candidates.nbytes
@@ -80,6 +80,13 @@ def ParseJSON(input_json, out_csv_file, variable_consumers=[], filter=[]):
     content = json.load(input_json)
     Variable.writeheader(writer)
 
+    # With compact_code_systems, the dd only has values-count and the values
+    # themselves live in the code-system found at values-url
+    code_systems = {}
+    for cs in content.get('code-systems', []):
+        if 'url' in cs:
+            code_systems[cs['url']] = cs.get('values', [])
+
     for table in content['study']['data-dictionary']:
         table_name = table['table_name']
 
@@ -98,7 +105,10 @@ def ParseJSON(input_json, out_csv_file, variable_consumers=[], filter=[]):
                 v.writerow(writer)
 
                 # Now lets look at the values:
-                for value in variable['values']:
+                values = variable.get('values')
+                if values is None:
+                    values = code_systems.get(variable.get('values-url'), [])
+                for value in values:
                     vdesc = value['description']
 
                     if vdesc.lower() not in ignore_these_values:
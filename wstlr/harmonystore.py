@@ -0,0 +1,142 @@
+"""
+Process wide store for the harmony CSV files.
+
+The same harmony file is used in several places: DataCsvToObject pulls the
+display text for each local code, ObjectifyHarmony builds the harmony
+entries for the whistle input and BuildConceptMap writes the ConceptMap
+whistle uses for Harmonize. Multiple configs will often share the same
+file, too. Rather than each reading the CSV for itself, they get the rows
+from here, where each file is parsed at most once per process.
+
+The parsed rows are also cached on disk (see wstlr.cache), keyed by the
+file's content hash, so unchanged files needn't be parsed by later runs.
+
+Rows are plain dictionaries with lower cased field names. They are shared
+by every consumer, so please treat them as read only.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from csv import DictReader
+from pathlib import Path
+from threading import Lock
+from typing import Any
+
+from wstlr.cache import cache_dir, content_hash, write_atomic
+
+# Bump this if the format of the rows changes
+cache_version = 1
+
+
+class HarmonyFile:
+    def __init__(self, filename: str | os.PathLike[str], rows: list[dict[str, str]], digest: str) -> None:
+        self.filename = Path(filename)
+        self.rows = rows
+        self.digest = digest
+
+        self._code_details: dict[str, str] | None = None
+
+    def code_details(self) -> dict[str, str]:
+        """local code => display. As was always the case, the last row
+        wins when a code appears more than once"""
+        if self._code_details is None:
+            self._code_details = {
+                row.get("local code", ""): row.get("display", "") for row in self.rows
+            }
+        return self._code_details
+
+
+def parse_harmony_csv(filename: str | os.PathLike[str]) -> list[dict[str, str]]:
+    with open(filename, "rt") as f:
+        reader = DictReader(f, delimiter=",", quotechar='"')
+        # Make sure the field names are uniform. Just ignore case
+        fieldnames = [x.lower() for x in reader.fieldnames or []]
+        reader.fieldnames = fieldnames
+
+        rows = []
+        for row in reader:
+            # Drop anything beyond the header's columns
+            row.pop(None, None)  # type: ignore[call-overload]
+            # Short rows result in None for the missing columns
+            for key in fieldnames:
+                if row.get(key) is None:
+                    row[key] = ""
+            # Older harmony files don't have a code system column at all
+            if "code system" not in row:
+                row["code system"] = ""
+            rows.append(row)
+    return rows
+
+
+class HarmonyStore:
+    def __init__(self, use_disk_cache: bool = True) -> None:
+        self.use_disk_cache = use_disk_cache
+        self.lock = Lock()
+
+        # resolved path => ((mtime_ns, size), HarmonyFile)
+        self.files: dict[str, tuple[tuple[int, int], HarmonyFile]] = {}
+
+        # Number of times a CSV was actually parsed. Useful for tests
+        self.parse_count = 0
+
+    def get(self, filename: str | os.PathLike[str]) -> HarmonyFile:
+        path = Path(filename).resolve()
+        stat = path.stat()
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            entry = self.files.get(str(path))
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+
+            digest = content_hash(path)
+            if entry is not None and entry[1].digest == digest:
+                # Touched, but not changed
+                harmony = entry[1]
+            else:
+                harmony = HarmonyFile(filename, self.load_rows(path, digest), digest)
+            self.files[str(path)] = (signature, harmony)
+            return harmony
+
+    def load_rows(self, path: Path, digest: str) -> list[dict[str, str]]:
+        cachefile = None
+        if self.use_disk_cache:
+            cachefile = cache_dir("harmony") / f"{digest}.json"
+            if cachefile.exists():
+                try:
+                    with cachefile.open("rt") as f:
+                        cached = json.load(f)
+                    if cached.get("version") == cache_version:
+                        fieldnames = cached["fieldnames"]
+                        return [dict(zip(fieldnames, values)) for values in cached["rows"]]
+                except (ValueError, KeyError):
+                    # A damaged cache entry is simply rebuilt
+                    pass
+
+        rows = parse_harmony_csv(path)
+        self.parse_count += 1
+
+        if cachefile is not None and len(rows) > 0:
+            fieldnames = list(rows[0].keys())
+            entry: dict[str, Any] = {
+                "version": cache_version,
+                "filename": str(path),
+                "fieldnames": fieldnames,
+                "rows": [[row[key] for key in fieldnames] for row in rows],
+            }
+            write_atomic(cachefile, json.dumps(entry).encode())
+        return rows
+
+    def clear(self) -> None:
+        with self.lock:
+            self.files = {}
+
+
+harmony_store = HarmonyStore()
+
+
+def load_harmony(filename: str | os.PathLike[str]) -> HarmonyFile:
+    """Returns the parsed harmony file from the process wide store"""
+    return harmony_store.get(filename)
@@ -0,0 +1,233 @@
+"""
+On-disk cache for the files whistler downloads (remote data-dictionaries
+and IG packages for igload).
+
+Responses are kept under the cache root (see wstlr.cache) along with their
+ETag and Last-Modified headers. When a cached file is requested again, we
+ask the server whether it has changed (If-None-Match/If-Modified-Since),
+so an unchanged file costs a single, empty 304 response. If the server
+can't be reached or answers with a server error (5xx), the cached copy is
+used with a warning.
+
+In offline mode (WHISTLER_OFFLINE=1 or --offline), no requests are made at
+all: cached files are returned as is and anything missing from the cache is
+an error. This is handy for CI or for working without a network.
+
+The cache is limited to WHISTLER_HTTP_CACHE_MB megabytes (1024 by default).
+When it grows beyond that, the least recently used files are removed.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from time import time, time_ns
+from typing import Any
+
+import requests
+from rich import print
+
+from wstlr.cache import cache_dir, write_atomic
+
+default_max_mb = 1024
+
+
+class OfflineCacheMiss(Exception):
+    def __init__(self, url: str) -> None:
+        self.url = url
+        super().__init__(
+            f"{url} isn't in the download cache and whistler is running offline"
+        )
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    content: bytes
+    digest: str
+    from_cache: bool
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def text(self) -> str:
+        return self.content.decode("utf-8-sig")
+
+
+def add_http_cache_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Don't download anything. Remote data-dictionaries and IGs must "
+        "already be in the download cache (see WHISTLER_CACHE_DIR)",
+    )
+
+
+class HttpCache:
+    def __init__(
+        self,
+        directory: str | os.PathLike[str] | None = None,
+        max_bytes: int | None = None,
+        offline: bool | None = None,
+        timeout: float = 120.0,
+    ) -> None:
+        self._directory = None if directory is None else Path(directory)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("WHISTLER_HTTP_CACHE_MB", default_max_mb)) * 1024 * 1024
+        self.max_bytes = max_bytes
+        if offline is None:
+            offline = os.environ.get("WHISTLER_OFFLINE", "").lower() in ["1", "true", "yes"]
+        self.offline = offline
+        self.timeout = timeout
+        self.lock = Lock()
+
+    @property
+    def directory(self) -> Path:
+        # Resolved when used so that WHISTLER_CACHE_DIR can be changed after
+        # the default cache is created
+        if self._directory is None:
+            return cache_dir("http")
+        self._directory.mkdir(parents=True, exist_ok=True)
+        return self._directory
+
+    def _paths(self, url: str) -> tuple[Path, Path]:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        directory = self.directory
+        return directory / f"{key}.body", directory / f"{key}.json"
+
+    def _read_metadata(self, metafile: Path) -> dict[str, Any] | None:
+        try:
+            with metafile.open("rt") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _touch(self, bodyfile: Path) -> None:
+        # The body's mtime is how we track the least recently used entries.
+        # The file system's own timestamps can be too coarse to tell apart
+        # files written in quick succession, so we set it ourselves
+        now = time_ns()
+        os.utime(bodyfile, ns=(now, now))
+
+    def _cached(self, url: str, bodyfile: Path, metadata: dict[str, Any]) -> CachedResponse:
+        self._touch(bodyfile)
+        return CachedResponse(url, bodyfile.read_bytes(), metadata["digest"], True)
+
+    def _lookup(self, url: str) -> CachedResponse | None:
+        """The cached copy of url, if there is one. The lock must already be
+        held"""
+        bodyfile, metafile = self._paths(url)
+        if not bodyfile.exists():
+            return None
+        metadata = self._read_metadata(metafile)
+        if metadata is None:
+            return None
+        try:
+            return self._cached(url, bodyfile, metadata)
+        except FileNotFoundError:
+            return None
+
+    def get(self, url: str) -> CachedResponse:
+        # The lock only covers the cache directory itself. The download
+        # happens without it so one slow server doesn't hold up every other
+        # thread's downloads
+        bodyfile, metafile = self._paths(url)
+        with self.lock:
+            metadata = None
+            if bodyfile.exists():
+                metadata = self._read_metadata(metafile)
+
+            if self.offline:
+                if metadata is None:
+                    raise OfflineCacheMiss(url)
+                return self._cached(url, bodyfile, metadata)
+
+        headers = {}
+        if metadata is not None:
+            if metadata.get("etag"):
+                headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified"):
+                headers["If-Modified-Since"] = metadata["last_modified"]
+
+        problem: str | None = None
+        try:
+            response = requests.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            if metadata is None:
+                raise
+            problem = str(e)
+        else:
+            if response.status_code >= 500 and metadata is not None:
+                problem = f"HTTP {response.status_code}"
+
+        if problem is not None or response.status_code == 304:
+            with self.lock:
+                cached = self._lookup(url)
+            if cached is not None:
+                if problem is not None:
+                    print(f"[yellow]Unable to reach {url} ({problem}), using the cached copy[/yellow]")
+                return cached
+            # Evicted by another thread while we were waiting on the server
+            response = requests.get(url, timeout=self.timeout)
+
+        response.raise_for_status()
+
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            write_atomic(bodyfile, content)
+            self._touch(bodyfile)
+            write_atomic(
+                metafile,
+                json.dumps(
+                    {
+                        "url": url,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "fetched": time(),
+                        "size": len(content),
+                        "digest": digest,
+                    }
+                ).encode(),
+            )
+            self.evict(keep=bodyfile)
+        return CachedResponse(url, content, digest, False)
+
+    def evict(self, keep: Path | None = None) -> None:
+        """Remove the least recently used files until we are under the size
+        limit. The lock must already be held"""
+        entries = []
+        total = 0
+        for bodyfile in self.directory.glob("*.body"):
+            stat = bodyfile.stat()
+            total += stat.st_size
+            entries.append((stat.st_mtime_ns, bodyfile, stat.st_size))
+
+        for mtime, bodyfile, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if bodyfile == keep:
+                continue
+            bodyfile.unlink(missing_ok=True)
+            bodyfile.with_suffix(".json").unlink(missing_ok=True)
+            total -= size
+
+    def open_text(self, url: str) -> io.StringIO:
+        return io.StringIO(self.get(url).text())
+
+    def open_binary(self, url: str) -> io.BytesIO:
+        return io.BytesIO(self.get(url).content)
+
+
+http_cache = HttpCache()
+
+
+def set_offline(offline: bool) -> None:
+    if offline:
+        http_cache.offline = True
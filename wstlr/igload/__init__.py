@@ -3,10 +3,9 @@ from ncpi_fhir_client.fhir_client import FhirClient
 from yaml import safe_load
 from wstlr import get_host_config
 from wstlr.igload import ig_source, file_source
-import zipfile
-import requests
-from tempfile import TemporaryFile
-import json
+from wstlr.igload.loader import IgLoader
+from wstlr.profiling import Profiler, add_profile_arguments
+from wstlr.httpcache import add_http_cache_arguments, set_offline
 from time import sleep
 
 from argparse import ArgumentParser, FileType
@@ -52,29 +51,6 @@ def delete_resource(fn, fhir_client, data, deleted_items):
     return response
 
 
-def load_resource(fn, fhir_client, data, force_overwrite):
-    if "url" in data:
-        response = fhir_client.load(
-            data["resourceType"], data, skip_insert_if_present=not force_overwrite
-        )
-    else:
-        response = fhir_client.post(data["resourceType"], data)
-    if type(response) is dict:
-        response = [response]
-
-    for resp in response:
-        if resp["status_code"] < 300:
-            print(f"Loading {fn} - {resp['status_code']}")
-        else:
-            print(f"An error occurred loading {fn}")
-            print(resp["status_code"])
-            if "issue" in resp:
-                print(resp["issue"])
-            else:
-                print(resp)
-    return response
-
-
 def exec():
     host_config = get_host_config()
     env_options = sorted(host_config.keys())
@@ -105,7 +81,24 @@ def exec():
     parser.add_argument(
         "--force-overwrite",
         action="store_true",
-        help="Replace resources that are already loaded in the target FHIR server.",
+        help="Replace resources that are already loaded in the target FHIR server, even if they haven't changed.",
+    )
+    parser.add_argument(
+        "--update-changed",
+        action="store_true",
+        help="Replace resources that are already loaded in the target FHIR server if they have changed. Normally, resources that are already loaded are skipped.",
+    )
+    parser.add_argument(
+        "--delete-first",
+        action="store_true",
+        help="Delete any existing copies of the resources before loading them. Normally, resources that are already loaded are skipped (or replaced in place, with --update-changed).",
+    )
+    parser.add_argument(
+        "-t",
+        "--thread-count",
+        type=int,
+        default=4,
+        help="Number of resources to load at once. Resources that depend on each other are never loaded at the same time.",
     )
     parser.add_argument(
         "-c",
@@ -132,7 +125,11 @@ def exec():
         action="store_true",
         help="Return the version number associated with the application. ",
     )
+    add_profile_arguments(parser)
+    add_http_cache_arguments(parser)
     args = parser.parse_args(sys.argv[1:])
+    profiler = Profiler.from_args(args)
+    set_offline(args.offline)
 
     if args.version:
         print(f"{Path(__file__).parent.name} v{__version__}")
@@ -164,27 +161,11 @@ def exec():
     print(f"Destination host: {fhir_client.target_service_url}")
 
     for key in content:
-
-        resources = {}
-
-        if content[key]["source_type"] == "IG":
-            resources = ig_source.load_resources(content[key])
-        elif content[key]["source_type"] == "FILES":
-            resources = file_source.load_resources(content[key])
-
-            resource_types = set()
-            for resource in resources:
-                resource_types.add(resources[resource]["resourceType"])
-
-            # replace the filenames with the resource types
-            content[key]["resources"] = list(resource_types)
-
-        # Capture the resourceTypes found in the contents we just loaded and
-        # cache them in case the user didn't restrict resources to a subset
-
+        # Load the resourceTypes (or files) requested, or if the user didn't
+        # restrict resources to a subset, whatever the module is configured for
         resource_list = args.resource
         if resource_list is None:
-            resource_list = content[key]["resources"]
+            resource_list = content[key].get("resources")
             if type(resource_list) is str:
                 resource_list = [x.strip() for x in resource_list.split()]
 
@@ -194,55 +175,72 @@ def exec():
             if type(exclusion_list) is str:
                 exclusion_list = [x.strip() for x in exclusion_list.split()]
 
-        excluded_list = []
-        # First, let's try deleting any that may already exist
-        deleted_items = []
-        if args.force_overwrite:
-            print("Forcing Overwrite!")
-            ig = None
-            for fn, data in resources.items():
-                if data["resourceType"] in resource_list and not test_exclusion(
-                    fn, args.exclude
-                ):
-                    if data["resourceType"] == "ImplementationGuide":
-                        ig = data
+        package = None
+        with profiler.stage(f"fetch-{key}"):
+            if content[key]["source_type"] == "IG":
+                # Only the entries we are going to load are ever parsed
+                package = ig_source.IgPackage(content[key])
+                selected, excluded_list = package.select(
+                    resource_list, lambda fn: test_exclusion(fn, exclusion_list)
+                )
+                read = package.read
+            elif content[key]["source_type"] == "FILES":
+                resources = file_source.load_resources(content[key])
+
+                # The resources are named by file, so the types come from 
+                # the files themselves
+                if args.resource is None:
+                    resource_list = list(set(x["resourceType"] for x in resources.values()))
+
+                selected = []
+                excluded_list = []
+                for fn, data in resources.items():
+                    if (
+                        data["resourceType"] in resource_list or fn in resource_list
+                    ) and not test_exclusion(fn, exclusion_list):
+                        selected.append((fn, data["resourceType"]))
                     else:
-                        print(data)
-                        print("Deleting the above resource")
-                        response = delete_resource(fn, fhir_client, data, deleted_items)
-
-            if ig is not None:
-                response = delete_resource(fn, fhir_client, data, deleted_items)
-
-            if len(deleted_items) > 0:
-                print(f"Sleeping to give the backend time to catchup")
-
-                sleep(args.sleep_time + len(deleted_items))
-
-        # Iterate over the list and load them one at a time
-        ig = None
-        print(resource_list)
-        for fn, data in resources.items():
-            if (
-                data["resourceType"] in resource_list or fn in resource_list
-            ) and not test_exclusion(fn, exclusion_list):
-                if data["resourceType"] == "ImplementationGuide":
-                    print(f"\n\n--> IG: {fn}")
-                    ig = data
-                else:
-                    response = load_resource(
-                        fn, fhir_client, data, args.force_overwrite
-                    )
-                    print(f"{fn} -- {response.keys()}")
-            else:
-                print(f"\nSkipping {fn}")
-                excluded_list.append(fn)
-
-        if ig is not None:
-            response = load_resource(fn, fhir_client, ig, args.force_overwrite)
-            print(response)
-
-        print("Files Loaded: " + ", ".join(sorted(resources.keys())))
+                        print(f"\nSkipping {fn}")
+                        excluded_list.append(fn)
+                read = resources.get
+
+        with profiler.stage(f"load-{key}"):
+            # Only if asked to, delete any that may already exist. Otherwise,
+            # they are skipped or, with --update-changed, replaced in place
+            deleted_items = []
+            if args.delete_first:
+                print("Deleting existing copies first!")
+                ig = None
+                for fn, resource_type in selected:
+                    if resource_type == "ImplementationGuide":
+                        ig = fn
+                    else:
+                        response = delete_resource(fn, fhir_client, read(fn), deleted_items)
+
+                if ig is not None:
+                    response = delete_resource(ig, fhir_client, read(ig), deleted_items)
+
+                if len(deleted_items) > 0:
+                    print(f"Sleeping to give the backend time to catchup")
+
+                    sleep(args.sleep_time + len(deleted_items))
+
+            # Dependencies first, the ImplementationGuide last
+            loader = IgLoader(
+                fhir_client,
+                thread_count=args.thread_count,
+                force_overwrite=args.force_overwrite or args.delete_first,
+                update_changed=args.update_changed,
+            )
+            results = loader.load_entries(selected, read)
+            print(
+                f"{results['loaded']} loaded, {results['unchanged']} unchanged, "
+                f"{results['failed']} failed"
+            )
+
+        if package is not None:
+            package.close()
+        print("Files Loaded: " + ", ".join(sorted(x[0] for x in selected)))
         print("Files Excluded: " + ", ".join(sorted(excluded_list)))
 
     print(
@@ -251,3 +249,4 @@ def exec():
         """loading large vocabularies can take quite some time before the """
         """server is ready to use them and any changes made afterward. """
     )
+    profiler.finish()
@@ -1,10 +1,9 @@
 
 from pathlib import Path
-import zipfile
-import requests
-from tempfile import TemporaryFile
 import json
 
+from wstlr.httpcache import http_cache
+
 import sys
 
 def load_resources(config):
@@ -14,9 +13,7 @@ def load_resources(config):
         resource = None
 
         if filename.lower()[:4] == "http":
-            response = requests.get(filename)
-            response.raise_for_status()
-            resource = response.json()
+            resource = http_cache.get(filename).json()
         else:
             f = Path(filename).open('rt')
             resource = json.load(f)
@@ -1,56 +1,114 @@
 from pathlib import Path
 import zipfile
-import requests
-from tempfile import TemporaryFile
 import json
+import re
+from wstlr.httpcache import http_cache
 from rich import print
 import sys
 
+# The resourceType is almost always among the first few keys, so peeking at
+# the start of an entry is enough to tell what it is without parsing it all
+peek_size = 1024
+resource_type_rx = re.compile(r'"resourceType"\s*:\s*"([A-Za-z]+)"')
+
+
+def open_package(config):
+    """Returns the IG's definitions.json.zip, along with where it came from"""
+    if 'url' in config:
+        # Grab the definition zip file from the IG website
+        url = f"{config['url']}/definitions.json.zip"
+
+        # The package is only downloaded again if it has changed
+        return zipfile.ZipFile(http_cache.open_binary(url)), url
+    elif 'path' in config:
+        # If we have a path, then we just open the file as usual. ZipFile
+        # only reads the parts of it we ask for
+        path = Path(config['path']) / "output/definitions.json.zip"
+        return zipfile.ZipFile(path), config['path']
+    else:
+        sys.stderr.write("ERROR: Each module MUST contain either a 'path' or a 'url' pointing to a valid IG produced by HL7s publisher.")
+        sys.exit(1)
+
+
+class IgPackage:
+    """Lazy access to the resources in an IG's definitions.json.zip. The
+    entries are listed from the zip's central directory and each is only
+    decompressed and parsed when it is read"""
+    def __init__(self, config):
+        self.zipped, self.source = open_package(config)
+        self.filenames = [
+            x.filename for x in self.zipped.infolist()
+            if x.filename != "spec.internals" and not x.is_dir()
+        ]
+
+    def peek_type(self, filename):
+        """The entry's resourceType, from the start of the entry. None if it
+        isn't where we expect it"""
+        with self.zipped.open(filename) as f:
+            head = f.read(peek_size).decode('utf-8', errors='ignore')
+        match = resource_type_rx.search(head)
+        if match is not None:
+            return match.group(1)
+        return None
+
+    def resource_type(self, filename):
+        resource_type = self.peek_type(filename)
+        if resource_type is None:
+            # Nothing for it but to parse the whole thing
+            resource = self.read(filename)
+            if resource is not None:
+                resource_type = resource.get('resourceType')
+        return resource_type
+
+    def select(self, resource_list=None, excluded=None):
+        """Returns [(filename, resourceType)] for the entries that match the
+        resource_list (resourceTypes or filenames) and aren't excluded by
+        excluded(filename), along with the filenames skipped"""
+        selected = []
+        skipped = []
+        for filename in self.filenames:
+            if excluded is not None and excluded(filename):
+                skipped.append(filename)
+                continue
+            resource_type = self.resource_type(filename)
+            if resource_type is None:
+                skipped.append(filename)
+            elif resource_list is None or resource_type in resource_list or filename in resource_list:
+                selected.append((filename, resource_type))
+            else:
+                skipped.append(filename)
+        print(f"{len(selected)} of {len(self.filenames)} resources selected from: {self.source}")
+        return selected, skipped
+
+    def read(self, filename):
+        data = self.zipped.read(filename).decode()
+        try:
+            obj = json.loads(data)
+            if obj is None:
+                print(f"{filename} parsed to an empty JSON object")
+                print(data)
+            return obj
+        except json.JSONDecodeError as e:
+            print(f"Failed to parse {filename}: {e}")
+            print(data)
+        return None
+
+    def close(self):
+        self.zipped.close()
+
 
 # Return a list of valid JSON objects ready for loading
 def load_resources(config):
         resources = {}
-        f = None
-
-        ig_source = ""
-
-        if 'url' in config:
-            # Grab the definition zip file from the IG website
-            url = f"{config['url']}/definitions.json.zip"
-            ig_source = url
-            response = requests.get(url)
-
-            # Open it up using a Temporary File
-            f = TemporaryFile()
-            f.write(response.content)
-            f.seek(0)
-        elif 'path' in config:
-            # If we have a path, then we just open the file as usual
-            ig_source = config['path']
-            f = (Path(config['path']) / "output/definitions.json.zip").open('rb')
-        else:
-            sys.stderr("ERROR: Each module MUST contain either a 'path' or a 'url' pointing to a valid IG produced by HL7s publisher.")
-            sys.exit(1)
-
-        # These are plain zip files, so just open it up using python's Zipfile
-        zipped = zipfile.ZipFile(f)
+        package = IgPackage(config)
 
         # Iterate over each of the entries 
-        for f in zipped.infolist():
-            filename = f.filename
-            data = zipped.read(filename).decode()
-
-            if filename != "spec.internals":
-                try:
-                    obj = json.loads(data)
-                    if obj is None:
-                        print(f"{filename} parsed to an empty JSON object")
-                        print(data)
-                    resources[filename] = obj
-                except json.JSONDecodeError as e:
-                    print(f"Failed to parse {filename}: {e}")
-                    print(data)
-
-        print(f"{len(resources)} resources found at: {ig_source}")
+        for filename in package.filenames:
+            obj = package.read(filename)
+            if obj is not None:
+                resources[filename] = obj
+        package.close()
+
+        print(f"{len(resources)} resources found at: {package.source}")
 
         return resources
\ No newline at end of file
@@ -0,0 +1,254 @@
+"""
+Load an IG's resources in dependency order, several at a time.
+
+Resources are loaded in tiers by type: CodeSystems and StructureDefinitions,
+then the ValueSets built from them, then the things that refer to those
+(SearchParameters, ConceptMaps, ...), then everything else and finally the
+ImplementationGuide itself. A tier only starts once the previous one is
+done. Within a tier, StructureDefinitions can build on each other (their
+baseDefinition and the profiles their elements use) as can ValueSets
+(compose.include.valueSet), so those are split further into levels by their
+references (see dependency_levels). Everything within a level is loaded
+concurrently.
+
+By default, as always, resources the server already has are left alone.
+With update_changed, the server's copy (same url and version) of each
+resource with a canonical url is fetched first. If its content matches ours
+(ignoring meta and id, which the server owns), there is nothing to do.
+Otherwise, ours replaces it in place, so there is no need to delete
+everything before reloading it. force_overwrite replaces everything.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import json
+from collections import Counter
+from collections.abc import Callable, Iterable
+from typing import Any
+from urllib.parse import quote
+
+from rich import print
+
+# Resource types in the order they must be loaded. Anything not listed
+# belongs with the None entry
+load_order: list[list[str | None]] = [
+    ["CodeSystem", "StructureDefinition", "NamingSystem"],
+    ["ValueSet"],
+    [
+        "SearchParameter",
+        "ConceptMap",
+        "OperationDefinition",
+        "CompartmentDefinition",
+        "StructureMap",
+        "CapabilityStatement",
+    ],
+    [None],
+    ["ImplementationGuide"],
+]
+
+_tiers = {
+    resource_type: index
+    for index, types in enumerate(load_order)
+    for resource_type in types
+}
+
+
+def load_tier(resource_type: str) -> int:
+    return _tiers.get(resource_type, _tiers[None])
+
+
+def content_hash(resource: dict[str, Any]) -> str:
+    """Hash of everything but the parts the server assigns itself"""
+    content = {k: v for k, v in resource.items() if k not in ("id", "meta")}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+def order_entries(entries: Iterable[tuple[str, str]]) -> list[list[str]]:
+    """Split the entries ((filename, resourceType)) into their tiers, keeping
+    them in their original order within each tier. Empty tiers are dropped"""
+    tiers: list[list[str]] = [[] for _ in load_order]
+    for filename, resource_type in entries:
+        tiers[load_tier(resource_type)].append(filename)
+    return [x for x in tiers if len(x) > 0]
+
+
+def canonical_references(resource: dict[str, Any]) -> set[str]:
+    """The canonical urls (without versions) of the resources of the same
+    type this one builds on, which must be loaded before it"""
+    references: set[str] = set()
+    resource_type = resource.get("resourceType")
+    if resource_type == "StructureDefinition":
+        if "baseDefinition" in resource:
+            references.add(resource["baseDefinition"])
+        for view in ("snapshot", "differential"):
+            for element in resource.get(view, {}).get("element", []):
+                for element_type in element.get("type", []):
+                    references.update(element_type.get("profile", []))
+    elif resource_type == "ValueSet":
+        compose = resource.get("compose", {})
+        for part in ("include", "exclude"):
+            for entry in compose.get(part, []):
+                references.update(entry.get("valueSet", []))
+    return {x.split("|")[0] for x in references}
+
+
+# The types whose resources may refer to others of the same type
+self_referencing_types = {"StructureDefinition", "ValueSet"}
+
+
+def dependency_levels(
+    tier: list[str],
+    types: dict[str, str],
+    read: Callable[[str], dict[str, Any] | None],
+) -> list[list[str]]:
+    """Split a tier's filenames into levels such that nothing is loaded
+    before whatever it refers to within the tier. Only the resources of
+    self_referencing_types are read to find out (and are read again when
+    they are loaded, so they needn't all be held at once). References to
+    anything outside the tier are ignored and anything caught up in a cycle
+    ends up in the last level, in its original order"""
+    urls: dict[str, str] = {}
+    references: dict[str, set[str]] = {}
+    for filename in tier:
+        if types[filename] not in self_referencing_types:
+            continue
+        resource = read(filename)
+        if resource is None:
+            continue
+        if "url" in resource:
+            urls[resource["url"]] = filename
+        references[filename] = canonical_references(resource)
+
+    # filename => filenames in the tier it must wait for
+    waiting = {
+        filename: {
+            urls[x] for x in references.get(filename, set()) if x in urls and urls[x] != filename
+        }
+        for filename in tier
+    }
+    levels = []
+    loaded: set[str] = set()
+    while len(waiting) > 0:
+        level = [x for x in tier if x in waiting and waiting[x] <= loaded]
+        if len(level) == 0:
+            level = [x for x in tier if x in waiting]
+        levels.append(level)
+        loaded.update(level)
+        for filename in level:
+            del waiting[filename]
+    return levels
+
+
+def order_resources(resources: dict[str, dict[str, Any]]) -> list[list[tuple[str, dict[str, Any]]]]:
+    """order_entries for resources that have already been read"""
+    tiers = order_entries((k, v["resourceType"]) for k, v in resources.items())
+    return [[(filename, resources[filename]) for filename in tier] for tier in tiers]
+
+
+def load_resource(fn: str, fhir_client: Any, data: dict[str, Any], force_overwrite: bool) -> list[dict[str, Any]]:
+    if "url" in data:
+        response = fhir_client.load(
+            data["resourceType"], data, skip_insert_if_present=not force_overwrite
+        )
+    else:
+        response = fhir_client.post(data["resourceType"], data)
+    if type(response) is dict:
+        response = [response]
+
+    for resp in response:
+        if resp["status_code"] < 300:
+            print(f"Loading {fn} - {resp['status_code']}")
+        else:
+            print(f"An error occurred loading {fn}")
+            print(resp["status_code"])
+            if "issue" in resp:
+                print(resp["issue"])
+            else:
+                print(resp)
+    return response
+
+
+class IgLoader:
+    def __init__(
+        self,
+        fhir_client: Any,
+        thread_count: int = 4,
+        force_overwrite: bool = False,
+        update_changed: bool = False,
+    ) -> None:
+        self.client = fhir_client
+        self.thread_count = thread_count
+        # Load everything, even if the server already has identical copies
+        self.force_overwrite = force_overwrite
+        # Replace the server's copies that differ from ours. Otherwise,
+        # anything the server already has is skipped
+        self.update_changed = update_changed
+
+        # loaded, unchanged or failed => count
+        self.results: Counter[str] = Counter()
+
+    def server_copy(self, resource: dict[str, Any]) -> dict[str, Any] | None:
+        """The server's version of a canonical resource, if it has exactly
+        one"""
+        query = f"{resource['resourceType']}?url={quote(resource['url'], safe='')}"
+        if "version" in resource:
+            query += f"&version={quote(str(resource['version']), safe='')}"
+        response = self.client.get(query, recurse=False, except_on_error=False)
+        matches = [x["resource"] for x in response.entries if "resource" in x]
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def is_unchanged(self, resource: dict[str, Any]) -> bool:
+        if self.force_overwrite or not self.update_changed or "url" not in resource:
+            return False
+        current = self.server_copy(resource)
+        return current is not None and content_hash(current) == content_hash(resource)
+
+    def load_one(self, filename: str, read: Callable[[str], dict[str, Any] | None]) -> str:
+        try:
+            resource = read(filename)
+            if resource is None:
+                return "failed"
+            if self.is_unchanged(resource):
+                print(f"Unchanged {filename}")
+                return "unchanged"
+
+            # When replacing, anything already there is replaced in place
+            replace = self.force_overwrite or self.update_changed
+            response = load_resource(filename, self.client, resource, replace)
+        except Exception as e:
+            print(f"Something went wrong loading {filename}: {e}")
+            return "failed"
+        if all(x["status_code"] < 300 for x in response):
+            return "loaded"
+        return "failed"
+
+    def load(self, resources: dict[str, dict[str, Any]]) -> Counter[str]:
+        """Load the resources (filename => resource) tier by tier"""
+        entries = [(filename, x["resourceType"]) for filename, x in resources.items()]
+        return self.load_entries(entries, resources.get)
+
+    def load_entries(
+        self,
+        entries: list[tuple[str, str]],
+        read: Callable[[str], dict[str, Any] | None],
+    ) -> Counter[str]:
+        """Load the entries ((filename, resourceType)) tier by tier. Each
+        resource is only read (read(filename)) when it is about to be loaded,
+        so the whole IG needn't be held in memory"""
+        types = dict(entries)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.thread_count)) as executor:
+            for tier in order_entries(entries):
+                tier_types = sorted(set(types[x] for x in tier))
+                print(f"Loading {len(tier)} resources ({', '.join(tier_types)})")
+                for level in dependency_levels(tier, types, read):
+                    jobs = [executor.submit(self.load_one, filename, read) for filename in level]
+                    # Everything in this level must be in place before the next
+                    for job in jobs:
+                        self.results[job.result()] += 1
+        return self.results
@@ -0,0 +1,187 @@
+"""
+Collect every problem the inspectors find rather than stopping at the first.
+
+By default, inspectjson (and the inspection play runs after whistle) exits as
+soon as it finds a problem with a resource. With a large output, that means
+rerunning the whole inspection once for each problem. With --inspect-all,
+everything is inspected in one pass and the problems are gathered into an
+InspectionReport, grouped by module and rule:
+
+    * missing-resource-type
+    * missing-identifier
+    * missing-system (the first identifier has no system)
+    * duplicate-identifier
+    * missing-meta-tag
+    * not-official (no single identifier with use: official)
+    * missing-code (Observations only)
+
+Each group keeps a count and a few samples. --inspection-report writes the
+report as JSON or, if the filename ends with .csv, as one row per group.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from typing import Any
+
+from rich import print
+
+rules = [
+    "missing-resource-type",
+    "missing-identifier",
+    "missing-system",
+    "duplicate-identifier",
+    "missing-meta-tag",
+    "not-official",
+    "missing-code",
+]
+
+
+def describe(resource: dict[str, Any], max_length: int = 200) -> str:
+    """A short description of the resource, to be used as a sample"""
+    identifier = resource.get("identifier")
+    if type(identifier) is list and len(identifier) > 0:
+        identifier = identifier[0]
+    if type(identifier) is dict and "value" in identifier:
+        return f"{resource.get('resourceType')} {identifier.get('system', '')}:{identifier['value']}"
+
+    text = json.dumps(resource, separators=(",", ":"))
+    if len(text) > max_length:
+        text = text[: max_length - 3] + "..."
+    return text
+
+
+@dataclass
+class Finding:
+    module: str
+    rule: str
+    message: str
+    count: int = 0
+    samples: list[str] = field(default_factory=list)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "module": self.module,
+            "rule": self.rule,
+            "message": self.message,
+            "count": self.count,
+            "samples": self.samples,
+        }
+
+
+class InspectionReport:
+    def __init__(self, max_samples: int = 5) -> None:
+        self.max_samples = max_samples
+
+        # (module, rule) => Finding
+        self.findings: dict[tuple[str, str], Finding] = {}
+
+    def __len__(self) -> int:
+        return sum(x.count for x in self.findings.values())
+
+    def finding(self, module: str, rule: str, message: str) -> Finding:
+        finding = self.findings.get((module, rule))
+        if finding is None:
+            finding = Finding(module, rule, message)
+            self.findings[(module, rule)] = finding
+        return finding
+
+    def add(self, module: str, rule: str, resource: dict[str, Any], message: str) -> None:
+        finding = self.finding(module, rule, message)
+        finding.count += 1
+        if len(finding.samples) < self.max_samples:
+            finding.samples.append(describe(resource))
+
+    def add_sample(self, module: str, rule: str, sample: str, message: str) -> None:
+        finding = self.finding(module, rule, message)
+        finding.count += 1
+        if len(finding.samples) < self.max_samples:
+            finding.samples.append(sample)
+
+    def merge(self, other: InspectionReport) -> None:
+        for theirs in other.findings.values():
+            finding = self.finding(theirs.module, theirs.rule, theirs.message)
+            finding.count += theirs.count
+            room = self.max_samples - len(finding.samples)
+            finding.samples += theirs.samples[: max(room, 0)]
+
+    def ordered(self) -> list[Finding]:
+        """By module, then in the order the rules are listed above"""
+
+        def rule_order(finding: Finding) -> tuple[str, int, str]:
+            index = rules.index(finding.rule) if finding.rule in rules else len(rules)
+            return finding.module, index, finding.rule
+
+        return sorted(self.findings.values(), key=rule_order)
+
+    def as_dict(self) -> dict[str, Any]:
+        modules: dict[str, dict[str, Any]] = {}
+        for finding in self.ordered():
+            modules.setdefault(finding.module, {})[finding.rule] = {
+                "message": finding.message,
+                "count": finding.count,
+                "samples": finding.samples,
+            }
+        return {"problems": len(self), "modules": modules}
+
+    def print_report(self, max_findings: int = 50) -> None:
+        print(f"\nInspection found [red]{len(self)} problems[/red]")
+        if len(self.findings) == 0:
+            return
+
+        print(
+            "Module Name                      Rule                     #         Sample"
+        )
+        print(
+            "-------------------------------  ------------------------ --------- ------"
+        )
+        ordered = self.ordered()
+        for finding in ordered[:max_findings]:
+            sample = finding.samples[0] if len(finding.samples) > 0 else ""
+            print(f"{finding.module:<32} {finding.rule:<24} {finding.count:<9} {sample}")
+        if len(ordered) > max_findings:
+            print(f"... and {len(ordered) - max_findings} more")
+
+    def save(self, filename: str) -> None:
+        if filename.endswith(".csv"):
+            with open(filename, "wt", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["module", "rule", "message", "count", "samples"])
+                for finding in self.ordered():
+                    writer.writerow(
+                        [
+                            finding.module,
+                            finding.rule,
+                            finding.message,
+                            finding.count,
+                            " ; ".join(finding.samples),
+                        ]
+                    )
+        else:
+            with open(filename, "wt") as f:
+                json.dump(self.as_dict(), f, indent=2)
+
+
+def add_inspection_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--inspect-all",
+        action="store_true",
+        help="Inspect every resource and report all of the problems found "
+        "rather than stopping at the first one",
+    )
+    parser.add_argument(
+        "--inspection-report",
+        type=str,
+        default=None,
+        help="Write the problems found by --inspect-all to this file (JSON, or "
+        "CSV if the name ends with .csv)",
+    )
+    parser.add_argument(
+        "--inspect-workers",
+        type=int,
+        default=1,
+        help="Number of processes to inspect the whistle output with",
+    )
@@ -14,17 +14,31 @@ from pathlib import Path
 import json
 import sys
 from wstlr.module_summary import ModuleSummary
+from wstlr.fingerprints import IdentifierSet, TwoPassIdentifierSet
+from wstlr.inspection_report import InspectionReport, add_inspection_arguments
 from argparse import ArgumentParser, FileType
 from wstlr.bundle import Bundle, ParseBundle, RequestType
+from wstlr.profiling import Profiler, add_profile_arguments
 from rich import print
 
+duplicate_message = "The following identifier appears multiple times"
+
 def ReportError(is_error, resource, message):
     if is_error:
         print(pformat(resource))
         print(message)
         sys.exit(1)
 
-def CheckForUse(identifiers):
+def StopAtFirstProblem(report):
+    """The parallel inspection always collects everything. Without
+    --inspect-all, report one of the problems the way ReportError would"""
+    if len(report) > 0:
+        finding = report.ordered()[0]
+        print(finding.samples[0] if len(finding.samples) > 0 else "")
+        print(finding.message)
+        sys.exit(1)
+
+def CheckForUse(identifiers, exit_on_error=True):
     official_count = 0
 
     # ConceptMap can only have one identifier (possibly others as well)
@@ -35,7 +49,7 @@ def CheckForUse(identifiers):
     else:
         if identifiers.get('use') == 'official':
             official_count = 1
-    if official_count != 1:
+    if official_count != 1 and exit_on_error:
         print(identifiers)
         print(f"use = Official doesn't appear in the the identifier: {identifiers}")
         sys.exit(1)
@@ -43,58 +57,100 @@ def CheckForUse(identifiers):
     return official_count == 1
 
 
-class ObservationInspector:
-    def __init__(self):
-        pass
+class Inspector:
+    """When given an InspectionReport, problems are added to it and the
+    inspection carries on. Otherwise, the first problem ends the run"""
+    def __init__(self, report=None):
+        self.report = report
 
-    def inspect(self, group_name, resource):
+    def problem(self, is_error, group_name, rule, resource, message, details=None):
+        """Returns True if there was a problem. Details are only shown when
+        the run stops, since the report keeps one message for all of the
+        resources with the same problem"""
+        if is_error:
+            if self.report is None:
+                if details is not None:
+                    message = f"{message}{details}"
+                ReportError(is_error, resource, message)
+            self.report.add(group_name, rule, resource, message)
+        return is_error
 
-        ReportError('resourceType' not in resource, resource, "There is no resourceType specified in this resource")
 
-        if resource['resourceType'] == "Observation":
-            ReportError('code' not in resource, resource, "There is no code present in this resource")
+class ObservationInspector(Inspector):
+    def inspect(self, group_name, resource):
+        if self.problem('resourceType' not in resource, group_name, "missing-resource-type", resource, "There is no resourceType specified in this resource"):
+            return
 
-class ResourceInspector:
-    def __init__(self, require_official):
-        # ResourceType => Set(ids)
-        self.identifiers = defaultdict(set)
+        if resource['resourceType'] == "Observation":
+            self.problem('code' not in resource, group_name, "missing-code", resource, "There is no code present in this resource")
+
+class ResourceInspector(Inspector):
+    def __init__(self, require_official, identifiers=None, report=None):
+        super().__init__(report)
+        # Fingerprints of each resourceType|system:value seen so far (see
+        # wstlr.fingerprints). Full strings take far too much memory for
+        # outputs with millions of resources
+        if identifiers is None:
+            identifiers = IdentifierSet()
+        self.identifiers = identifiers
         self.require_official = require_official
 
     def check_identifier(self, group_name, resource):
         if 'resourceType' not in resource:
-            print(resource)
-            print("No resourceType was found. As such, this is not a valid resource")
-            sys.exit(1)
-
-        ReportError('resourceType' not in resource, resource, "There is no resourceType specified in this resource")
+            if self.report is None:
+                print(resource)
+                print("No resourceType was found. As such, this is not a valid resource")
+                sys.exit(1)
+            # The ObservationInspector reports these
+            return
 
         # CMs can only have one identifier, which has all sorts of downstream issues with the system...so, skipping them for
         # now
         if resource['resourceType'] not in ['ConceptMap']:
-            ReportError('identifier' not in resource, resource, "There is no identifier present in this resource")
-        ReportError('meta' not in resource or 'tag' not in resource['meta'], resource, "There is no meta.tag present.")
+            self.problem('identifier' not in resource, group_name, "missing-identifier", resource, "There is no identifier present in this resource")
+        self.problem('meta' not in resource or 'tag' not in resource['meta'], group_name, "missing-meta-tag", resource, "There is no meta.tag present.")
+        if 'identifier' not in resource:
+            return
 
         if self.require_official:
-            ReportError(not CheckForUse(resource['identifier']), resource, "There is no 'use: official' as requested by portal team")
+            is_official = CheckForUse(resource['identifier'], exit_on_error=self.report is None)
+            self.problem(not is_official, group_name, "not-official", resource, "There is no 'use: official' as requested by portal team")
 
         identifier = resource['identifier']
         if type(identifier) is list:
             identifier = resource['identifier'][0]
-        
-        resourcetype = resource['resourceType']
         if 'system' not in identifier:
-            print(resource)
-            print(identifier)
-            print("identifier doesn't have a system")
-            sys.exit(1)
-        idval = f"{identifier['system']}:{identifier['value']}"
-
-        if idval in self.identifiers[resourcetype]:
-            print(resourcetype)
-            print(self.identifiers[resourcetype])
+            if self.report is None:
+                print(resource)
+                print(identifier)
+                print("identifier doesn't have a system")
+                sys.exit(1)
+            self.report.add(group_name, "missing-system", resource, "identifier doesn't have a system")
+            return
+
+        self.check_duplicate(group_name, resource)
+
+    @staticmethod
+    def identifier_key(resource):
+        """resourceType|system:value of the resource's (first) identifier, or
+        None if it doesn't have a usable one"""
+        identifier = resource.get('identifier')
+        if type(identifier) is list and len(identifier) > 0:
+            identifier = identifier[0]
+        if type(identifier) is not dict or 'system' not in identifier or 'resourceType' not in resource:
+            return None
+        return f"{resource['resourceType']}|{identifier['system']}:{identifier.get('value')}"
+
+    def check_duplicate(self, group_name, resource):
+        key = self.identifier_key(resource)
+        # Anything else has already been reported by check_identifier
+        if key is None:
+            return
 
-        ReportError(idval in self.identifiers[resourcetype], resource, f"The following identifier appears multiple times: \n{pformat(identifier)}")
-        self.identifiers[resourcetype].add(idval)
+        identifier = resource['identifier']
+        if type(identifier) is list:
+            identifier = identifier[0]
+        self.problem(self.identifiers.seen(key), group_name, "duplicate-identifier", resource, duplicate_message, f": \n{pformat(identifier)}")
 
 def exec():
     parser = ArgumentParser(
@@ -112,12 +168,80 @@ def exec():
         type=FileType('rt'),
         help="JSON output from Whistle to be inspected.",
     )
+    parser.add_argument(
+        "--fingerprint-bits",
+        type=int,
+        choices=[64, 128],
+        default=64,
+        help="Size of the fingerprints used to spot duplicate identifiers. 128 makes a false alarm all but impossible, at twice the memory"
+    )
+    parser.add_argument(
+        "--two-pass",
+        action='store_true',
+        help="Use even less memory to look for duplicate identifiers by reading the files twice"
+    )
+    parser.add_argument(
+        "--expected-resources",
+        type=int,
+        default=10000000,
+        help="Roughly how many resources to expect when using --two-pass"
+    )
+    add_inspection_arguments(parser)
+    add_profile_arguments(parser)
 
     args = parser.parse_args(sys.argv[1:])
-    resource_inspector = ResourceInspector(require_official=args.require_official)
-    obs_inspector = ObservationInspector()
-    summary = ModuleSummary()
-    for result_file in args.file:
-        modules = set(ParseBundle(result_file, [resource_inspector.check_identifier, obs_inspector.inspect, summary.summary]))
-
-    summary.print_summary()
+    if args.two_pass and args.inspect_workers > 1:
+        parser.error("--two-pass can't be combined with --inspect-workers")
+    profiler = Profiler.from_args(args)
+    report = None
+    if args.inspect_all:
+        report = InspectionReport()
+    title = ", ".join(Path(x.name).stem for x in args.file)
+
+    if args.inspect_workers > 1:
+        # Imported here, since it needs the inspectors defined above
+        from wstlr.parallel_inspection import inspect_parallel
+
+        for result_file in args.file:
+            result_file.close()
+        with profiler.stage("inspect"):
+            summary, parallel_report = inspect_parallel(
+                [x.name for x in args.file],
+                require_official=args.require_official,
+                workers=args.inspect_workers,
+                bits=args.fingerprint_bits
+            )
+        if report is None:
+            StopAtFirstProblem(parallel_report)
+        else:
+            report = parallel_report
+    else:
+        if args.two_pass:
+            identifiers = TwoPassIdentifierSet(args.expected_resources)
+        else:
+            identifiers = IdentifierSet(bits=args.fingerprint_bits)
+        resource_inspector = ResourceInspector(require_official=args.require_official, identifiers=identifiers, report=report)
+        obs_inspector = ObservationInspector(report=report)
+        summary = ModuleSummary()
+        for result_file in args.file:
+            with profiler.stage(f"inspect-{Path(result_file.name).stem}"):
+                modules = set(ParseBundle(result_file, [resource_inspector.check_identifier, obs_inspector.inspect, summary.summary]))
+
+        if args.two_pass and identifiers.needs_second_pass:
+            # Only the possible duplicates from the first pass are checked
+            identifiers.start_second_pass()
+            for result_file in args.file:
+                result_file.seek(0)
+                with profiler.stage(f"duplicates-{Path(result_file.name).stem}"):
+                    ParseBundle(result_file, [resource_inspector.check_duplicate])
+
+    summary.print_summary(title)
+    profiler.finish()
+
+    if report is not None:
+        report.print_report()
+        if args.inspection_report is not None:
+            report.save(args.inspection_report)
+            print(f"Report written to {args.inspection_report}")
+        if len(report) > 0:
+            sys.exit(1)
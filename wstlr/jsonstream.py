@@ -0,0 +1,149 @@
+"""
+Incremental reading of large JSON documents, such as the whistle input.
+
+The whistle input is a single object whose members are mostly arrays of
+rows (one array per table). json.load would hold the entire thing, and every
+row in it, in memory at once. iter_members() instead yields each top level
+member in turn; arrays are returned as generators which decode a single
+element at a time, so only the row currently being looked at needs to be in
+memory.
+
+    with open("whistle-input.json") as f:
+        for key, value in iter_members(f):
+            if isinstance(value, ArrayStream):
+                for row in value:
+                    ...
+
+Each array must be consumed (or abandoned) before moving on to the next
+member; anything left unread is skipped automatically.
+"""
+
+from __future__ import annotations
+
+import json
+from collections.abc import Iterator
+from typing import Any, TextIO
+
+_whitespace = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class JsonStreamError(ValueError):
+    pass
+
+
+class _Reader:
+    def __init__(self, stream: TextIO, chunk_size: int = 1 << 20) -> None:
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, minimum: int = 1) -> bool:
+        """Make sure at least minimum characters are available past pos.
+        Returns False if the end of the stream gets in the way"""
+        while len(self.buffer) - self.pos < minimum and not self.eof:
+            chunk = self.stream.read(max(self.chunk_size, minimum))
+            if chunk == "":
+                self.eof = True
+                break
+            # Drop whatever has already been consumed
+            self.buffer = self.buffer[self.pos :] + chunk
+            self.pos = 0
+        return len(self.buffer) - self.pos >= minimum
+
+    def peek(self) -> str:
+        """Returns the next non-whitespace character without consuming it"""
+        while True:
+            if not self.fill():
+                raise JsonStreamError("Unexpected end of JSON document")
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+    def expect(self, character: str) -> None:
+        found = self.peek()
+        if found != character:
+            raise JsonStreamError(f"Expected '{character}' but found '{found}'")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decodes the next complete value"""
+        self.peek()
+        needed = 1
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                value, end = None, None
+            # A number that runs right up to the end of the buffer may have
+            # more digits to come, so only trust it once we can see past it
+            if end is not None and (end < len(self.buffer) or self.eof):
+                self.pos = end
+                return value
+            if self.eof:
+                raise JsonStreamError("Unable to decode JSON value")
+            # Read more and try again. Doubling the request keeps this linear
+            # for values much larger than a single chunk
+            needed = max(needed * 2, len(self.buffer) - self.pos + self.chunk_size)
+            self.fill(needed)
+
+
+class ArrayStream:
+    """Iterates over the elements of an array, decoding them one at a time"""
+
+    def __init__(self, reader: _Reader) -> None:
+        self.reader = reader
+        self.done = False
+        self.first = True
+
+    def __iter__(self) -> Iterator[Any]:
+        return self
+
+    def __next__(self) -> Any:
+        if self.done:
+            raise StopIteration
+        reader = self.reader
+        if reader.peek() == "]":
+            reader.pos += 1
+            self.done = True
+            raise StopIteration
+        if not self.first:
+            reader.expect(",")
+        self.first = False
+        return reader.value()
+
+    def skip(self) -> None:
+        for _ in self:
+            pass
+
+
+def iter_members(stream: TextIO, chunk_size: int = 1 << 20) -> Iterator[tuple[str, Any]]:
+    """Yields (key, value) for each member of the top level object. Arrays
+    are yielded as ArrayStreams, everything else is fully decoded"""
+    reader = _Reader(stream, chunk_size)
+    # Skip a byte order mark, if there is one
+    if reader.fill() and reader.buffer.startswith("\ufeff"):
+        reader.pos = 1
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise JsonStreamError("Object keys must be strings")
+        reader.expect(":")
+        if reader.peek() == "[":
+            reader.pos += 1
+            array = ArrayStream(reader)
+            yield key, array
+            array.skip()
+        else:
+            yield key, reader.value()
+
+        if reader.peek() == "}":
+            return
+        reader.expect(",")
@@ -14,12 +14,13 @@ from pathlib import Path
 from argparse import ArgumentParser, FileType
 import json
 from copy import deepcopy
-from time import sleep
+from contextlib import nullcontext
+from time import perf_counter, sleep
 
 from pathlib import Path
 from ncpi_fhir_client.fhir_client import FhirClient
 from yaml import safe_load
-from wstlr.studyids import StudyIDs
+from wstlr.studyids import StudyIDs, open_study_ids
 
 import concurrent.futures
 from threading import Lock, current_thread, main_thread
@@ -104,6 +105,9 @@ class ResourceLoader:
         idcache=None,
         threaded=False,
         thread_count=10,
+        timings=None,
+        metrics=None,
+        study_ids_file=None,
     ):
         self.identifier_prefix = identifier_prefix
         self.identifier_rx = re.compile(identifier_prefix)
@@ -119,9 +123,17 @@ class ResourceLoader:
 
         self.study_id = study_id
 
-        self.studyids = StudyIDs(fhir_client.target_service_url, study_id)
         # We'll write this out at the end of the run so that we can have a complete
-        # list of IDs for purging if we want to clean them out
+        # list of IDs for purging if we want to clean them out. When we know
+        # where that is, the IDs are also logged as we go (see wstlr.studyids)
+        # so that they aren't lost if the load doesn't finish
+        self.study_ids_file = study_ids_file
+        if study_ids_file is None:
+            self.studyids = StudyIDs(fhir_client.target_service_url, study_id)
+        else:
+            self.studyids = open_study_ids(
+                fhir_client.target_service_url, study_ids_file, study_id
+            )
         self.observed_record_ids = defaultdict(list)
 
         # resourceType => # seen Useful only for validation cutoff.
@@ -143,6 +155,13 @@ class ResourceLoader:
         self.successful_loads = defaultdict(lambda: defaultdict(int))
         self.resource_summary = defaultdict(int)
 
+        # Optional CallTimings object (see wstlr.profiling) used to capture
+        # the time spent on each step of the load per resourceType
+        self.timings = timings
+
+        # Optional RunMetrics object (see wstlr.metrics) for live reporting
+        self.metrics = metrics
+
         self.records_loaded = 0
         if threaded:
             self.thread_executor = concurrent.futures.ThreadPoolExecutor(
@@ -174,6 +193,30 @@ class ResourceLoader:
                 return (official["system"], official["value"])
         return (None, None)
 
+    def timed(self, resource_type, step):
+        """Context manager recording the time spent in a step when timings
+        have been requested"""
+        if self.timings is None:
+            return nullcontext()
+        return self.timings.time(resource_type, step)
+
+    def in_flight(self):
+        """Context manager used to track the number of active requests"""
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.worker("load")
+
+    def observe_response(self, resource_type, result, start_time):
+        if self.metrics is not None:
+            self.metrics.observe_response(
+                "load", resource_type, result["status_code"], perf_counter() - start_time
+            )
+
+    def update_queue_metrics(self):
+        if self.metrics is not None:
+            self.metrics.queue_depth.set(len(self.load_queue), "load")
+            self.metrics.delayed.set(len(self.delayed_loading), "load")
+
     def launch_threads(self, msg=None):
         """This should be called before the application exits
 
@@ -187,10 +230,15 @@ class ResourceLoader:
                     concurrent.futures.as_completed(self.load_queue), msg
                 ):
                     entry.result()
+                    if self.metrics is not None:
+                        self.metrics.queue_depth.dec("load")
             else:
                 for entry in concurrent.futures.as_completed(self.load_queue):
                     entry.result()
+                    if self.metrics is not None:
+                        self.metrics.queue_depth.dec("load")
             self.load_queue = []
+            self.update_queue_metrics()
 
     def save_fails(self, filename):
         data = {}
@@ -239,6 +287,8 @@ class ResourceLoader:
             self.load_queue.append(
                 self.thread_executor.submit(self.load_resource, group_name, resource)
             )
+            if self.metrics is not None:
+                self.metrics.queue_depth.inc("load")
 
             if self.max_queue_size <= len(self.load_queue):
                 self.launch_threads()
@@ -257,12 +307,17 @@ class ResourceLoader:
                         if "resourceType" not in resource:
                             print(pformat(resource))
 
-                        build_references(resource, self.idcache, parent_key=None)
+                        with self.timed(
+                            resource.get("resourceType"), "build_references"
+                        ):
+                            build_references(resource, self.idcache, parent_key=None)
 
                     self.add_job_to_queue(group_name, resource)
 
                 except InvalidReference as e:
                     self.delayed_loading.append((group_name, resource))
+                    if self.metrics is not None:
+                        self.metrics.delayed.inc("load")
 
     def retry_loading(self, resources=None):
         if resources is None:
@@ -275,7 +330,8 @@ class ResourceLoader:
         ):
             try:
                 with load_lock:
-                    build_references(resource, self.idcache, parent_key=None)
+                    with self.timed(resource["resourceType"], "build_references"):
+                        build_references(resource, self.idcache, parent_key=None)
                 self.add_job_to_queue(group_name, resource)
 
             except InvalidReference:
@@ -284,6 +340,7 @@ class ResourceLoader:
 
         with load_lock:
             self.delayed_loading = delayed_again
+        self.update_queue_metrics()
 
     def consume_validate(self, group_name, resource, halt_on_warn=False):
         """Do we even care to use async with validate? I'm skipping it for now"""
@@ -337,9 +394,18 @@ class ResourceLoader:
         ):
             # For now, we'll just return a successful status code
             return {"status_code": 200}
+        if self.timings is not None:
+            # The client serializes the resource itself, so this is only an
+            # estimate of that cost. It's only incurred when profiling
+            with self.timed(resource_type, "serialize"):
+                json.dumps(resource)
+
         # We'll handle CodeSystems and ValueSets differently
         if resource_type in ["CodeSystem", "ValueSet", "ConceptMap"]:
-            result = self.client.load(resource_type, resource, validate_only)
+            start_time = perf_counter()
+            with self.timed(resource_type, "client.load"), self.in_flight():
+                result = self.client.load(resource_type, resource, validate_only)
+            self.observe_response(resource_type, result, start_time)
             if result["status_code"] < 300:
                 # Validation responses without any warnings or errors have no
                 # response entry
@@ -379,19 +445,22 @@ class ResourceLoader:
             while retry_count > 0:
                 retry_count -= 1
                 try:
-                    result = self.client.post(
-                        resource_type,
-                        resource,
-                        identifier=resource_identifier,
-                        identifier_system=system,
-                        identifier_type=identifier_type,
-                        validate_only=validate_only,
-                        retry_count=1,
-                    )
+                    start_time = perf_counter()
+                    with self.timed(resource_type, "client.post"), self.in_flight():
+                        result = self.client.post(
+                            resource_type,
+                            resource,
+                            identifier=resource_identifier,
+                            identifier_system=system,
+                            identifier_type=identifier_type,
+                            validate_only=validate_only,
+                            retry_count=1,
+                        )
                 except Exception as e:
                     print(f"Exception occured when loading {resource_type}: {e}")
                     print(resource)
                     print(f"{system}|{resource_identifier} {identifier_type}")
+                self.observe_response(resource_type, result, start_time)
                 if result["status_code"] < 300:
                     retry_count = 0
 
@@ -407,6 +476,9 @@ class ResourceLoader:
                 else:
                     print(f"\t{result['status_code']} : {result['request_url']}")
                     sleep(5)
+
+                if retry_count > 0 and result["status_code"] >= 300 and self.metrics is not None:
+                    self.metrics.retry("load", resource_type)
         if result["status_code"] < 300:
             self.successful_loads[group_name][resource_type] += 1
             self.resource_summary[resource_type] += 1
@@ -0,0 +1,409 @@
+"""
+Live metrics for long running loads and purges.
+
+ResourceLoader and ResourceDeleter accept an optional RunMetrics object
+which they update as they work. The metrics are rendered in the
+Prometheus/OpenMetrics text format and can be exposed on a local HTTP
+endpoint (--metrics-port) and/or written periodically to a textfile for
+node_exporter's textfile collector (--metrics-textfile).
+
+There is no dependency on prometheus_client. The handful of metric types
+we need are simple enough to maintain here.
+"""
+
+from __future__ import annotations
+
+import os
+from argparse import ArgumentParser, Namespace
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any
+
+from rich import print
+
+# Seconds. These cover everything from a fast local server to a heavily
+# throttled cloud endpoint
+default_buckets: tuple[float, ...] = (
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def add_metrics_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Expose live load/purge metrics in Prometheus format on "
+        "http://localhost:PORT/metrics",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        type=str,
+        default=None,
+        help="Periodically write load/purge metrics in Prometheus format to "
+        "this file (for node_exporter's textfile collector)",
+    )
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if len(names) == 0:
+        return ""
+    labels = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        labels.append(f'{name}="{value}"')
+    return "{" + ",".join(labels) + "}"
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = Lock()
+
+    def header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, description, labels)
+        self.values: defaultdict[tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] += amount
+
+    def snapshot(self) -> dict[tuple[str, ...], float]:
+        with self.lock:
+            return dict(self.values)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for label_values, value in sorted(self.snapshot().items()):
+            lines.append(
+                f"{self.name}_total{_format_labels(self.labels, label_values)} {value}"
+            )
+        return lines
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, description, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, *label_values: str) -> None:
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.append(
+                f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+            )
+        return lines
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = default_buckets,
+    ) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+        # label values => [per-bucket counts (+Inf last), sum]
+        self.values: dict[tuple[str, ...], list[Any]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[label_values] = entry
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        with self.lock:
+            values = sorted((k, (list(v[0]), v[1])) for k, v in self.values.items())
+
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labels + ("le",), label_values + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+        return lines
+
+
+class RateGauge(Metric):
+    """Per second rate of a counter over a sliding window, computed when
+    the metrics are rendered"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, description: str, counter: Counter, window: float = 60.0) -> None:
+        super().__init__(name, description, counter.labels)
+        self.counter = counter
+        self.window = window
+        self.history: list[tuple[float, dict[tuple[str, ...], float]]] = []
+
+    def render(self) -> list[str]:
+        now = monotonic()
+        current = self.counter.snapshot()
+
+        with self.lock:
+            self.history.append((now, current))
+            # Keep the most recent snapshot that is at least a full window
+            # old as our baseline
+            while len(self.history) > 2 and now - self.history[1][0] >= self.window:
+                self.history.pop(0)
+            then, previous = self.history[0]
+
+        lines = self.header()
+        elapsed = now - then
+        for label_values, value in sorted(current.items()):
+            rate = 0.0
+            if elapsed > 0:
+                rate = (value - previous.get(label_values, 0)) / elapsed
+            lines.append(
+                f"{self.name}{_format_labels(self.labels, label_values)} {rate:.3f}"
+            )
+        return lines
+
+
+class RunMetrics:
+    """The set of metrics reported by the loader and the deleter.
+
+    operation is either "load" or "delete" so that both can share a single
+    endpoint when run from the same process."""
+
+    def __init__(self, rate_window: float = 60.0) -> None:
+        self.resources = Counter(
+            "whistler_resources",
+            "Resources successfully loaded or deleted",
+            ("operation", "resource_type"),
+        )
+        self.resource_rate = RateGauge(
+            "whistler_resources_per_second",
+            f"Resources per second over the last {rate_window:.0f} seconds",
+            self.resources,
+            window=rate_window,
+        )
+        self.latency = Histogram(
+            "whistler_request_seconds",
+            "Latency of requests made to the FHIR server",
+            ("operation", "resource_type"),
+        )
+        self.responses = Counter(
+            "whistler_responses",
+            "Responses from the FHIR server by status class",
+            ("operation", "status_class"),
+        )
+        self.throttled = Counter(
+            "whistler_throttled",
+            "Responses with status 429 (Too Many Requests)",
+            ("operation", "resource_type"),
+        )
+        self.server_errors = Counter(
+            "whistler_server_errors",
+            "Responses with a 5xx status",
+            ("operation", "resource_type"),
+        )
+        self.retries = Counter(
+            "whistler_retries",
+            "Requests that were retried",
+            ("operation", "resource_type"),
+        )
+        self.delayed = Gauge(
+            "whistler_delayed_resources",
+            "Resources waiting on a retry (unresolved references or delete conflicts)",
+            ("operation",),
+        )
+        self.queue_depth = Gauge(
+            "whistler_queue_depth",
+            "Jobs submitted to the thread pool that haven't been collected",
+            ("operation",),
+        )
+        self.active_workers = Gauge(
+            "whistler_active_workers",
+            "Requests currently in progress",
+            ("operation",),
+        )
+
+        self.metrics: list[Metric] = [
+            self.resources,
+            self.resource_rate,
+            self.latency,
+            self.responses,
+            self.throttled,
+            self.server_errors,
+            self.retries,
+            self.delayed,
+            self.queue_depth,
+            self.active_workers,
+        ]
+
+        self.server: ThreadingHTTPServer | None = None
+        self.textfile: Path | None = None
+        self.textfile_interval = 15.0
+        self.stop_event = Event()
+        self.threads: list[Thread] = []
+
+    @classmethod
+    def from_args(cls, args: Namespace) -> RunMetrics | None:
+        """Returns None unless the user asked for metrics"""
+        if args.metrics_port is None and args.metrics_textfile is None:
+            return None
+
+        metrics = cls()
+        if args.metrics_port is not None:
+            metrics.serve(args.metrics_port)
+        if args.metrics_textfile is not None:
+            metrics.write_textfile_periodically(args.metrics_textfile)
+        return metrics
+
+    def observe_response(
+        self, operation: str, resource_type: str, status_code: int, seconds: float
+    ) -> None:
+        self.latency.observe(seconds, operation, resource_type)
+        self.responses.inc(operation, f"{status_code // 100}xx")
+
+        if status_code < 300:
+            self.resources.inc(operation, resource_type)
+        elif status_code == 429:
+            self.throttled.inc(operation, resource_type)
+        elif status_code >= 500:
+            self.server_errors.inc(operation, resource_type)
+
+    def retry(self, operation: str, resource_type: str) -> None:
+        self.retries.inc(operation, resource_type)
+
+    @contextmanager
+    def worker(self, operation: str) -> Iterator[None]:
+        self.active_workers.inc(operation)
+        try:
+            yield
+        finally:
+            self.active_workers.dec(operation)
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self.metrics:
+            lines += metric.render()
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type",
+                    "application/openmetrics-text; version=1.0.0; charset=utf-8",
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                # Scrapes would otherwise clutter up the load output
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        print(f"Serving metrics at http://{host}:{self.server.server_port}/metrics")
+
+    def write_textfile(self) -> None:
+        assert self.textfile is not None
+        # node_exporter may read the file at any time, so write it
+        # somewhere else first and then move it into place
+        tmpfile = self.textfile.with_name(f".{self.textfile.name}.{os.getpid()}")
+        tmpfile.write_text(self.render())
+        os.replace(tmpfile, self.textfile)
+
+    def write_textfile_periodically(
+        self, filename: str | os.PathLike[str], interval: float | None = None
+    ) -> None:
+        self.textfile = Path(filename)
+        self.textfile.parent.mkdir(parents=True, exist_ok=True)
+        if interval is not None:
+            self.textfile_interval = interval
+
+        def writer() -> None:
+            while not self.stop_event.wait(self.textfile_interval):
+                self.write_textfile()
+
+        self.write_textfile()
+        thread = Thread(target=writer, name="metrics-textfile", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self) -> None:
+        """Write out the final values and shut down the endpoint"""
+        self.stop_event.set()
+        if self.textfile is not None:
+            self.write_textfile()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
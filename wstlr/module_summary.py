@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from collections import defaultdict
+from functools import partial
 from typing import Any
 
 from rich import print
@@ -12,8 +13,10 @@ class ModuleSummary:
         self.resource_types = resource_types
 
         # Module-name => ResourceType => count
+        # (partial rather than a lambda, so summaries can be sent between
+        # processes)
         self.module_summary: defaultdict[str, defaultdict[str, int]] = defaultdict(
-            lambda: defaultdict(int)
+            partial(defaultdict, int)
         )
         self.resource_summary: defaultdict[str, int] = defaultdict(int)
 
@@ -23,6 +26,14 @@ class ModuleSummary:
             self.module_summary[group_name][resourceType] += 1
             self.resource_summary[resourceType] += 1
 
+    def merge(self, other: ModuleSummary) -> None:
+        """Add the other summary's counts to ours"""
+        for modulename, counts in other.module_summary.items():
+            for resourcetype, count in counts.items():
+                self.module_summary[modulename][resourcetype] += count
+        for resourcetype, count in other.resource_summary.items():
+            self.resource_summary[resourcetype] += count
+
     def print_summary(self, study_id: str) -> None:
         print(f"\nModule Summary [green]({study_id})[/green]")
         print(
@@ -0,0 +1,137 @@
+"""
+Inspect whistle output across several worker processes.
+
+Each worker streams the output files itself (see wstlr.jsonstream), so the
+whole output never has to be loaded or sent between processes. Resources
+are dealt out to the workers in batches: worker i inspects every batch
+whose number (counting from the start of each module) plus the module's
+position in the output is i, modulo the number of workers. That spreads a
+single large module across all of the workers, too. The workers still have
+to read past everyone else's batches, but the per-resource checks,
+fingerprinting and summaries are divided between them.
+
+Each worker returns its InspectionReport, ModuleSummary and the fingerprints
+of the identifiers it saw, which are merged in worker order. Duplicates
+within a worker's share have already been reported by then. Duplicates
+across shares show up as the fingerprints two workers have in common, in
+which case a second pass finds each worker's first resource
+with one of those fingerprints, so they can be reported as well.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import repeat
+from typing import Any
+
+from wstlr.fingerprints import FingerprintSet, IdentifierSet, fingerprint
+from wstlr.inspection_report import InspectionReport, describe
+from wstlr.inspector import ObservationInspector, ResourceInspector, duplicate_message
+from wstlr.jsonstream import ArrayStream, iter_members
+from wstlr.module_summary import ModuleSummary
+
+
+@dataclass
+class InspectionTask:
+    filenames: list[str]
+    worker: int
+    workers: int
+    require_official: bool
+    bits: int = 64
+    batch_size: int = 1000
+
+
+@dataclass
+class InspectionResult:
+    worker: int
+    identifiers: FingerprintSet
+    report: InspectionReport
+    summary: ModuleSummary = field(default_factory=ModuleSummary)
+
+
+def iter_share(
+    filenames: list[str], worker: int, workers: int, batch_size: int = 1000
+) -> Iterator[tuple[str, dict[str, Any]]]:
+    """(module, resource) for each resource in the output files that belongs
+    to the worker"""
+    module_number = 0
+    for filename in filenames:
+        with open(filename, "rt", encoding="utf-8") as f:
+            for module, resources in iter_members(f):
+                if not isinstance(resources, ArrayStream):
+                    continue
+                for index, resource in enumerate(resources):
+                    batch = index // batch_size
+                    if (module_number + batch) % workers != worker:
+                        continue
+                    if type(resource) is dict:
+                        yield module, resource
+                module_number += 1
+
+
+def inspect_share(task: InspectionTask) -> InspectionResult:
+    report = InspectionReport()
+    identifiers = IdentifierSet(task.bits)
+    resource_inspector = ResourceInspector(
+        require_official=task.require_official, identifiers=identifiers, report=report
+    )
+    obs_inspector = ObservationInspector(report=report)
+    summary = ModuleSummary()
+
+    for module, resource in iter_share(task.filenames, task.worker, task.workers, task.batch_size):
+        resource_inspector.check_identifier(module, resource)
+        obs_inspector.inspect(module, resource)
+        summary.summary(module, resource)
+    return InspectionResult(task.worker, identifiers.fingerprints, report, summary)
+
+
+def first_occurrences(task: InspectionTask, wanted: set[int]) -> dict[int, tuple[str, str]]:
+    """fingerprint => (module, sample) for the first resource in the task's
+    share with each of the wanted fingerprints"""
+    found: dict[int, tuple[str, str]] = {}
+    for module, resource in iter_share(task.filenames, task.worker, task.workers, task.batch_size):
+        key = ResourceInspector.identifier_key(resource)
+        if key is None:
+            continue
+        value = fingerprint(key, task.bits)
+        if value in wanted and value not in found:
+            found[value] = (module, describe(resource))
+    return found
+
+
+def inspect_parallel(
+    filenames: list[str],
+    require_official: bool,
+    workers: int = 4,
+    bits: int = 64,
+    batch_size: int = 1000,
+) -> tuple[ModuleSummary, InspectionReport]:
+    """Inspect the files, returning the combined summary and every problem
+    found"""
+    tasks = [
+        InspectionTask(filenames, worker, workers, require_official, bits, batch_size)
+        for worker in range(workers)
+    ]
+
+    summary = ModuleSummary()
+    report = InspectionReport()
+    identifiers = FingerprintSet(bits=bits)
+    shared: set[int] = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(inspect_share, tasks):
+            summary.merge(result.summary)
+            report.merge(result.report)
+            shared.update(identifiers.update(result.identifiers))
+
+        if len(shared) > 0:
+            # Whichever worker comes first keeps its resource, just as if
+            # the shares had been inspected one after another
+            reported: set[int] = set()
+            for found in executor.map(first_occurrences, tasks, repeat(shared)):
+                for value, (module, sample) in found.items():
+                    if value in reported:
+                        report.add_sample(module, "duplicate-identifier", sample, duplicate_message)
+                    reported.add(value)
+    return summary, report
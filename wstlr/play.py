@@ -5,7 +5,13 @@
 from pathlib import Path
 from wstlr.conceptmap import BuildConceptMap
 from wstlr.extractor import DataCsvToObject
-from wstlr.inspector import ResourceInspector, ObservationInspector
+from wstlr.inspector import ResourceInspector, ObservationInspector, StopAtFirstProblem
+from wstlr.parallel_inspection import inspect_parallel
+from wstlr.fhirvalidate import (
+    add_local_validation_arguments,
+    build_validator,
+    validate_output,
+)
 from wstlr.module_summary import ModuleSummary
 
 from subprocess import run
@@ -29,8 +35,14 @@ from rich.progress import track
 
 from ncpi_fhir_client.ridcache import RIdCache
 from wstlr.config import Configuration
+from wstlr.profiling import Profiler, add_profile_arguments
+from wstlr.metrics import RunMetrics, add_metrics_arguments
+from wstlr.dryrun import MemoryIdCache, NullFhirClient, print_dry_run_summary
+from wstlr.httpcache import add_http_cache_arguments, set_offline
+from wstlr.validate import add_validate_arguments, validate_data
+from wstlr.inspection_report import InspectionReport, add_inspection_arguments
 
-from time import sleep
+from time import perf_counter, sleep
 
 
 import os
@@ -271,17 +283,41 @@ def exec():
         action="store_true",
         help="If set, whistler will not exit when duplicate IDs are encountered by during caching. ",
     )
+    parser.add_argument(
+        "--dry-run-load",
+        action="store_true",
+        help="Run the loader without a FHIR server. Resources are assigned synthetic IDs and nothing is sent anywhere. Reports the rate the loader can sustain on our side and any references that couldn't be resolved. No --host is required.",
+    )
+    parser.add_argument(
+        "--study-ids-db",
+        type=str,
+        default=None,
+        help="SQLite database (.sqlite) to record the IDs of everything loaded in, rather than the output directory's study-ids.json. IDs are written as they are created and delfhir can read them straight from the database.",
+    )
+    add_profile_arguments(parser)
+    add_metrics_arguments(parser)
+    add_http_cache_arguments(parser)
+    add_validate_arguments(parser)
+    add_inspection_arguments(parser)
+    add_local_validation_arguments(parser)
 
     args = parser.parse_args(sys.argv[1:])
+    profiler = Profiler.from_args(args)
+    metrics = RunMetrics.from_args(args)
+    set_offline(args.offline)
 
     if args.bundle_only:
         args.save_bundle = True
 
     host = args.host
 
+    # Profiles for --local-validation, only compiled once
+    validator = None
+
     should_sleep = False
     for config_file in args.config:
-        cfg = Configuration(config_file)
+        with profiler.stage("configuration"):
+            cfg = Configuration(config_file)
         require_official = cfg.require_official
 
         print("--------------------------------------------------------------")
@@ -322,8 +358,22 @@ def exec():
         whistle_src = f"{prj_home}/{cfg.whistle_src}"
         projection_lib = f"{prj_home}/{args.projection_version}"
 
+        if args.validate_data:
+            with profiler.stage("validate"):
+                report = validate_data(cfg)
+            report.print_report()
+            if args.validation_report is not None:
+                report.save(args.validation_report)
+            if len(report.errors) > 0:
+                print(
+                    "[red]The data doesn't agree with the data-dictionary. Please "
+                    "correct the errors above before running whistle.[/red]"
+                )
+                sys.exit(1)
+
         try:
-            dataset = DataCsvToObject(cfg)
+            with profiler.stage("extract"):
+                dataset = DataCsvToObject(cfg)
         except FileNotFoundError as e:
             sys.stderr.write(f"ERROR: Unable to find file, {e.filename}.\n")
             sys.exit(1)
@@ -331,32 +381,37 @@ def exec():
         cm_timestamp = None
         harmony_files = set()
 
-        if cfg.code_harmonization:
-            cm_timestamp = BuildConceptMap(
-                cfg.code_harmonization,
-                curies=cfg.curies,
-                name_prefix=cfg.harmony_prefix,
-                outname=f"{cfg.code_harmonization_dir}/{cfg.harmony_prefix}.json",
-                codesystems=dataset["code-systems"],
-            )
-
-            harmony_files = set(cfg.code_harmonization)
-
-        # Build ConceptMaps if provided
-        for dsname, dsconfig in cfg.dataset.items():
-            # We do want to rebuild each harmony file once per config, but
-            # no need to do it more than that.
-            if (
-                "code_harmonization" in dsconfig
-                and dsconfig["code_harmonization"] not in harmony_files
-            ):
-                # For old style harmony entries, we assume only one at a time
+        with profiler.stage("conceptmap"):
+            if cfg.code_harmonization:
                 cm_timestamp = BuildConceptMap(
-                    [dsconfig["code_harmonization"]],
+                    cfg.code_harmonization,
                     curies=cfg.curies,
+                    name_prefix=cfg.harmony_prefix,
+                    outname=f"{cfg.code_harmonization_dir}/{cfg.harmony_prefix}.json",
                     codesystems=dataset["code-systems"],
+                    dd_self_maps=cfg.harmony_dd_self_maps,
+                    merge_groups=cfg.harmony_merge_groups,
                 )
-                harmony_files.add(dsconfig["code_harmonization"])
+
+                harmony_files = set(cfg.code_harmonization)
+
+            # Build ConceptMaps if provided
+            for dsname, dsconfig in cfg.dataset.items():
+                # We do want to rebuild each harmony file once per config, but
+                # no need to do it more than that.
+                if (
+                    "code_harmonization" in dsconfig
+                    and dsconfig["code_harmonization"] not in harmony_files
+                ):
+                    # For old style harmony entries, we assume only one at a time
+                    cm_timestamp = BuildConceptMap(
+                        [dsconfig["code_harmonization"]],
+                        curies=cfg.curies,
+                        codesystems=dataset["code-systems"],
+                        dd_self_maps=cfg.harmony_dd_self_maps,
+                        merge_groups=cfg.harmony_merge_groups,
+                    )
+                    harmony_files.add(dsconfig["code_harmonization"])
 
         input_file_ts = check_latest_update(
             cfg, prj_home, whistle_src, projection_lib, cm_timestamp
@@ -367,7 +422,7 @@ def exec():
             or not whistle_input.exists()
             or input_file_ts > whistle_input.stat().st_mtime
         ):
-            with whistle_input.open(mode="wt") as f:
+            with profiler.stage("write-input"), whistle_input.open(mode="wt") as f:
                 f.write(json.dumps(dataset, indent=2))
 
         # We'll move the output into the projection type directory
@@ -393,45 +448,100 @@ def exec():
 
             # Switch to using modular projection libraries
             print(f"Whistle source: {whistle_src}")
-            result_file = run_whistle(
-                whistlefile=whistle_src,
-                inputfile=str(whistle_input),
-                harmonydir=cfg.code_harmonization_dir,
-                projectorlib=projection_lib,
-                outputdir=str(output_directory),
-                whistle_path=whistle_path,
-            )
+            with profiler.stage("whistle"):
+                result_file = run_whistle(
+                    whistlefile=whistle_src,
+                    inputfile=str(whistle_input),
+                    harmonydir=cfg.code_harmonization_dir,
+                    projectorlib=projection_lib,
+                    outputdir=str(output_directory),
+                    whistle_path=whistle_path,
+                )
 
             # We really only want to run this when we generate a new Whistle file,
             # so we'll do this work separately from the other consumers
-            resource_inspector = ResourceInspector(require_official=require_official)
-            obs_inspector = ObservationInspector()
-            resource_summary = ModuleSummary()
-            with open(result_file, "rt") as f:
-                ParseBundle(
-                    f,
-                    [
-                        resource_inspector.check_identifier,
-                        obs_inspector.inspect,
-                        resource_summary.summary,
-                    ],
+            inspection = None
+            if args.inspect_all:
+                inspection = InspectionReport()
+            if args.inspect_workers > 1:
+                with profiler.stage("inspect"):
+                    resource_summary, parallel_report = inspect_parallel(
+                        [result_file],
+                        require_official=require_official,
+                        workers=args.inspect_workers,
+                    )
+                if inspection is None:
+                    StopAtFirstProblem(parallel_report)
+                else:
+                    inspection = parallel_report
+            else:
+                resource_inspector = ResourceInspector(
+                    require_official=require_official, report=inspection
                 )
+                obs_inspector = ObservationInspector(report=inspection)
+                resource_summary = ModuleSummary()
+                with profiler.stage("inspect"), open(result_file, "rt") as f:
+                    ParseBundle(
+                        f,
+                        [
+                            resource_inspector.check_identifier,
+                            obs_inspector.inspect,
+                            resource_summary.summary,
+                        ],
+                    )
             resource_summary.print_summary(cfg.study_id)
+            if inspection is not None:
+                inspection.print_report()
+                if args.inspection_report is not None:
+                    inspection.save(args.inspection_report)
+                if len(inspection) > 0:
+                    print(
+                        "[red]Inspection found problems with the whistle output. "
+                        "Please correct them before loading.[/red]"
+                    )
+                    sys.exit(1)
         else:
             result_file = str(whistle_output)
             print(f"Skipping whistle since none of the input has changed")
 
-        if host:
+        if args.local_validation is not None:
+            with profiler.stage("local-validation"):
+                if validator is None:
+                    validator = build_validator(
+                        args.local_validation, args.default_profile
+                    )
+                validation = validate_output(
+                    [result_file], validator, workers=args.local_validation_workers
+                )
+            validation.print_summary()
+            if args.local_validation_report is not None:
+                validation.report.save(args.local_validation_report)
+            if len(validation.report) > 0:
+                print(
+                    "[red]The whistle output doesn't conform to the IG's profiles. "
+                    "Please correct the problems above before loading.[/red]"
+                )
+                sys.exit(1)
+
+        if host or args.dry_run_load:
             if args.max_validations > 0:
                 ResourceLoader._max_validations_per_resource = args.max_validations
-            cache_remote_ids = RIdCache(
-                study_id=cfg.study_id, valid_patterns=cfg.fhir_id_patterns
-            )
-            fhir_client = FhirClient(
-                host_config[host],
-                idcache=cache_remote_ids,
-                exit_on_dupes=not args.permit_cache_dupes,
-            )
+            if args.dry_run_load:
+                cache_remote_ids = MemoryIdCache()
+                fhir_client = NullFhirClient()
+            else:
+                cache_remote_ids = RIdCache(
+                    study_id=cfg.study_id, valid_patterns=cfg.fhir_id_patterns
+                )
+                fhir_client = FhirClient(
+                    host_config[host],
+                    idcache=cache_remote_ids,
+                    exit_on_dupes=not args.permit_cache_dupes,
+                )
+
+            study_ids_file = output_directory / f"study-ids.json"
+            if args.study_ids_db is not None:
+                study_ids_file = Path(args.study_ids_db)
 
             loader = ResourceLoader(
                 cfg.identifier_prefix,
@@ -442,6 +552,9 @@ def exec():
                 idcache=cache_remote_ids,
                 threaded=args.threaded,
                 thread_count=args.thread_count,
+                timings=profiler.timings,
+                metrics=metrics,
+                study_ids_file=None if args.dry_run_load else study_ids_file,
             )
             if args.threaded:
                 print("Threading enabled")
@@ -471,27 +584,38 @@ def exec():
                 )
                 resource_consumers.append(transaction_bundle.consume_resource)
 
-            with open(result_file, "rt") as f:
-                ParseBundle(f, resource_consumers)
-
-            max_final_attempts = 10
-            if not args.validate_only:
-                while len(loader.delayed_loading) > 0 and max_final_attempts > 0:
-                    # Make sure we clear out the queue in case there are some
-                    # things there that these reloads depend on
-                    loader.launch_threads()
-
-                    print(
-                        f"Attempting to load {len(loader.delayed_loading)} left-overs. "
-                    )
-                    loader.retry_loading()
-                    max_final_attempts -= 1
-
-            # Launch anything that was lingering in the queue
-            loader.cleanup_threads()
+            load_start = perf_counter()
+            with profiler.stage("load"):
+                with open(result_file, "rt") as f:
+                    ParseBundle(f, resource_consumers)
+
+                max_final_attempts = 10
+                if not args.validate_only:
+                    while len(loader.delayed_loading) > 0 and max_final_attempts > 0:
+                        # Make sure we clear out the queue in case there are some
+                        # things there that these reloads depend on
+                        loader.launch_threads()
+
+                        print(
+                            f"Attempting to load {len(loader.delayed_loading)} left-overs. "
+                        )
+                        loader.retry_loading()
+                        max_final_attempts -= 1
+
+                # Launch anything that was lingering in the queue
+                loader.cleanup_threads()
+            load_elapsed = perf_counter() - load_start
             loader.print_summary()
-            loader.save_fails(output_directory / f"invalid-references.json")
-            loader.save_study_ids(output_directory / f"study-ids.json")
+            if args.dry_run_load:
+                # The IDs are synthetic, so there is nothing worth keeping
+                print_dry_run_summary(loader, load_elapsed)
+            else:
+                loader.save_fails(output_directory / f"invalid-references.json")
+                loader.save_study_ids(study_ids_file)
 
             if args.save_bundle:
                 transaction_bundle.close_bundle()
+
+    profiler.finish()
+    if metrics is not None:
+        metrics.stop()
@@ -0,0 +1,230 @@
+"""
+Opt-in profiling for the command line tools.
+
+Each CLI that supports --profile wraps its pipeline stages with
+Profiler.stage(), which writes one profile per stage into the profile
+directory. By default, this is a cProfile dump (readable with pstats or
+snakeviz). If pyinstrument is installed, --profile-mode sample will use it
+instead and write collapsed stacks suitable for flamegraph.pl/speedscope.
+
+CallTimings captures wall-clock time spent, per resourceType, in the
+individual steps of the loader (build_references, JSON serialization and
+the FhirClient calls). Those run inside worker threads when loading with
+--threaded, where cProfile can't reliably follow them.
+"""
+
+from __future__ import annotations
+
+import cProfile
+import json
+import os
+import re
+from argparse import ArgumentParser, Namespace
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Any
+
+from rich import print
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:
+    SamplingProfiler = None
+
+profile_modes = ["cprofile", "sample"]
+
+
+def add_profile_arguments(parser: ArgumentParser) -> None:
+    """Add the shared --profile options to a CLI's argument parser"""
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Profile each stage of the run and write the results to DIR. "
+        "Loads will also report time spent per resourceType.",
+    )
+    parser.add_argument(
+        "--profile-mode",
+        choices=profile_modes,
+        default="cprofile",
+        help="cprofile writes a pstats file per stage. sample uses "
+        "pyinstrument (if installed) and writes collapsed stacks.",
+    )
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_")
+
+
+class Profiler:
+    def __init__(self, output_dir: str | os.PathLike[str] | None = None, mode: str = "cprofile") -> None:
+        self.output_dir = None if output_dir is None else Path(output_dir)
+        self.mode = mode
+
+        if self.mode == "sample" and SamplingProfiler is None:
+            print(
+                "[yellow]pyinstrument isn't installed, falling back to "
+                "cProfile for --profile-mode sample[/yellow]"
+            )
+            self.mode = "cprofile"
+
+        # Stage name => number of times we've seen it. Multiple configs
+        # will run the same stages more than once
+        self.stage_counts: defaultdict[str, int] = defaultdict(int)
+
+        # Stage name => total elapsed seconds
+        self.stage_times: dict[str, float] = {}
+
+        self.timings: CallTimings | None = None
+        if self.output_dir is not None:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            self.timings = CallTimings()
+
+    @classmethod
+    def from_args(cls, args: Namespace) -> Profiler:
+        return cls(args.profile, mode=args.profile_mode)
+
+    @property
+    def enabled(self) -> bool:
+        return self.output_dir is not None
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Profile the body of the with block as a single stage"""
+        if not self.enabled:
+            yield
+            return
+
+        assert self.output_dir is not None
+        self.stage_counts[name] += 1
+        filename = self.output_dir / f"{_safe_name(name)}-{self.stage_counts[name]:02d}"
+
+        start = perf_counter()
+        if self.mode == "sample":
+            sampler = SamplingProfiler()
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self.write_collapsed(sampler, filename.parent / f"{filename.name}.collapsed")
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(filename.parent / f"{filename.name}.pstats")
+
+        elapsed = perf_counter() - start
+        self.stage_times[name] = self.stage_times.get(name, 0.0) + elapsed
+        print(f"[dim]Profiled stage, {name}, in {elapsed:.2f}s: {filename}[/dim]")
+
+    def write_collapsed(self, sampler: Any, filename: Path) -> None:
+        """Write pyinstrument's call tree as collapsed stacks"""
+        stacks: defaultdict[str, float] = defaultdict(float)
+
+        def walk(frame: Any, path: list[str]) -> None:
+            if frame is None:
+                return
+            path = path + [f"{frame.function} ({Path(frame.file_path or '').name}:{frame.line_no})"]
+            self_time = frame.time - sum(child.time for child in frame.children)
+            if self_time > 0:
+                stacks[";".join(path)] += self_time
+            for child in frame.children:
+                walk(child, path)
+
+        walk(sampler.last_session.root_frame(), [])
+
+        with filename.open("wt") as f:
+            for stack, seconds in stacks.items():
+                # Collapsed stack counts are integers, so we'll use
+                # microseconds
+                f.write(f"{stack} {int(seconds * 1e6)}\n")
+
+    def finish(self) -> None:
+        """Print the stage summary and write out the loader timings"""
+        if not self.enabled:
+            return
+
+        assert self.output_dir is not None
+        print("\nProfile Summary")
+        print("Stage                            Seconds")
+        print("-------------------------------- ----------")
+        for name, elapsed in self.stage_times.items():
+            print(f"{name:<32} {elapsed:>10.2f}")
+
+        if self.timings is not None and len(self.timings.timings) > 0:
+            self.timings.print_summary()
+            self.timings.dump(self.output_dir / "call-timings.json")
+
+
+class CallTimings:
+    """Thread safe accumulator of time spent per resourceType and step"""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+
+        # resourceType => step => [call count, total seconds, max seconds]
+        self.timings: defaultdict[str, dict[str, list[float]]] = defaultdict(dict)
+
+    def record(self, resource_type: str, step: str, seconds: float) -> None:
+        with self.lock:
+            entry = self.timings[resource_type].get(step)
+            if entry is None:
+                self.timings[resource_type][step] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                if seconds > entry[2]:
+                    entry[2] = seconds
+
+    @contextmanager
+    def time(self, resource_type: str, step: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(resource_type, step, perf_counter() - start)
+
+    def as_dict(self) -> dict[str, dict[str, dict[str, float]]]:
+        with self.lock:
+            return {
+                resource_type: {
+                    step: {
+                        "calls": int(calls),
+                        "total_seconds": total,
+                        "mean_ms": 1000.0 * total / calls,
+                        "max_ms": 1000.0 * longest,
+                    }
+                    for step, (calls, total, longest) in steps.items()
+                }
+                for resource_type, steps in self.timings.items()
+            }
+
+    def dump(self, filename: str | os.PathLike[str]) -> None:
+        with Path(filename).open("wt") as f:
+            json.dump(self.as_dict(), f, indent=2)
+        print(f"Call timings written to {filename}")
+
+    def print_summary(self) -> None:
+        print("\nLoader Timings")
+        print(
+            "Resource Type            Step                 Calls     Total (s)  Mean (ms)  Max (ms)"
+        )
+        print(
+            "------------------------ -------------------- --------- ---------- ---------- ----------"
+        )
+        for resource_type, steps in sorted(self.as_dict().items()):
+            for step, stats in sorted(steps.items()):
+                print(
+                    f"{resource_type:<24} {step:<20} {stats['calls']:<9} "
+                    f"{stats['total_seconds']:>10.2f} {stats['mean_ms']:>10.2f} "
+                    f"{stats['max_ms']:>10.2f}"
+                )
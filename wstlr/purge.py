@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
-from wstlr.studyids import StudyIDs
+from wstlr.studyids import open_study_ids
 from wstlr.hostfile import load_hosts_file
+from wstlr.profiling import Profiler, add_profile_arguments
+from wstlr.metrics import RunMetrics, add_metrics_arguments
+from wstlr.refgraph import blocking_referrer, from_whistle_output, next_link, scan_server
 from collections import defaultdict
 
 from ncpi_fhir_client.fhir_client import FhirClient
@@ -10,14 +13,42 @@ from copy import deepcopy
 
 import datetime
 import time
+from contextlib import nullcontext
 import concurrent.futures
 from threading import Lock, current_thread, main_thread
 
+import re
 import sys
 from argparse import ArgumentParser, FileType
 
 del_lock = Lock()
 
+# Number of IDs requested per page when purging by tag
+default_page_size = 500
+
+# Number of DELETEs sent in each batch Bundle by delfhir
+default_batch_size = 100
+
+# Ways of asking the server how many resources match a search without
+# returning them, in order of preference
+count_queries = ["_summary=count", "_total=accurate&_count=0"]
+
+def entry_status(entry):
+    """The numeric status of a batch-response entry, e.g. '409 Conflict'"""
+    status = str(entry.get('response', {}).get('status', '500')).strip()
+    try:
+        return int(status.split()[0])
+    except ValueError:
+        return 500
+
+def diagnostics(outcome):
+    """The first diagnostic message of an OperationOutcome, if any"""
+    if type(outcome) is dict:
+        for issue in outcome.get('issue', []):
+            if 'diagnostics' in issue:
+                return issue['diagnostics']
+    return None
+
 resource_order = [
     'CodeSystem',
     'ValueSet',
@@ -40,8 +71,10 @@ resource_order = [
 ]
 
 class ResourceDeleter:
-    def __init__(self, client, threaded=False, max_queue_size=5000, thread_count=10):
+    def __init__(self, client, threaded=False, max_queue_size=5000, thread_count=10, metrics=None):
         self.client = client
+        # Optional RunMetrics object (see wstlr.metrics) for live reporting
+        self.metrics = metrics
         self.studyids = None
 
         self.threaded = threaded
@@ -51,6 +84,35 @@ class ResourceDeleter:
         self.ids_to_delete = defaultdict(list)
         self.delayed_deletes = defaultdict(list)
         self.records_purged = 0
+
+        # resource type => number of resources successfully deleted
+        self.deleted = defaultdict(int)
+        self.page_size = default_page_size
+
+        # When larger than 1, deletes are sent as batch Bundles of this size
+        self.batch_size = 1
+        # resource type => IDs waiting to fill a batch
+        self.pending_batch = defaultdict(list)
+
+        # Purge by tag with a single conditional DELETE per resource type
+        # when the server says that it supports it
+        self.conditional_delete = True
+        self._capabilities = None
+
+        # The reference graph (see wstlr.refgraph) of whatever is being purged.
+        # When we have one, resources are deleted in its order and conflicts
+        # with other resources in the graph are resolved on the spot
+        self.graph = None
+        # Resource types in the order they should be deleted, if known
+        self.type_order = None
+        # (resourceType, id) of everything deleted so far using the graph
+        self.purged = set()
+        # How long a chain of blocking referrers we'll follow
+        self.max_conflict_depth = 5
+
+        # Which of count_queries the server understands. False if none of
+        # them, None until we've checked
+        self.count_query = None
         self.threaded = threaded
         self.max_queue_size = max_queue_size
         self.del_queue = []
@@ -60,9 +122,178 @@ class ResourceDeleter:
             self.thread_executor = concurrent.futures.ThreadPoolExecutor(max_workers=thread_count)
 
     def load_studyids(self, filename):
-        self.studyids = StudyIDs(self.client.target_service_url)
+        self.studyids = open_study_ids(self.client.target_service_url, filename)
         return self.studyids.load_from_file(filename)
 
+    def order_resources(self, ordered_resources):
+        """Put the resource types into the order derived from the reference
+        graph, if there is one. Anything the graph doesn't know about goes
+        first"""
+        if self.type_order is None:
+            return ordered_resources
+        known = [x for x in self.type_order if x in ordered_resources]
+        return [x for x in ordered_resources if x not in known] + known
+
+    def build_reference_graph(self, study_id, resource_list=None, by_tag=False, whistle_output=None, scan=False):
+        """Work out the order to delete things from the references between
+        them. The whistle output (if provided) gives us the order of the
+        resource types and tells us which elements hold references. Only
+        when asked to scan are the server's copies read (just their
+        reference elements, see refgraph.scan_server) to build the graph
+        itself. The whole graph is held in memory, so this is best kept
+        for studies of a modest size.
+
+        When purging by tag, types the server can delete with a single
+        conditional DELETE are left out of the scan, since
+        delete_resources_by_tag takes care of them"""
+        elements = None
+        if whistle_output is not None:
+            hints = from_whistle_output(whistle_output)
+            self.type_order = hints.type_order()
+            elements = {}
+            for resource in hints.resource_types:
+                elements[resource] = hints.reference_elements.get(resource) or set(['id'])
+        if not scan:
+            return None
+
+        if by_tag:
+            if resource_list is None or 'ALL' in resource_list:
+                resource_list = default_resources(self.client, ignore_resources=['Bundle'])
+            if self.conditional_delete:
+                resource_list = [x for x in resource_list if not self.supports_conditional_delete(x)]
+            ids = None
+        else:
+            if resource_list is None or resource_list == ['ALL']:
+                resource_list = self.studyids.list_resource_types(study_id)
+            ids = {}
+            for resource in resource_list:
+                ids[resource] = self.studyids.iter_ids(study_id, resource)
+
+        print(f"Scanning {len(resource_list)} resource types for references")
+        self.graph = scan_server(self.client, resource_list, study_id=study_id, ids=ids, page_size=self.page_size, elements=elements, thread_count=self.thread_count)
+        if self.type_order is None:
+            self.type_order = self.graph.type_order()
+        print(f"Found {len(self.graph)} resources to delete in {len(self.graph.levels())} levels")
+        return self.graph
+
+    def delete_by_reference_graph(self):
+        """Delete everything in the graph, one level at a time. Nothing in a
+        level is referenced by anything in the same or a later level, so each
+        level's deletes can all run at once"""
+        levels = self.graph.levels()
+        for depth, level in enumerate(levels):
+            print(f"Deleting level {depth + 1} of {len(levels)} ({len(level)} resources)")
+            for resource, id in level:
+                self.add_job_to_queue(resource, id)
+            # A level must be finished before the next one can start
+            self.launch_threads()
+
+    def capabilities(self):
+        """The server's CapabilityStatement, fetched once"""
+        if self._capabilities is None:
+            response = self.client.get("metadata", recurse=False, except_on_error=False)
+            self._capabilities = response.response if type(response.response) is dict else {}
+        return self._capabilities
+
+    def supports_conditional_delete(self, resource):
+        for rest in self.capabilities().get('rest', []):
+            for resource_def in rest.get('resource', []):
+                if resource_def.get('type') == resource:
+                    return resource_def.get('conditionalDelete') == 'multiple'
+        return False
+
+    def send_bundle(self, entries):
+        """POST a batch Bundle to the server's base URL"""
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": entries
+        }
+        return self.client.post("", bundle)
+
+    def conditional_delete_by_tag(self, resource, study_id):
+        """Ask the server to delete everything with the study's tag in one
+        go. This is sent as the only entry of a batch so that we needn't
+        issue the conditional DELETE ourselves. Anything the server couldn't
+        delete (usually because something else still refers to it) is left
+        for the normal, paged purge"""
+        start_time = time.perf_counter()
+        response = self.send_bundle([{
+            "request": {
+                "method": "DELETE",
+                "url": f"{resource}?_tag={study_id}"
+            }
+        }])
+        entries = response['response'].get('entry', []) if type(response['response']) is dict else []
+        if response['status_code'] >= 300 or len(entries) == 0:
+            return
+
+        status_code = entry_status(entries[0])
+        message = diagnostics(entries[0].get('response', {}).get('outcome')) or ""
+        if self.metrics is not None:
+            self.metrics.observe_response("delete", resource, status_code, time.perf_counter() - start_time)
+        if status_code < 300:
+            # HAPI and friends report "Successfully deleted N resource(s)"
+            deleted = re.search(r"deleted (\d+) resource", message)
+            if deleted is not None:
+                with del_lock:
+                    self.deleted[resource] += int(deleted.group(1))
+            print(f"{resource} : conditional delete by tag - {message}")
+        else:
+            print(f"{resource} : conditional delete by tag failed ({status_code}) - {message}")
+
+    def fetch_tag_page(self, url):
+        """Returns the IDs on a single page of a tag search along with the
+        total reported by the server (if any) and the next page's URL"""
+        response = self.client.get(url, recurse=False, except_on_error=False)
+        bundle = response.response
+        if type(bundle) is not dict:
+            # Error pages needn't be JSON at all
+            return [], None, None
+
+        ids = []
+        for entry in response.entries:
+            # If it's an empty bundle, then there won't be a resource
+            if 'resource' in entry:
+                ids.append(entry['resource']['id'])
+        total = bundle.get('total')
+        return ids, total if type(total) is int else None, next_link(bundle)
+
+    def purge_tag_pass(self, resource, study_id, skip_ids):
+        """Delete everything currently returned by the tag search, one page
+        at a time. The next page is fetched while the current page's deletes
+        are running. Returns the number of IDs submitted for deletion"""
+        url = f"{resource}?_tag={study_id}&_elements=id&_count={self.page_size}"
+        submitted = 0
+        remaining = None
+        start_time = time.perf_counter()
+        deleted_before = self.deleted[resource]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as fetcher:
+            page = fetcher.submit(self.fetch_tag_page, url)
+            while page is not None:
+                ids, total, url = page.result()
+                if remaining is None and total is not None:
+                    remaining = total
+                page = fetcher.submit(self.fetch_tag_page, url) if url else None
+
+                for id in ids:
+                    if id not in skip_ids:
+                        skip_ids.add(id)
+                        self.add_job_to_queue(resource, id)
+                        submitted += 1
+                self.launch_threads()
+
+                deleted = self.deleted[resource] - deleted_before
+                elapsed = time.perf_counter() - start_time
+                rate = deleted / elapsed if elapsed > 0 else 0.0
+                progress = f"{resource} : {deleted} deleted ({rate:.1f}/s)"
+                if remaining is not None:
+                    progress += f" of {remaining}"
+                if submitted > 0:
+                    print(progress)
+        return submitted
+
     def delete_resources_by_tag(self, study_id, resource_list=None):
         if resource_list is None or 'ALL' in resource_list:
             resource_list = default_resources(self.client)
@@ -71,26 +302,39 @@ class ResourceDeleter:
         # have dependant resources point back to them:
 
         ordered_resources = default_resources(self.client, ignore_resources=resource_order + ['Bundle']) +  resource_order[::-1]
+        ordered_resources = self.order_resources(ordered_resources)
 
         for resource in ordered_resources:
             if resource in resource_list or 'ALL' in resource_list:
-                qry = f"{resource}?_tag={study_id}&_elements=id"
-
-                response = self.client.get(qry)    
-                ids = []
-                if len(response.entries) > 0:
-                    print(f"Purging All IDS from {study_id}:{resource}")
-
-                for entry in response.entries:
-                    # If it's an empty bundle, then there won't be a resource
-                    if 'resource' in entry:
-                        self.add_job_to_queue(resource, entry['resource']['id'])
-
-                if len(response.entries) > 0:
-                    self.launch_threads()
-
-                    if response.response['total'] > 0:
-                        print(f"{resource} : {response.response['total']}")            
+                if self.conditional_delete and self.supports_conditional_delete(resource):
+                    self.conditional_delete_by_tag(resource, study_id)
+
+                # Deleting resources shifts the pages under us, so we keep
+                # searching until nothing is left. IDs we've already tried
+                # (e.g. those that conflicted) are left for retry_purge, so
+                # a pass that turns up nothing new ends the round. Servers
+                # may hand back stale search results, though, so we only
+                # stop once the count says nothing is left or stops going
+                # down
+                self.detect_count_query(resource, study_id)
+                skip_ids = set()
+                passes = 0
+                remaining = None
+                while True:
+                    while self.purge_tag_pass(resource, study_id, skip_ids) > 0:
+                        passes += 1
+                    last_remaining = remaining
+                    remaining = self.count_remaining(resource, study_id)
+                    if remaining == 0 or (last_remaining is not None and remaining >= last_remaining):
+                        break
+                    # Try anything still tagged again, other than the IDs
+                    # already waiting on retry_purge
+                    skip_ids = set(self.delayed_deletes.get(resource, []))
+
+                if passes > 0:
+                    print(f"Purged {self.deleted[resource]} {resource} resources from {study_id}")
+                if remaining > 0:
+                    print(f"{remaining} {resource} resources tagged with {study_id} remain")
 
     def delete_resources(self, study_id, resource_list=None):
         global resource_order
@@ -108,18 +352,78 @@ class ResourceDeleter:
                 ordered_resources.append(resource)
 
         ordered_resources += resource_order[::-1]
+        ordered_resources = self.order_resources(ordered_resources)
 
         for resource in ordered_resources:
             if resource in resource_list:
-                ids = self.studyids.get_ids(study_id, resource)[::-1]
-                print(f"Deleting {len(ids)} from {resource}")
-
-                self.ids_to_delete[resource] += ids
-
-                for id in self.ids_to_delete[resource]:
+                # The IDs are streamed rather than read in all at once
+                count = 0
+                for id in self.studyids.iter_ids(study_id, resource, reverse=True):
                     self.add_job_to_queue(resource, id)
-                
+                    count += 1
+
                 self.launch_threads()
+                print(f"Processed {count} IDs from {resource}")
+
+    def search_total(self, url):
+        """The total reported by the search, or None if the server didn't
+        provide one (or refused the search)"""
+        response = self.client.get(url, recurse=False, except_on_error=False)
+        bundle = response.response
+        if type(bundle) is not dict or bundle.get('resourceType') == 'OperationOutcome':
+            return None
+        total = bundle.get('total')
+        return total if type(total) is int else None
+
+    def detect_count_query(self, resource, study_id):
+        """Work out (once) how to get a count out of the server"""
+        if self.count_query is None:
+            self.count_query = False
+            for query in count_queries:
+                if self.search_total(f"{resource}?_tag={study_id}&{query}") is not None:
+                    self.count_query = query
+                    break
+        return self.count_query
+
+    def count_remaining(self, resource, study_id):
+        """The number of resources still tagged with the study"""
+        if self.count_query:
+            total = self.search_total(f"{resource}?_tag={study_id}&{self.count_query}")
+            if total is not None:
+                return total
+
+        # Without a count, we have to page through the matches, but we
+        # needn't download anything more than their IDs
+        remaining = 0
+        url = f"{resource}?_tag={study_id}&_elements=id&_count={self.page_size}"
+        while url:
+            ids, total, url = self.fetch_tag_page(url)
+            remaining += len(ids)
+        return remaining
+
+    def verify(self, study_id, resource_list=None):
+        """Count what is left of the study for each resource type, running
+        the counts in parallel. Returns resource type => count"""
+        if resource_list is None or 'ALL' in resource_list:
+            resource_list = default_resources(self.client, ignore_resources=['Bundle'])
+        if len(resource_list) == 0:
+            return {}
+
+        self.detect_count_query(resource_list[0], study_id)
+        if not self.count_query:
+            print("The server won't provide counts, so the remaining IDs will be paged through instead")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.thread_count)) as executor:
+            counts = dict(zip(resource_list, executor.map(lambda x: self.count_remaining(x, study_id), resource_list)))
+
+        remaining = {x: counts[x] for x in resource_list if counts[x] > 0}
+        if len(remaining) == 0:
+            print(f"Nothing tagged with {study_id} remains for the {len(resource_list)} resource types checked")
+        else:
+            print(f"Resources remaining for {study_id}:")
+            for resource, count in remaining.items():
+                print(f"\t{resource} : {count}")
+        return counts
 
     def cleanup_threads(self):
         if self.thread_executor is not None:
@@ -137,10 +441,13 @@ class ResourceDeleter:
                 if len(self.delayed_deletes) > 0:
                     self.ids_to_delete = self.delayed_deletes
                     self.delayed_deletes = defaultdict(list)
+                    if self.metrics is not None:
+                        self.metrics.delayed.set(0, "delete")
                     ordered_resources = []
                     ordered_resources = default_resources(self.client, ignore_resources=resource_order + ['Bundle'])
 
                     ordered_resources += resource_order[::-1]
+                    ordered_resources = self.order_resources(ordered_resources)
 
                     for resource in ordered_resources:
                         if resource in self.ids_to_delete:
@@ -157,40 +464,140 @@ class ResourceDeleter:
                     print(f"\t{resource} - {len(self.delayed_deletes[resource])}")
 
     def launch_threads(self):
+        self.flush_batches()
         if self.thread_executor is not None:
             start_time = datetime.datetime.now()
             self.records_purged += len(self.del_queue)
             print(f"Launching threads ({len(self.del_queue)} | {self.records_purged})")
             for entry in concurrent.futures.as_completed(self.del_queue):
                 entry.result()
+                if self.metrics is not None:
+                    self.metrics.queue_depth.dec("delete")
             print(f"Thread queue ({len(self.del_queue)}) completed in {(datetime.datetime.now() - start_time).seconds}s")
             self.del_queue = []
 
 
     def add_job_to_queue(self, resource, id):
+        if self.batch_size > 1:
+            self.pending_batch[resource].append(id)
+            if len(self.pending_batch[resource]) >= self.batch_size:
+                self.queue_batch(resource)
+            return
+
         if self.thread_executor is not None:
             self.del_queue.append(self.thread_executor.submit(self.delete_resource, resource, id))
+            if self.metrics is not None:
+                self.metrics.queue_depth.inc("delete")
 
             if self.max_queue_size <= len(self.del_queue):
                 self.launch_threads()
         else:
             self.delete_resource(resource, id)
 
-    def delete_resource(self, resource, id):
+    def queue_batch(self, resource):
+        ids = self.pending_batch.pop(resource, [])
+        if len(ids) == 0:
+            return
+
+        if self.thread_executor is not None:
+            self.del_queue.append(self.thread_executor.submit(self.delete_batch, resource, ids))
+            if self.metrics is not None:
+                self.metrics.queue_depth.inc("delete")
+
+            if self.max_queue_size <= len(self.del_queue) * self.batch_size:
+                self.launch_threads()
+        else:
+            self.delete_batch(resource, ids)
+
+    def flush_batches(self):
+        for resource in list(self.pending_batch.keys()):
+            self.queue_batch(resource)
+
+    def delete_batch(self, resource, ids):
+        """Delete the IDs with a single batch Bundle. If the server won't
+        accept the Bundle at all, we fall back to deleting them one by one"""
+        if current_thread() is not main_thread():
+            current_thread().name = f"{resource}/batch"
+
+        in_flight = nullcontext() if self.metrics is None else self.metrics.worker("delete")
+        start_time = time.perf_counter()
+        with in_flight:
+            response = self.send_bundle([
+                {"request": {"method": "DELETE", "url": f"{resource}/{id}"}}
+                for id in ids
+            ])
+        elapsed = time.perf_counter() - start_time
+
+        entries = []
+        if response['status_code'] < 300 and type(response['response']) is dict:
+            entries = response['response'].get('entry', [])
+        if len(entries) != len(ids):
+            print(f"Unable to delete {resource} in batches ({response['status_code']}), deleting them individually")
+            for id in ids:
+                self.delete_resource(resource, id)
+            return
+
+        for id, entry in zip(ids, entries):
+            self.record_result(resource, id, entry_status(entry), entry.get('response', {}).get('outcome'), elapsed)
+
+    def delete_resource(self, resource, id, depth=0):
         if current_thread() is not main_thread():
             current_thread().name = f"{resource}/{id}"
 
-        response = self.client.delete_by_record_id(resource, id, silence_warnings=True)
+        in_flight = nullcontext() if self.metrics is None else self.metrics.worker("delete")
+        start_time = time.perf_counter()
+        with in_flight:
+            response = self.client.delete_by_record_id(resource, id, silence_warnings=True)
 
-        status_code = response['status_code']
-        if status_code == 200:
-            return
+        if response['status_code'] in (200, 204):
+            outcome = None
+        else:
+            outcome = response['response']
+        return self.record_result(resource, id, response['status_code'], outcome, time.perf_counter() - start_time, response, depth)
+
+    def record_result(self, resource, id, status_code, outcome, elapsed, response=None, depth=0):
+        """Returns True if the resource is gone"""
+        if self.metrics is not None:
+            self.metrics.observe_response("delete", resource, status_code, elapsed)
+        if status_code in (200, 204):
+            with del_lock:
+                # Conflict resolution can delete a resource ahead of its turn
+                if (resource, id) not in self.purged:
+                    self.deleted[resource] += 1
+                    if self.graph is not None:
+                        self.purged.add((resource, id))
+            return True
         elif status_code == 409:
-            print(response['response']['issue'][0]['diagnostics'])
-
-            self.delayed_deletes[resource].append(id)
+            message = diagnostics(outcome)
+            if self.resolve_conflict(resource, id, message, depth):
+                return True
+            print(message)
+
+            with del_lock:
+                self.delayed_deletes[resource].append(id)
+                if self.metrics is not None:
+                    self.metrics.delayed.inc("delete")
+                    self.metrics.retry("delete", resource)
         else:
-            print(response)
+            print(response if response is not None else f"{resource}/{id} : {status_code} {diagnostics(outcome)}")
+        return False
+
+    def resolve_conflict(self, resource, id, message, depth):
+        """If the delete was refused because something we are also purging
+        still refers to the resource, delete that first and try again right
+        away rather than waiting for retry_purge. Referrers from outside the
+        reference graph are left alone"""
+        blocker = blocking_referrer(message)
+        if blocker is None or self.graph is None or blocker not in self.graph:
+            return False
+        if depth >= self.max_conflict_depth:
+            return False
+
+        if self.metrics is not None:
+            self.metrics.retry("delete", resource)
+        if blocker not in self.purged and not self.delete_resource(*blocker, depth=depth + 1):
+            return False
+        return self.delete_resource(resource, id, depth=depth + 1)
 
 
 def exec(args=None):
@@ -217,7 +624,7 @@ def exec(args=None):
         "-s", 
         "--study-ids",
         type=FileType('rt'),
-        help="Name of the study IDs JSON file to pull IDs from"
+        help="Name of the study IDs file to pull IDs from. Either the JSON file or a StudyIDs database (.sqlite)"
     )
     parser.add_argument(
         "-tag",
@@ -252,15 +659,50 @@ def exec(args=None):
         default=10,
         help="Number of threads to run when running multi-threaded"
     )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=default_page_size,
+        help="Number of IDs to request per page when deleting by tag"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=default_batch_size,
+        help="Number of DELETEs to send in each batch Bundle. Use 1 to delete resources one request at a time"
+    )
+    parser.add_argument(
+        "--no-conditional-delete",
+        action='store_true',
+        help="When deleting by tag, don't use a conditional DELETE even if the server supports deleting multiple resources that way"
+    )
+    parser.add_argument(
+        "--whistle-output",
+        type=str,
+        default=None,
+        help="Whistle output for the study. Used to work out the order resource types must be deleted in and which elements hold references"
+    )
+    parser.add_argument(
+        "--scan-references",
+        action='store_true',
+        help="Scan the server for references between the study's resources and delete them in that order. Without it, resource types are deleted in a fixed order (or the order derived from --whistle-output)"
+    )
+    add_profile_arguments(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args(sys.argv[1:])
+    profiler = Profiler.from_args(args)
+    metrics = RunMetrics.from_args(args)
 
     if args.study_ids is not None:
         args.study_ids.close()
         args.study_ids = args.study_ids.name
 
     fhir_client = FhirClient(host_config[args.env])
-    purgery = ResourceDeleter(fhir_client, threaded=args.threaded, max_queue_size=10000, thread_count=args.thread_count)
+    purgery = ResourceDeleter(fhir_client, threaded=args.threaded, max_queue_size=10000, thread_count=args.thread_count, metrics=metrics)
+    purgery.page_size = args.page_size
+    purgery.batch_size = args.batch_size
+    purgery.conditional_delete = not args.no_conditional_delete
     if not args.delete_files_by_tag:
         study_ids = purgery.load_studyids(args.study_ids)
 
@@ -276,25 +718,33 @@ def exec(args=None):
     if args.resource is None or len(args.resource) == 0:
         args.resource = ['ALL']
     
-    if args.delete_files_by_tag:
-        purgery.delete_resources_by_tag(args.study_name, resource_list = args.resource)
-    else:
-        purgery.delete_resources(args.study_name, resource_list = args.resource)
-
-    purgery.retry_purge()
-
-    # Launch anything that was lingering in the queue
-    purgery.cleanup_threads()
-
-    for resource in resource_order:
-        qry = f"{resource}?_tag={args.study_name}&_summary=count"
-        
-        response = fhir_client.get(qry, except_on_error=False)   
-        if 'issue' in response.response:
-            if "_summary argument is not supported" in response.response['issue'][0]['diagnostics']:
-                qry = f"{resource}?_tag={args.study_name}"
-                response = fhir_client.get(qry)
-                print(f"{resource} : {len(response.entries)}")
-        else:
-            print(f"{resource} : {response.response['total']}")
+    with profiler.stage("scan"):
+        purgery.build_reference_graph(args.study_name, 
+                    resource_list = args.resource, 
+                    by_tag = args.delete_files_by_tag, 
+                    whistle_output = args.whistle_output, 
+                    scan = args.scan_references)
+
+    with profiler.stage("purge"):
+        if purgery.graph is not None:
+            purgery.delete_by_reference_graph()
+
+        if args.delete_files_by_tag:
+            # Anything the scan missed (e.g. added since) is picked up here
+            purgery.delete_resources_by_tag(args.study_name, resource_list = args.resource)
+        elif purgery.graph is None:
+            purgery.delete_resources(args.study_name, resource_list = args.resource)
+
+    with profiler.stage("retry"):
+        purgery.retry_purge()
+
+        # Launch anything that was lingering in the queue
+        purgery.cleanup_threads()
+
+    with profiler.stage("verify"):
+        purgery.verify(args.study_name, resource_list = args.resource)
+
+    profiler.finish()
+    if metrics is not None:
+        metrics.stop()
         
\ No newline at end of file
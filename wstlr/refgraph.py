@@ -0,0 +1,319 @@
+"""
+The graph of references between the resources belonging to a study.
+
+A FHIR server won't delete a resource while something else still refers to
+it, so delfhir has to remove the referrers first. Rather than rely on a
+fixed list of resource types, the order is worked out from the references
+themselves:
+
+    * scan_server() reads the study's resources from the server (either by
+      tag or by the IDs in the StudyIDs file) and records every literal
+      reference (Type/id) they contain
+    * from_whistle_output() does the same for the whistle output, where
+      references are made by identifier. The output has no server IDs, so
+      this is mostly useful for its type_order() and to learn which elements
+      hold references, letting the server scan ask for just those via
+      _elements
+
+levels() then groups the resources so that nothing in a level is referred
+to by anything in the same or a later level. Deleting one level at a time,
+leaves first, each level's deletes can run in parallel.
+
+blocking_referrer() pulls the offending resource out of a 409's diagnostics
+("...First reference found was resource Observation/123 in path..."), which
+lets the purge delete it right away when it belongs to the study, too.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import os
+import re
+from collections import defaultdict
+from collections.abc import Iterable
+from itertools import islice
+from typing import Any
+
+from wstlr.jsonstream import ArrayStream, iter_members
+
+# (resourceType, id)
+Node = tuple[str, str]
+
+reference_rx = re.compile(r"^([A-Z][A-Za-z]+)/([A-Za-z0-9\-\.]{1,64})$")
+conflict_rx = re.compile(
+    r"First reference found was resource ([A-Z][A-Za-z]+)/([A-Za-z0-9\-\.]{1,64})"
+)
+
+# Top level elements that commonly hold references. scan_server asks for
+# these (via _elements) for any type it has no better list for, so whole
+# resources are never downloaded. Elements a type doesn't have are ignored
+default_reference_elements = frozenset(
+    [
+        "basedOn",
+        "collection",
+        "context",
+        "derivedFrom",
+        "encounter",
+        "entry",
+        "focus",
+        "for",
+        "hasMember",
+        "individual",
+        "link",
+        "managingOrganization",
+        "member",
+        "parent",
+        "partOf",
+        "patient",
+        "specimen",
+        "study",
+        "subject",
+    ]
+)
+
+# Number of IDs in each _id search when scanning the IDs from a StudyIDs file.
+# Much more than this and the URL gets unreasonably long
+id_chunk_size = 100
+
+
+def next_link(bundle: dict[str, Any]) -> str | None:
+    """Return the URL of the next page of a search Bundle, if there is one"""
+    for link in bundle.get("link", []):
+        if link.get("relation") == "next":
+            return link.get("url")
+    return None
+
+
+def blocking_referrer(message: str | None) -> Node | None:
+    """The resource named in a 409's diagnostics as still referring to the
+    one we tried to delete"""
+    if message is None:
+        return None
+    match = conflict_rx.search(message)
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+def literal_reference(reference: str) -> Node | None:
+    """(resourceType, id) for a literal Type/id reference. None for anything
+    else, such as the system|value of an identifier"""
+    match = reference_rx.match(reference)
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+def find_references(
+    value: Any, found: set[tuple[str, str]] | None = None, element: str | None = None
+) -> set[tuple[str, str]]:
+    """Collect (top level element, reference) for every reference inside a
+    resource. A reference is either a literal "Type/id" or, as whistle
+    writes them, "system|value" of the referenced resource's identifier"""
+    if found is None:
+        found = set()
+    if type(value) is dict:
+        for key, child in value.items():
+            path = key if element is None else element
+            if element is not None and key == "reference" and type(child) is str:
+                if reference_rx.match(child):
+                    found.add((path, child))
+            elif (
+                element is not None
+                and key == "identifier"
+                and type(child) is dict
+                and "value" in child
+            ):
+                found.add((path, f"{child.get('system', '')}|{child['value']}"))
+            elif type(child) in (dict, list):
+                find_references(child, found, path)
+    elif type(value) is list:
+        for child in value:
+            find_references(child, found, element)
+    return found
+
+
+class ReferenceGraph:
+    def __init__(self) -> None:
+        self.nodes: set[Node] = set()
+
+        # node => nodes it refers to
+        self.references: defaultdict[Node, set[Node]] = defaultdict(set)
+
+        # node => nodes that refer to it
+        self.referrers: defaultdict[Node, set[Node]] = defaultdict(set)
+
+        # resourceType => top level elements that hold references
+        self.reference_elements: defaultdict[str, set[str]] = defaultdict(set)
+
+    def __contains__(self, node: object) -> bool:
+        return node in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def add(self, node: Node, references: Iterable[Node] = ()) -> None:
+        self.nodes.add(node)
+        for target in references:
+            if target != node:
+                self.references[node].add(target)
+                self.referrers[target].add(node)
+
+    def add_resource(self, resource: dict[str, Any]) -> None:
+        resource_type = resource["resourceType"]
+        references = []
+        for element, reference in find_references(resource):
+            # Identifiers can't be followed on the server
+            target = literal_reference(reference)
+            if target is not None:
+                self.reference_elements[resource_type].add(element)
+                references.append(target)
+        self.add((resource_type, resource["id"]), references)
+
+    @property
+    def resource_types(self) -> list[str]:
+        return sorted(set(x[0] for x in self.nodes))
+
+    def levels(self) -> list[list[Node]]:
+        """Group the nodes so that nothing refers to a node from the same or
+        a later group. Leaves (those nothing refers to) come first. If there
+        are cycles, whatever is caught up in them ends up in the last group"""
+        waiting = {
+            node: len(self.referrers[node] & self.nodes) for node in self.nodes
+        }
+        level = sorted(node for node, count in waiting.items() if count == 0)
+
+        levels = []
+        while len(level) > 0:
+            levels.append(level)
+            next_level = []
+            for node in level:
+                del waiting[node]
+                for target in self.references[node]:
+                    if target in waiting:
+                        waiting[target] -= 1
+                        if waiting[target] == 0:
+                            next_level.append(target)
+            level = sorted(next_level)
+
+        if len(waiting) > 0:
+            levels.append(sorted(waiting))
+        return levels
+
+    def type_order(self) -> list[str]:
+        """Resource types in the order they can be deleted: a type comes
+        before any type it refers to. References within a type, and cycles
+        between types, are ignored"""
+        referenced_by: defaultdict[str, set[str]] = defaultdict(set)
+        for node, targets in self.references.items():
+            for target in targets:
+                if target in self.nodes and target[0] != node[0]:
+                    referenced_by[target[0]].add(node[0])
+
+        remaining = set(self.resource_types)
+        order = []
+        while len(remaining) > 0:
+            ready = sorted(x for x in remaining if len(referenced_by[x] & remaining) == 0)
+            if len(ready) == 0:
+                # A cycle, so just take them as they come
+                ready = sorted(remaining)
+            order += ready
+            remaining -= set(ready)
+        return order
+
+
+def from_whistle_output(filename: str | os.PathLike[str]) -> ReferenceGraph:
+    """Build the graph from whistle's output, where resources are keyed by
+    their identifiers (system|value) rather than by server IDs"""
+    # identifier => node. Several identifiers may point to the same resource
+    owners: dict[str, Node] = {}
+    # node => (element, reference)
+    pending: dict[Node, set[tuple[str, str]]] = {}
+
+    graph = ReferenceGraph()
+    with open(filename, "rt", encoding="utf-8-sig") as f:
+        for _, resources in iter_members(f):
+            if not isinstance(resources, ArrayStream):
+                continue
+            for resource in resources:
+                if type(resource) is not dict or "resourceType" not in resource:
+                    continue
+                identifiers = resource.get("identifier", [])
+                if type(identifiers) is dict:
+                    identifiers = [identifiers]
+                keys = [
+                    f"{x.get('system', '')}|{x['value']}" for x in identifiers if "value" in x
+                ]
+                if len(keys) == 0:
+                    continue
+                node = (resource["resourceType"], keys[0])
+                for key in keys:
+                    owners[key] = node
+
+                pending[node] = find_references(resource)
+
+    # Only identifiers belonging to resources in the output, and literal
+    # references, are kept. Any other identifier found inside an element
+    # (a container's, say) isn't a reference at all
+    for node, references in pending.items():
+        targets = []
+        for element, reference in references:
+            target = owners.get(reference) or literal_reference(reference)
+            if target is not None:
+                graph.reference_elements[node[0]].add(element)
+                targets.append(target)
+        graph.add(node, targets)
+    return graph
+
+
+def scan_search(client: Any, url: str | None) -> list[dict[str, Any]]:
+    """Follow the search's pages, returning every resource found"""
+    resources = []
+    while url is not None:
+        response = client.get(url, recurse=False, except_on_error=False)
+        for entry in response.entries:
+            if "resource" in entry:
+                resources.append(entry["resource"])
+        url = next_link(response.response) if type(response.response) is dict else None
+    return resources
+
+
+def scan_server(
+    client: Any,
+    resource_types: Iterable[str],
+    study_id: str | None = None,
+    ids: dict[str, Iterable[str]] | None = None,
+    page_size: int = 500,
+    elements: dict[str, set[str]] | None = None,
+    thread_count: int = 4,
+) -> ReferenceGraph:
+    """Read the study's resources from the server and build the graph of
+    their references. When ids (resourceType => IDs, as found in the
+    StudyIDs file) are provided, only those resources are read. Otherwise,
+    everything tagged with the study_id is.
+
+    Only the elements listed in elements (resourceType => element names)
+    are requested for the types it lists, and default_reference_elements
+    for the rest. Types are scanned in parallel"""
+    searches = []
+    for resource_type in resource_types:
+        type_elements = default_reference_elements
+        if elements is not None and resource_type in elements:
+            type_elements = frozenset(elements[resource_type])
+        params = f"_count={page_size}&_elements=" + ",".join(sorted(type_elements))
+
+        if ids is not None:
+            type_ids = iter(ids.get(resource_type, []))
+            while chunk := ",".join(islice(type_ids, id_chunk_size)):
+                searches.append(f"{resource_type}?_id={chunk}&{params}")
+        else:
+            searches.append(f"{resource_type}?_tag={study_id}&{params}")
+
+    graph = ReferenceGraph()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, thread_count)) as executor:
+        pages = [executor.submit(scan_search, client, url) for url in searches]
+        # The graph isn't thread safe, so it is only built from the main thread
+        for page in pages:
+            for resource in page.result():
+                graph.add_resource(resource)
+    return graph
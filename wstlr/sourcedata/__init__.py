@@ -53,7 +53,12 @@ class DdVariable:
         self.values_url = variable.get("values-url")
         self.fieldname = fix_fieldname(self.varname)
 
-        if "values" in variable and len(variable["values"]) > 1:
+        # compact_code_systems leaves only values-count in the dd entry
+        value_count = variable.get("values-count")
+        if value_count is None:
+            value_count = len(variable.get("values", []))
+
+        if value_count > 1:
             self.vartype = "enumeration"
         elif self.vartype in _string_types:
             self.vartype = "string"
@@ -14,19 +14,117 @@
 
     Each row will be a single ID that was PUT or POSTed to a given server. 
 
-    
+    StudyIDs keeps everything in a single JSON file which is rewritten at the
+    end of each run. StudyIDsDB keeps them in a SQLite database instead,
+    writing them in chunks as they are added and reading them back one
+    study/host/resourceType at a time. open_study_ids() picks the backend
+    based on the filename (.sqlite, .sqlite3 or .db for the database).
+
+    Either way, a run that finishes replaces the IDs recorded for each
+    resourceType it loaded (for its study and host) with its own, so IDs
+    from earlier loads that are no longer around don't pile up. A run that
+    doesn't finish only ever adds IDs.
+
+    So that a load that crashes (or exits early) doesn't lose track of what
+    it has already created, StudyIDs can also append the IDs to a log next to
+    the JSON file as they are added (see open_log). The log is written in
+    batches and synced to disk, then folded into the JSON file by
+    dump_to_file at the end of the run. Each run has its own log, which it
+    keeps locked until it is done with it. Anything left in a log by a run
+    that never got that far is picked up by the next load_from_file or
+    dump_to_file, so delfhir can still clean up after it. Logs still locked
+    by runs in progress are read, but never removed, by anyone else.
 """
 
 from __future__ import annotations
 
+import atexit
 import json
 import os
 import sqlite3
+import sys
+from argparse import ArgumentParser
 from collections import defaultdict
-from collections.abc import KeysView
+from collections.abc import Iterator, KeysView
 from pathlib import Path
 from threading import Lock
-from typing import Any
+from time import monotonic
+from typing import IO, Any, TextIO
+
+from wstlr.cache import write_atomic
+
+if sys.platform != "win32":
+    import fcntl
+
+# Pending IDs are written to the log at least this often (seconds)
+default_flush_interval = 1.0
+
+
+def log_filename(filename: str | os.PathLike[str], study_id: str, pid: int | None = None) -> Path:
+    """The append-only log for a run's IDs, kept alongside the JSON file.
+    Each process gets its own, so concurrent runs never share a log"""
+    filename = Path(filename)
+    if pid is None:
+        pid = os.getpid()
+    return filename.with_name(f"{filename.name}.{study_id}.{pid}.log")
+
+
+def find_logs(filename: str | os.PathLike[str]) -> list[Path]:
+    """Every log belonging to the JSON file"""
+    filename = Path(filename)
+    return sorted(filename.parent.glob(f"{filename.name}.*.log"))
+
+
+def lock_log(f: IO[Any], wait: bool = False) -> bool:
+    """Take an exclusive lock on an open log, returning False if another run
+    holds it. Without fcntl (i.e. on Windows), logs are never locked"""
+    if sys.platform == "win32":
+        return False
+    flags = fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+        fcntl.flock(f.fileno(), flags)
+    except OSError:
+        return False
+    return True
+
+
+def is_linked(f: IO[Any], log: Path) -> bool:
+    """Whether the open file is still the one found at log, i.e. it hasn't
+    been compacted and removed since it was opened"""
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), log.stat())
+    except FileNotFoundError:
+        return False
+
+
+def read_logs(logs: list[Path]) -> dict[tuple[str, str, str], set[str]]:
+    """(study, host, resourceType) => IDs from the logs. A line cut short by
+    a crash is ignored; the IDs on it were never synced and only those are
+    lost"""
+    found: defaultdict[tuple[str, str, str], set[str]] = defaultdict(set)
+    for log in logs:
+        try:
+            f = log.open('rt')
+        except FileNotFoundError:
+            # Compacted by someone else in the meantime
+            continue
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    key = (entry["study"], entry["host"], entry["resourceType"])
+                    found[key].update(entry["ids"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    return found
+
+
+def merge_logged_ids(data: dict[str, Any], logged: dict[tuple[str, str, str], set[str]]) -> None:
+    """Add the logged IDs to the contents of a JSON file"""
+    for (study, host, resourceType), ids in logged.items():
+        resources = data.setdefault(study, {}).setdefault(host, {})
+        resources[resourceType] = sorted(set(resources.get(resourceType, [])) | ids)
+
 
 class StudyIDs:
     def __init__(
@@ -53,9 +151,77 @@ class StudyIDs:
 
         self.data: dict[str, Any] | None = None
 
+        # The append-only log (see open_log). IDs wait in pending until the
+        # next batch is written
+        self.log: TextIO | None = None
+        self.log_file: Path | None = None
+        self.pending: defaultdict[str, list[str]] = defaultdict(list)
+        self.pending_count = 0
+        self.flush_interval = default_flush_interval
+        self.last_flush = monotonic()
+
+    def open_log(self, filename: str | os.PathLike[str]) -> None:
+        """Start logging IDs as they are added, so that they survive even if
+        we never make it to dump_to_file"""
+        assert self.study_id is not None
+        if self.log is None:
+            self.log_file = log_filename(filename, self.study_id)
+            # The lock is held for as long as the log is open, so that other
+            # runs leave it alone. If a previous run with our pid left this
+            # log behind and someone was compacting it just as we opened it,
+            # the file we have may already be gone
+            while True:
+                log = self.log_file.open('at')
+                lock_log(log, wait=True)
+                if is_linked(log, self.log_file):
+                    break
+                log.close()
+            self.log = log
+            # Covers sys.exit() and unhandled exceptions, at least
+            atexit.register(self.flush_log)
+
+    def _write_log(self) -> None:
+        """Append the pending IDs to the log. The lock must be held"""
+        if self.log is not None and self.pending_count > 0:
+            lines = [
+                json.dumps({
+                    "study": self.study_id,
+                    "host": self.servername,
+                    "resourceType": resourceType,
+                    "ids": ids,
+                })
+                for resourceType, ids in self.pending.items()
+            ]
+            self.log.write("\n".join(lines) + "\n")
+            self.log.flush()
+            os.fsync(self.log.fileno())
+        self.pending = defaultdict(list)
+        self.pending_count = 0
+        self.last_flush = monotonic()
+
+    def flush_log(self) -> None:
+        with self.lock:
+            self._write_log()
+
+    def close_log(self) -> None:
+        with self.lock:
+            self._write_log()
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+                atexit.unregister(self.flush_log)
+
     def add_id(self, resourceType: str, id: str) -> None:
         with self.lock:
             self.ids[resourceType].append(id)
+            if self.log is not None:
+                self.pending[resourceType].append(id)
+                self.pending_count += 1
+                if (
+                    self.pending_count >= self.chunk_size
+                    or monotonic() - self.last_flush >= self.flush_interval
+                ):
+                    self._write_log()
 
     def load_from_file(self, filename: str | os.PathLike[str]) -> list[str]:
         if self.data is None:
@@ -67,6 +233,12 @@ class StudyIDs:
                 with id_file.open('rt') as f:
                     self.data = json.load(f)
 
+            # Anything logged by a run that didn't finish (or hasn't yet)
+            logs = find_logs(filename)
+            if len(logs) > 0:
+                print(f"Recovering IDs from {len(logs)} unfinished log(s)")
+                merge_logged_ids(self.data, read_logs(logs))
+
         return [
             study
             for study in self.data.keys()
@@ -77,6 +249,11 @@ class StudyIDs:
         assert self.data is not None
         return self.data[study_id][self.servername][resource]
 
+    def iter_ids(self, study_id: str, resource: str, reverse: bool = False) -> Iterator[str]:
+        assert self.data is not None
+        ids = self.data[study_id][self.servername][resource]
+        return reversed(ids) if reverse else iter(ids)
+
     def list_resource_types(self, study_id: str) -> KeysView[str]:
         assert self.data is not None
 
@@ -85,12 +262,57 @@ class StudyIDs:
     def dump_to_file(self, filename: str | os.PathLike[str]) -> None:
         assert self.study_id is not None
         print(f"dumping IDs to file: {filename}")
+        # Our log stays open (and locked) until it has been compacted
+        self.flush_log()
+        claimed = self.claim_logs(filename)
+        try:
+            self._compact(filename, claimed)
+        finally:
+            for f in claimed.values():
+                f.close()
+            self.close_log()
+
+    def claim_logs(self, filename: str | os.PathLike[str]) -> dict[Path, IO[Any]]:
+        """The logs, other than our own, that no other run holds the lock on,
+        i.e. those left behind by runs that never finished. They are returned
+        open, and stay locked until they are closed"""
+        claimed: dict[Path, IO[Any]] = {}
+        for log in find_logs(filename):
+            if log == self.log_file:
+                continue
+            try:
+                f = log.open('rt')
+            except FileNotFoundError:
+                continue
+            if lock_log(f) and is_linked(f, log):
+                claimed[log] = f
+            else:
+                f.close()
+        return claimed
+
+    def _compact(self, filename: str | os.PathLike[str], claimed: dict[Path, IO[Any]]) -> None:
+        assert self.study_id is not None
         data: dict[str, Any] = {}
         id_file = Path(filename)
         if id_file.exists():
             with id_file.open('rt') as f:
                 data = json.load(f)
 
+        # Compact our log, along with those left behind by earlier runs, into
+        # the file. Our own IDs replace whatever was there before, as always,
+        # but IDs from unfinished runs are added to them
+        logs = list(claimed)
+        if self.log_file is not None:
+            logs.append(self.log_file)
+        logged = read_logs(logs)
+        current = {}
+        for (study, host, resourceType), ids in logged.items():
+            if study == self.study_id and host == self.servername:
+                current[resourceType] = ids
+        for resourceType in current:
+            del logged[(self.study_id, self.servername, resourceType)]
+        merge_logged_ids(data, logged)
+
         if self.study_id not in data:
             data[self.study_id] = {
                 self.servername: {}
@@ -99,46 +321,290 @@ class StudyIDs:
         if self.servername not in data[self.study_id]:
             data[self.study_id][self.servername] = {}
 
-        for resourceType in self.ids.keys():
-            id_list = sorted(list(set(self.ids[resourceType])))
+        for resourceType in set(self.ids.keys()) | set(current.keys()):
+            id_list = sorted(list(set(self.ids[resourceType]) | current.get(resourceType, set())))
             data[self.study_id][self.servername][resourceType] = id_list 
 
-        with id_file.open('wt') as f:
-            json.dump(data, f, indent=2)
+        # Only once the file is safely replaced can the logs go
+        write_atomic(id_file, json.dumps(data, indent=2).encode())
+        for log in logs:
+            log.unlink(missing_ok=True)
 
-    def _dump_to_file(self, filename):
-        def commit_to_db(cursor, data_chunk):
-            if len(data_chunk) > 0:
 
-                print(f"Committing {len(data_chunk)} to DB: #1=> {data_chunk[0]}")
-                cursor.executemany("""
-                        INSERT INTO 
-                            db_ids(hostname, study_id, resourceType, id) 
-                        VALUES(?,?,?,?)""", data_chunk)
+sqlite_suffixes = [".sqlite", ".sqlite3", ".db"]
 
-            return []
 
-        db = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
-    
-        cur = db.cursor()
+def is_sqlite_file(filename: str | os.PathLike[str]) -> bool:
+    return Path(filename).suffix.lower() in sqlite_suffixes
 
-        cur.execute("""CREATE TABLE IF NOT EXISTS db_ids
+
+class StudyIDsDB:
+    """The same bookkeeping as StudyIDs, but backed by a SQLite database.
+
+    IDs are inserted in chunks of chunk_size as they are added, so nothing
+    accumulates in memory and the file is never rewritten. Duplicates are
+    dropped by the table's unique constraint, which also serves as the index
+    for reading the IDs back by host, study and resourceType.
+
+    The IDs added by this run are also noted in a temporary table, so that
+    dump_to_file can drop the rows for the same study, host and
+    resourceTypes left by earlier runs."""
+
+    def __init__(
+        self,
+        fhir_endpoint: str,
+        study_id: str | None = None,
+        chunk_size: int = 1000,
+        filename: str | os.PathLike[str] | None = None,
+    ) -> None:
+        self.servername = fhir_endpoint
+        self.study_id = study_id
+        self.chunk_size = chunk_size
+        self.lock = Lock()
+
+        # Rows waiting to be inserted
+        self.pending: list[tuple[str, str, str, str]] = []
+        self.flush_interval = default_flush_interval
+        self.last_flush = monotonic()
+
+        self.filename: Path | None = None
+        self.db: sqlite3.Connection | None = None
+        if filename is not None:
+            self.open(filename)
+
+    def open(self, filename: str | os.PathLike[str]) -> None:
+        filename = Path(filename)
+        if self.db is not None:
+            if filename == self.filename:
+                return
+            self.close()
+
+        self.filename = filename
+        self.db = sqlite3.connect(str(filename), isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS db_ids
                         (hostname TEXT NOT NULL,
                          study_id TEXT NOT NULL,
                          resourceType TEXT NOT NULL,
                          id TEXT NOT NULL,
                          unique(hostname, study_id, resourceType, id)); """)
-        
-        cur.execute("DELETE FROM db_ids WHERE hostname=? AND study_id=?", (
-                        self.servername, self.study_id))
+        self.db.execute("""CREATE TEMP TABLE IF NOT EXISTS run_ids
+                        (resourceType TEXT NOT NULL,
+                         id TEXT NOT NULL,
+                         PRIMARY KEY(resourceType, id)) WITHOUT ROWID; """)
+        atexit.register(self.flush)
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+            atexit.unregister(self.flush)
+
+    def insert(self, rows: list[tuple[str, str, str, str]], this_run: bool = False) -> None:
+        """Insert the rows in a single transaction. The lock must be held"""
+        assert self.db is not None, "The StudyIDs database hasn't been opened"
+        if len(rows) > 0:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("""
+                        INSERT OR IGNORE INTO
+                            db_ids(hostname, study_id, resourceType, id)
+                        VALUES(?,?,?,?)""", rows)
+                if this_run:
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO run_ids(resourceType, id) VALUES(?,?)",
+                        [(x[2], x[3]) for x in rows],
+                    )
+            except sqlite3.Error:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def add_id(self, resourceType: str, id: str) -> None:
+        assert self.study_id is not None
+        with self.lock:
+            self.pending.append((self.servername, self.study_id, resourceType, id))
+            if self.db is not None and (
+                len(self.pending) >= self.chunk_size
+                or monotonic() - self.last_flush >= self.flush_interval
+            ):
+                self.insert(self.pending, this_run=True)
+                self.pending = []
+                self.last_flush = monotonic()
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.db is not None:
+                self.insert(self.pending, this_run=True)
+                self.pending = []
+                self.last_flush = monotonic()
+
+    def load_from_file(self, filename: str | os.PathLike[str]) -> list[str]:
+        """Returns the studies with IDs for our host"""
+        self.open(filename)
+        assert self.db is not None
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT DISTINCT study_id FROM db_ids WHERE hostname=? ORDER BY study_id",
+                (self.servername,),
+            ).fetchall()
+        return [x[0] for x in rows]
+
+    def iter_ids(
+        self, study_id: str, resource: str, reverse: bool = False, batch_size: int = 10000
+    ) -> Iterator[str]:
+        """Stream the IDs for a single resourceType, batch_size at a time"""
+        assert self.db is not None
+        cursor = self.db.execute(
+            "SELECT id FROM db_ids WHERE hostname=? AND study_id=? AND resourceType=? ORDER BY rowid"
+            + (" DESC" if reverse else ""),
+            (self.servername, study_id, resource),
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                return
+            for row in rows:
+                yield row[0]
+
+    def get_ids(self, study_id: str, resource: str) -> list[str]:
+        return list(self.iter_ids(study_id, resource))
+
+    def list_resource_types(self, study_id: str) -> list[str]:
+        assert self.db is not None
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT DISTINCT resourceType FROM db_ids WHERE hostname=? AND study_id=?",
+                (self.servername, study_id),
+            ).fetchall()
+        return [x[0] for x in rows]
+
+    def dump_to_file(self, filename: str | os.PathLike[str]) -> None:
+        """The IDs are already in the database, so there is only whatever is
+        still pending to write. Then, for each resourceType we loaded, the
+        IDs left by earlier runs are dropped"""
+        assert self.study_id is not None
+        self.open(filename)
+        self.flush()
+        assert self.db is not None
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.execute(
+                    """DELETE FROM db_ids
+                        WHERE hostname=? AND study_id=?
+                            AND resourceType IN (SELECT resourceType FROM run_ids)
+                            AND NOT EXISTS (
+                                SELECT 1 FROM run_ids
+                                WHERE run_ids.resourceType=db_ids.resourceType
+                                    AND run_ids.id=db_ids.id)""",
+                    (self.servername, self.study_id),
+                )
+            except sqlite3.Error:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def export_json(self, filename: str | os.PathLike[str], study_id: str | None = None) -> None:
+        """Write the IDs (everything, or just those for study_id) to a JSON
+        file in the same form StudyIDs uses, merged with whatever is already
+        in that file"""
+        assert self.db is not None
+        self.flush()
+        data: dict[str, Any] = {}
+        id_file = Path(filename)
+        if id_file.exists():
+            with id_file.open('rt') as f:
+                data = json.load(f)
+
+        query = "SELECT study_id, hostname, resourceType, id FROM db_ids"
+        params: tuple[str, ...] = ()
+        if study_id is not None:
+            query += " WHERE study_id=?"
+            params = (study_id,)
+        query += " ORDER BY study_id, hostname, resourceType, id"
+
+        exported: set[tuple[str, str, str]] = set()
+        for study, host, resourceType, id in self.db.execute(query, params):
+            ids = data.setdefault(study, {}).setdefault(host, {})
+            # Replace, rather than add to, whatever the file had before
+            if (study, host, resourceType) not in exported:
+                exported.add((study, host, resourceType))
+                ids[resourceType] = []
+            ids[resourceType].append(id)
+
+        write_atomic(id_file, json.dumps(data, indent=2).encode())
+
+    def import_json(self, filename: str | os.PathLike[str]) -> int:
+        """Add everything from a StudyIDs JSON file. Returns the number of
+        IDs read"""
+        with open(filename, 'rt') as f:
+            data = json.load(f)
+
+        count = 0
+        with self.lock:
+            rows = []
+            for study, hosts in data.items():
+                for host, resources in hosts.items():
+                    for resourceType, ids in resources.items():
+                        if type(ids) is not list:
+                            continue
+                        for id in ids:
+                            # Other logs (e.g. the invalid references) share
+                            # this layout, but don't hold IDs
+                            if type(id) is not str:
+                                continue
+                            rows.append((host, study, resourceType, id))
+                            count += 1
+                            if len(rows) >= self.chunk_size:
+                                self.insert(rows)
+                                rows = []
+            self.insert(rows)
+        return count
+
+
+def open_study_ids(
+    fhir_endpoint: str,
+    filename: str | os.PathLike[str],
+    study_id: str | None = None,
+) -> StudyIDs | StudyIDsDB:
+    """The StudyIDs backend appropriate for the file. When a study_id is
+    provided (i.e. we are recording IDs), they are written to the database or
+    the JSON file's log as they are added"""
+    if is_sqlite_file(filename):
+        return StudyIDsDB(fhir_endpoint, study_id, filename=filename)
+    studyids = StudyIDs(fhir_endpoint, study_id)
+    if study_id is not None:
+        studyids.open_log(filename)
+    return studyids
+
 
-        stmts = []
-        for resourceType in self.ids.keys():
-            for id in self.ids[resourceType]:
-                stmts.append((self.servername, self.study_id, resourceType, id))
+def exec(args: list[str] | None = None) -> None:
+    if args is None:
+        args = sys.argv[1:]
 
-                if len(stmts) >= self.chunk_size:
-                    stmts = commit_to_db(cur, stmts)
+    parser = ArgumentParser(
+        description="Move study IDs between a StudyIDs database and the JSON form."
+    )
+    parser.add_argument(
+        "command",
+        choices=["export", "import"],
+        help="export writes the database's IDs to the JSON file. import adds the JSON file's IDs to the database",
+    )
+    parser.add_argument("database", type=str, help="StudyIDs database (.sqlite)")
+    parser.add_argument("json", type=str, help="StudyIDs JSON file (e.g. study-ids.json)")
+    parser.add_argument(
+        "-n", "--study-name", type=str, default=None, help="Only export this study's IDs"
+    )
+    parsed = parser.parse_args(args)
 
-            stmts = commit_to_db(cur, stmts)
-            
\ No newline at end of file
+    db = StudyIDsDB("", filename=parsed.database)
+    if parsed.command == "export":
+        db.export_json(parsed.json, parsed.study_name)
+        print(f"IDs written to {parsed.json}")
+    else:
+        count = db.import_json(parsed.json)
+        print(f"{count} IDs added to {parsed.database}")
+    db.close()
@@ -0,0 +1,400 @@
+"""
+Check the source data against the data-dictionary before running whistle.
+
+Problems with the data itself (values that aren't among a variable's
+enumerations, text in an integer column, a table without its key columns)
+otherwise only come to light once whistle has run and the load fails. This
+reads each table's CSV files and compares them to the table's DdTable:
+
+    * columns that are missing from the data. This is an error for the
+      table's key columns (the subject ID and any key_component variables)
+      and a warning for anything else
+    * empty values in key columns
+    * values that aren't among an enumerated variable's codes (or their
+      descriptions, which the extractor maps back onto the codes)
+    * values that aren't integers/numbers in integer/number columns
+    * columns in the data that aren't in the data-dictionary (warning)
+
+Values listed under the config's "missing" property (and blanks) are always
+acceptable. Rows are checked in batches, one column at a time, and each
+distinct value in a batch is only checked once. Tables are checked in
+parallel worker processes.
+
+    validate-data config.yaml --report validation.json
+
+play --validate-data runs the same checks before extraction and stops if
+there are any errors.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import re
+import sys
+from argparse import ArgumentParser, FileType
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+
+from rich import print
+
+from wstlr import fix_fieldname
+from wstlr.config import Configuration
+
+default_missing = ["NA", "", "Not Provided"]
+
+_integer = re.compile(r"^[+-]?\d+$")
+
+
+@dataclass(frozen=True)
+class ColumnRule:
+    varname: str
+    data_type: str
+    enumerations: frozenset[str] = frozenset()
+    key: bool = False
+    # Enumeration descriptions found in the DD's varname lookup
+    descriptions: frozenset[str] = frozenset()
+
+
+@dataclass
+class TableSpec:
+    """Everything a worker needs to check a table, without the DD itself"""
+
+    table_name: str
+    filenames: list[str]
+    delimiter: str
+    columns: dict[str, ColumnRule]
+    missing: frozenset[str]
+    aggregators: list[str] = field(default_factory=list)
+
+
+@dataclass
+class Issue:
+    table: str
+    column: str
+    problem: str
+    severity: str
+    count: int = 0
+    examples: list[str] = field(default_factory=list)
+    first_row: int | None = None
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "table": self.table,
+            "column": self.column,
+            "problem": self.problem,
+            "severity": self.severity,
+            "count": self.count,
+            "examples": self.examples,
+            "first_row": self.first_row,
+        }
+
+
+class TableValidator:
+    def __init__(self, spec: TableSpec, batch_size: int = 10000, max_examples: int = 5) -> None:
+        self.spec = spec
+        self.batch_size = batch_size
+        self.max_examples = max_examples
+        self.rows = 0
+
+        # (column, problem) => Issue
+        self.issues: dict[tuple[str, str], Issue] = {}
+
+        self.aggregators = [re.compile(x, re.I) for x in spec.aggregators]
+
+    def report(
+        self,
+        column: str,
+        problem: str,
+        severity: str = "error",
+        value: str | None = None,
+        count: int = 1,
+        row: int | None = None,
+    ) -> None:
+        issue = self.issues.get((column, problem))
+        if issue is None:
+            issue = Issue(self.spec.table_name, column, problem, severity)
+            self.issues[(column, problem)] = issue
+        issue.count += count
+        if value is not None and value not in issue.examples:
+            if len(issue.examples) < self.max_examples:
+                issue.examples.append(value)
+        if row is not None and (issue.first_row is None or row < issue.first_row):
+            issue.first_row = row
+
+    def check_header(self, filename: str, fieldnames: list[str]) -> list[str]:
+        """Returns the columns we have rules for"""
+        present = set(fieldnames)
+        for colname, rule in self.spec.columns.items():
+            if colname not in present:
+                if rule.key:
+                    self.report(colname, "missing key column", value=filename)
+                else:
+                    self.report(colname, "missing column", "warning", value=filename)
+
+        for colname in fieldnames:
+            if colname not in self.spec.columns and not any(
+                x.search(colname) for x in self.aggregators
+            ):
+                self.report(colname, "not in data-dictionary", "warning", value=filename)
+        return [x for x in fieldnames if x in self.spec.columns]
+
+    def check_column(self, colname: str, values: list[str], first_row: int) -> None:
+        rule = self.spec.columns[colname]
+        missing = self.spec.missing
+
+        # Where each value first appears in the batch, only worked out if
+        # something turns out to be wrong
+        positions: dict[str, int] | None = None
+
+        def row_of(value: str) -> int:
+            nonlocal positions
+            if positions is None:
+                positions = {}
+                for index, x in enumerate(values):
+                    positions.setdefault(x, index)
+            return first_row + positions[value]
+
+        # Each distinct value only needs checking once per batch
+        for value, count in Counter(values).items():
+            stripped = value.strip()
+            if stripped in missing:
+                if rule.key:
+                    self.report(colname, "empty key value", count=count, row=row_of(value))
+                continue
+
+            problem = None
+            if len(rule.enumerations) > 0:
+                if stripped not in rule.enumerations and stripped not in rule.descriptions:
+                    problem = "not in enumerations"
+            elif rule.data_type == "int":
+                if not _integer.match(stripped):
+                    problem = "not an integer"
+            elif rule.data_type == "number":
+                try:
+                    float(stripped)
+                except ValueError:
+                    problem = "not a number"
+
+            if problem is not None:
+                self.report(colname, problem, value=stripped, count=count, row=row_of(value))
+
+    def check_batch(self, colnames: list[str], batch: list[dict[str, str]], first_row: int) -> None:
+        for colname in colnames:
+            self.check_column(colname, [row[colname] or "" for row in batch], first_row)
+
+    def run(self) -> list[Issue]:
+        for filename in self.spec.filenames:
+            with open(filename, "rt", encoding="utf-8-sig", errors="ignore", newline="") as f:
+                reader = csv.DictReader(f, delimiter=self.spec.delimiter, quotechar='"')
+                if reader.fieldnames is None:
+                    self.report("", "empty file", value=filename)
+                    continue
+                reader.fieldnames = [fix_fieldname(x) for x in reader.fieldnames]
+                colnames = self.check_header(filename, reader.fieldnames)
+
+                batch: list[dict[str, str]] = []
+                # Row numbers count the header as row 1, like a spreadsheet
+                first_row = 2
+                for row in reader:
+                    batch.append(row)
+                    if len(batch) >= self.batch_size:
+                        self.check_batch(colnames, batch, first_row)
+                        first_row += len(batch)
+                        batch = []
+                if len(batch) > 0:
+                    self.check_batch(colnames, batch, first_row)
+                    first_row += len(batch)
+                self.rows += first_row - 2
+        return list(self.issues.values())
+
+
+def validate_table(spec: TableSpec) -> tuple[str, int, list[Issue]]:
+    validator = TableValidator(spec)
+    issues = validator.run()
+    return spec.table_name, validator.rows, issues
+
+
+def table_specs(config: Configuration) -> list[TableSpec]:
+    missing = default_missing
+    if config.config is not None and "missing" in config.config:
+        missing = config.config["missing"].split(",")
+    missing_values = frozenset([x.strip() for x in missing] + [""])
+
+    active_tables = config.active_tables or {"ALL": True}
+
+    specs = []
+    for table_name, table in config.dataset.items():
+        if not (active_tables.get("ALL") == True or active_tables.get(table_name)):
+            continue
+        dd_table = config.study_dd.tables.get(table_name)
+        if dd_table is None:
+            continue
+
+        filenames = [
+            x.strip()
+            for x in table.get("filename", "").split(",")
+            if x.strip() != "" and x.strip().lower() != "none"
+        ]
+        if len(filenames) == 0:
+            continue
+
+        key_columns = set(dd_table.key)
+        if dd_table.subject_id is not None:
+            key_columns.add(dd_table.subject_id)
+        key_columns = {fix_fieldname(x) for x in key_columns}
+
+        # The same "varname:description" => code lookup the extractor uses
+        descriptions: defaultdict[str, set[str]] = defaultdict(set)
+        for vardesc in config.study_dd.varname_lookup(table_name):
+            varname, colon, description = vardesc.partition(":")
+            if colon:
+                descriptions[varname].add(description)
+
+        columns = {}
+        for varname, variable in dd_table.variables.items():
+            columns[variable.fieldname] = ColumnRule(
+                varname=varname,
+                data_type=variable.data_type,
+                enumerations=frozenset(variable.enumerations.keys()),
+                key=variable.fieldname in key_columns,
+                descriptions=frozenset(descriptions[variable.varname]),
+            )
+
+        specs.append(
+            TableSpec(
+                table_name=table_name,
+                filenames=filenames,
+                delimiter=table.get("delimiter", ","),
+                columns=columns,
+                missing=missing_values,
+                aggregators=list(table.get("aggregators", {}).values()),
+            )
+        )
+    return specs
+
+
+class ValidationReport:
+    def __init__(self) -> None:
+        # table name => number of rows checked
+        self.rows: dict[str, int] = {}
+        self.issues: list[Issue] = []
+
+    @property
+    def errors(self) -> list[Issue]:
+        return [x for x in self.issues if x.severity == "error"]
+
+    @property
+    def warnings(self) -> list[Issue]:
+        return [x for x in self.issues if x.severity == "warning"]
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "rows": self.rows,
+            "errors": sum(x.count for x in self.errors),
+            "warnings": sum(x.count for x in self.warnings),
+            "issues": [x.as_dict() for x in self.issues],
+        }
+
+    def print_report(self, max_issues: int = 50) -> None:
+        print(
+            f"\nValidated {sum(self.rows.values())} rows from {len(self.rows)} tables: "
+            f"[red]{sum(x.count for x in self.errors)} errors[/red], "
+            f"[yellow]{sum(x.count for x in self.warnings)} warnings[/yellow]"
+        )
+        if len(self.issues) == 0:
+            return
+
+        print(
+            "Table                    Column                   Problem                  #         Examples"
+        )
+        print(
+            "------------------------ ------------------------ ------------------------ --------- --------"
+        )
+        ordered = sorted(
+            self.issues, key=lambda x: (x.severity != "error", x.table, x.column, x.problem)
+        )
+        for issue in ordered[:max_issues]:
+            color = "red" if issue.severity == "error" else "yellow"
+            examples = ", ".join(issue.examples)
+            if issue.first_row is not None:
+                examples = f"{examples} (row {issue.first_row})"
+            print(
+                f"{issue.table:<24} {issue.column:<24} [{color}]{issue.problem:<24}[/{color}] "
+                f"{issue.count:<9} {examples}"
+            )
+        if len(ordered) > max_issues:
+            print(f"... and {len(ordered) - max_issues} more")
+
+    def save(self, filename: str) -> None:
+        with open(filename, "wt") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+def validate_data(config: Configuration, workers: int = 4) -> ValidationReport:
+    specs = table_specs(config)
+    if workers <= 1 or len(specs) < 2:
+        results = [validate_table(spec) for spec in specs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(specs))) as executor:
+            results = list(executor.map(validate_table, specs))
+
+    report = ValidationReport()
+    for table_name, rows, issues in results:
+        report.rows[table_name] = rows
+        report.issues += issues
+    return report
+
+
+def add_validate_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--validate-data",
+        action="store_true",
+        help="Check the source data against the data-dictionary before "
+        "running whistle and stop if there are any errors",
+    )
+    parser.add_argument(
+        "--validation-report",
+        type=str,
+        default=None,
+        help="Write the full validation report to this JSON file",
+    )
+
+
+def exec(args: list[str] | None = None) -> None:
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(
+        description="Check each table's CSV files against the data-dictionary."
+    )
+    parser.add_argument(
+        "config",
+        type=FileType("rt", encoding="utf-8-sig"),
+        nargs="+",
+        help="Dataset YAML file(s) with details required to run conversion.",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=4, help="Number of tables to check at once"
+    )
+    parser.add_argument("--report", type=str, help="Write the full report to this JSON file")
+    parsed = parser.parse_args(args)
+
+    error_count = 0
+    for config_file in parsed.config:
+        config = Configuration(config_file)
+        print(f"Validating [blue]{config.study_id}[/blue]")
+        report = validate_data(config, workers=parsed.workers)
+        report.print_report()
+        error_count += len(report.errors)
+        if parsed.report is not None:
+            report_file = parsed.report
+            if len(parsed.config) > 1:
+                report_file = report_file.replace(".json", f"-{config.study_id}.json")
+            report.save(report_file)
+            print(f"Report written to {report_file}")
+
+    if error_count > 0:
+        sys.exit(1)